@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""Benchmarks of the value and policy iteration solvers on frozen lakes."""
+import argparse
+import contextlib
+import csv
+import io
+import sys
+import time
+
+import numpy as np
+
+from frozen_lake import (
+    MAPS,
+    FrozenLakeEnv,
+    generate_random_map,
+    red_black_states,
+)
+from vi_and_pi import (
+    EVALUATION_MODES,
+    compile_lake,
+    compile_mdp,
+    policy_iteration,
+    policy_iteration_vectorized,
+    value_iteration,
+    value_iteration_gauss_seidel,
+    value_iteration_parallel,
+    value_iteration_prioritized,
+    value_iteration_vectorized,
+)
+
+SIZES = [100, 316, 1000]
+SCALING_SIZES = [4, 8, 16, 32, 64, 128, 256, 512, 1000]
+
+
+def timed(fn, *args, **kwargs):
+    """Return the result of fn and its wall-clock seconds, silencing its prints."""
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_vectorized(args):
+    """Nested-loop solvers against the vectorized ones on dense and sparse arrays."""
+    lakes = {name: MAPS[name] for name in ("4x4", "8x8")}
+    lakes[f"{args.size}x{args.size}"] = generate_random_map(
+        args.size, args.frozen, args.seed
+    )
+
+    for name, desc in lakes.items():
+        env = FrozenLakeEnv(desc=desc, is_slippery=args.slippery)
+        (T, R), compile_time = timed(compile_mdp, env.P, env.nS, env.nA)
+        (T_sparse, _), sparse_time = timed(
+            compile_mdp, env.P, env.nS, env.nA, sparse=True
+        )
+        print(
+            f"{name} lake ({env.nS} states), compiled in {compile_time:.3f} s,"
+            + f" sparse in {sparse_time:.3f} s"
+        )
+
+        for solver, vectorized in (
+            (value_iteration, value_iteration_vectorized),
+            (policy_iteration, policy_iteration_vectorized),
+        ):
+            (V, policy), loop_time = timed(
+                solver, env.P, env.nS, env.nA, gamma=args.gamma, tol=args.tol
+            )
+            times = {"loops": loop_time}
+            for backend, transitions in (("dense", T), ("sparse", T_sparse)):
+                (V_, policy_), times[backend] = timed(
+                    vectorized, transitions, R, gamma=args.gamma, tol=args.tol
+                )
+                # Sanity check: both compute the same fixed point
+                assert np.allclose(V, V_) and np.array_equal(policy, policy_)
+            print(
+                f"  {solver.__name__:<18}"
+                + "".join(f" {k}: {t:8.3f} s," for k, t in times.items())
+                + f" speedup: {loop_time / min(times.values()):.1f}x"
+            )
+
+
+def bench_sparse(args):
+    """The sparse solvers on generated lakes of up to millions of states."""
+    for size in args.sizes:
+        desc = generate_random_map(size, args.frozen, args.seed)
+        (T, R), compile_time = timed(compile_lake, desc, args.slippery)
+        megabytes = (T.data.nbytes + T.indices.nbytes + T.indptr.nbytes) / 2**20
+        print(
+            f"{size}x{size} lake ({len(R)} states, {T.nnz} transitions,"
+            + f" {megabytes:.1f} MB), compiled in {compile_time:.3f} s"
+        )
+        for solver in (value_iteration_vectorized, policy_iteration_vectorized):
+            _, solve_time = timed(solver, T, R, gamma=args.gamma, tol=args.tol)
+            print(f"  {solver.__name__:<28} {solve_time:8.3f} s")
+
+
+def bench_evaluation(args):
+    """Policy iteration with every policy evaluation mode on generated lakes."""
+    for size in args.sizes:
+        desc = generate_random_map(size, args.frozen, args.seed)
+        T, R = compile_lake(desc, args.slippery)
+        print(f"{size}x{size} lake ({len(R)} states)")
+        reference = None
+        for mode in EVALUATION_MODES:
+            V, _, stats = policy_iteration_vectorized(
+                T,
+                R,
+                gamma=args.gamma,
+                tol=args.tol,
+                evaluation=mode,
+                sweeps=args.sweeps,
+                return_stats=True,
+            )
+            if reference is None:
+                reference = V
+            print(
+                f"  {mode:<8}"
+                + f" improvements: {stats['improvements']:4d},"
+                + f" evaluation iterations: {stats['evaluation_iterations']:6d},"
+                + f" fallbacks: {stats['fallbacks']:3d},"
+                + f" evaluation: {stats['evaluation_time']:8.3f} s,"
+                + f" total: {stats['time']:8.3f} s,"
+                + f" max |V - V_sweeps|: {np.max(np.abs(V - reference)):.2e}"
+            )
+
+
+def bench_sweeping(args):
+    """Convergence against time of synchronous, in-place and prioritized sweeps."""
+    thresholds = [1e-1, 1e-2, 1e-3, 1e-4, 1e-5, 1e-6]
+    thresholds = [t for t in thresholds if t >= args.tol]
+    rows = []
+    for size in args.sizes:
+        desc = generate_random_map(size, args.frozen, args.seed)
+        T, R = compile_lake(desc, args.slippery)
+        colors = red_black_states(desc)
+        solvers = {
+            "jacobi": lambda trace: value_iteration_vectorized(
+                T, R, args.gamma, args.tol, trace=trace
+            ),
+            "red-black": lambda trace: value_iteration_gauss_seidel(
+                T, R, args.gamma, args.tol, blocks=colors, trace=trace
+            ),
+            "parallel": lambda trace: value_iteration_parallel(
+                T, R, args.gamma, args.tol, colors, args.workers, trace=trace
+            ),
+        }
+        # Per-state Python loops are only practical on smaller lakes
+        if len(R) <= args.max_loop_states:
+            solvers["gauss-seidel"] = lambda trace: value_iteration_gauss_seidel(
+                T, R, args.gamma, args.tol, trace=trace
+            )
+            solvers["prioritized"] = lambda trace: value_iteration_prioritized(
+                T, R, args.gamma, args.tol, trace=trace
+            )
+
+        print(f"{size}x{size} lake ({len(R)} states), seconds to max residual")
+        print(f"  {'':<13}" + "".join(f" {t:>9.0e}" for t in thresholds))
+        for name, solver in solvers.items():
+            trace = []
+            solver(trace)
+            times = [
+                next((t for t, _, residual in trace if residual <= threshold), None)
+                for threshold in thresholds
+            ]
+            unit = "backups" if name == "prioritized" else "sweeps"
+            print(
+                f"  {name:<13}"
+                + "".join(f" {'-' if t is None else f'{t:9.3f}':>9}" for t in times)
+                + f"  ({trace[-1][1]} {unit})"
+            )
+            rows += [(size, name, *entry) for entry in trace]
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["size", "solver", "seconds", "iterations", "residual"])
+            writer.writerows(rows)
+
+
+def bench_scaling(args):
+    """Time building and solving generated lakes of growing size, as CSV.
+
+    Every solver that is practical at a size runs on the same lake. The
+    value error is against value iteration on the sparse backend.
+    """
+    out = open(args.csv, "w", newline="") if args.csv else sys.stdout
+    writer = csv.writer(out)
+    writer.writerow(["size", "states", "method", "seconds", "max_value_error"])
+
+    for size in args.sizes:
+        desc = generate_random_map(size, args.frozen, args.seed)
+        (T, R), compile_time = timed(compile_lake, desc, args.slippery)
+        nS = len(R)
+        loops = nS <= args.max_loop_states
+        writer.writerow([size, nS, "compile_lake", compile_time, ""])
+
+        colors = red_black_states(desc)
+        # (name, solver, MDP arguments, keyword arguments)
+        methods = [
+            ("value_iteration_sparse", value_iteration_vectorized, (T, R), {}),
+            ("policy_iteration_sparse", policy_iteration_vectorized, (T, R), {}),
+        ]
+        for mode in EVALUATION_MODES[1:]:
+            # An LU factorization per policy gets slow quickly
+            if mode != "direct" or loops:
+                methods.append(
+                    (
+                        f"policy_iteration_{mode}",
+                        policy_iteration_vectorized,
+                        (T, R),
+                        dict(evaluation=mode),
+                    )
+                )
+        methods += [
+            (
+                "gauss_seidel_red_black",
+                value_iteration_gauss_seidel,
+                (T, R),
+                dict(blocks=colors),
+            ),
+            (
+                "parallel_red_black",
+                value_iteration_parallel,
+                (T, R),
+                dict(colors=colors, num_workers=args.workers),
+            ),
+        ]
+        if nS <= args.max_dense_states:
+            dense = compile_lake(desc, args.slippery, sparse=False)
+            methods += [
+                ("value_iteration_dense", value_iteration_vectorized, dense, {}),
+                ("policy_iteration_dense", policy_iteration_vectorized, dense, {}),
+            ]
+        if loops:
+            methods.append(("prioritized", value_iteration_prioritized, (T, R), {}))
+            env, build_time = timed(
+                FrozenLakeEnv, desc=desc, is_slippery=args.slippery
+            )
+            writer.writerow([size, nS, "build_P", build_time, ""])
+            P = (env.P, env.nS, env.nA)
+            methods += [
+                ("value_iteration", value_iteration, P, {}),
+                ("policy_iteration", policy_iteration, P, {}),
+            ]
+
+        reference = None
+        for name, solver, mdp, kwargs in methods:
+            (V, _), seconds = timed(
+                solver, *mdp, gamma=args.gamma, tol=args.tol, **kwargs
+            )
+            if reference is None:
+                reference = V
+            writer.writerow([size, nS, name, seconds, np.max(np.abs(V - reference))])
+        out.flush()
+
+    if args.csv:
+        out.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MDP solver benchmarks")
+    parser.add_argument(
+        "benchmark",
+        choices=["vectorized", "sparse", "evaluation", "sweeping", "scaling"],
+        help="What to benchmark",
+    )
+    parser.add_argument("--size", default=100, type=int, help="Generated lake size")
+    parser.add_argument(
+        "--sizes",
+        default=None,
+        nargs="+",
+        type=int,
+        help=f"Generated lake sizes, by default {SCALING_SIZES} when scaling"
+        + f" and {SIZES} otherwise",
+    )
+    parser.add_argument(
+        "--frozen", default=0.8, type=float, help="Frozen fraction of generated lakes"
+    )
+    parser.add_argument(
+        "--sweeps", default=5, type=int, help="Sweeps of modified policy iteration"
+    )
+    parser.add_argument(
+        "--workers", default=None, type=int, help="Processes of parallel sweeping"
+    )
+    parser.add_argument(
+        "--max_loop_states",
+        default=10000,
+        type=int,
+        help="Largest lake to run P and the per-state Python loops on",
+    )
+    parser.add_argument(
+        "--max_dense_states",
+        default=4096,
+        type=int,
+        help="Largest lake to run the dense backend on",
+    )
+    parser.add_argument(
+        "--csv",
+        default=None,
+        help="Write the sweeping traces or scaling results here, instead of stdout",
+    )
+    parser.add_argument("--seed", default=0, type=int, help="Generated lake seed")
+    parser.add_argument("--gamma", default=0.9, type=float, help="Discount factor")
+    parser.add_argument("--tol", default=1e-3, type=float, help="Tolerance")
+    parser.add_argument(
+        "--deterministic",
+        dest="slippery",
+        action="store_false",
+        help="Use deterministic instead of slippery lakes",
+    )
+    args = parser.parse_args()
+    if args.sizes is None:
+        args.sizes = SCALING_SIZES if args.benchmark == "scaling" else SIZES
+
+    if args.benchmark == "vectorized":
+        bench_vectorized(args)
+    elif args.benchmark == "sparse":
+        bench_sparse(args)
+    elif args.benchmark == "evaluation":
+        bench_evaluation(args)
+    elif args.benchmark == "sweeping":
+        bench_sweeping(args)
+    elif args.benchmark == "scaling":
+        bench_scaling(args)
+
+
+if __name__ == "__main__":
+    main()
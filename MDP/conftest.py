@@ -0,0 +1,19 @@
+import pytest
+
+LAKE_NAMES = ["4x4", "8x8", "12x12"]
+
+
+@pytest.fixture(scope="module", params=LAKE_NAMES)
+def lake(request):
+    """A lake's map, its environment, and the value iteration reference."""
+    pytest.importorskip("gym")
+    from frozen_lake import MAPS, FrozenLakeEnv, generate_random_map
+    from vi_and_pi import value_iteration
+
+    if request.param in MAPS:
+        desc = MAPS[request.param]
+    else:
+        desc = generate_random_map(12, p=0.7, seed=0)
+    env = FrozenLakeEnv(desc=desc)
+    V, policy = value_iteration(env.P, env.nS, env.nA, gamma=0.9, tol=1e-10)
+    return desc, env, V, policy
@@ -0,0 +1,51 @@
+"""The policy evaluation modes against the direct solve and value iteration."""
+import numpy as np
+import pytest
+
+pytest.importorskip("gym")
+
+import vi_and_pi
+from frozen_lake import MAPS
+from vi_and_pi import (
+    EVALUATION_MODES,
+    compile_lake,
+    evaluate_policy,
+    policy_iteration_vectorized,
+)
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+@pytest.mark.parametrize("mode", ["sweeps", "gmres", "bicgstab"])
+def test_evaluation_modes_match_direct_solve(lake, mode):
+    desc, _, _, policy = lake
+    T, R = compile_lake(desc)
+    expected, _, _ = evaluate_policy(T, R, policy, gamma=0.9, mode="direct")
+    V, _, fallback = evaluate_policy(T, R, policy, gamma=0.9, tol=1e-8, mode=mode)
+    # From zeros, bicgstab breaks down on some optimal lake policies
+    assert not fallback or mode == "bicgstab"
+    np.testing.assert_allclose(V, expected, atol=1e-7)
+
+
+@pytest.mark.parametrize("evaluation", EVALUATION_MODES)
+def test_policy_iteration_matches_value_iteration(lake, evaluation):
+    desc, _, V, _ = lake
+    T, R = compile_lake(desc)
+    V_, _ = policy_iteration_vectorized(
+        T, R, gamma=0.9, tol=1e-10, evaluation=evaluation
+    )
+    np.testing.assert_allclose(V_, V, atol=1e-8)
+
+
+def test_unconverged_krylov_evaluation_falls_back(monkeypatch):
+    T, R = compile_lake(MAPS["8x8"])
+    policy = np.zeros(len(R), dtype=int)
+    expected, _, _ = evaluate_policy(T, R, policy, mode="direct")
+
+    def gmres(A, b, **kwargs):
+        return np.zeros_like(b), 1  # Hit the iteration limit
+
+    monkeypatch.setattr(vi_and_pi.scipy.sparse.linalg, "gmres", gmres)
+    with pytest.warns(RuntimeWarning):
+        V, _, fallback = evaluate_policy(T, R, policy, mode="gmres")
+    assert fallback
+    np.testing.assert_allclose(V, expected)
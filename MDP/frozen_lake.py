@@ -30,6 +30,83 @@ MAPS = {
     ],
 }
 
+def generate_random_map(size=8, p=0.8, seed=None):
+    """
+    Generate a random size x size lake, with S top left and G bottom right.
+
+    Every other tile is frozen with probability p. The tiles of a random
+    staircase path of right and down moves from S to G are always frozen,
+    so the goal is reachable.
+    """
+    if size < 2:
+        raise ValueError('A lake needs size >= 2 to hold both S and G')
+    rng = np.random.default_rng(seed)
+    desc = np.where(rng.random((size, size)) < p, b'F', b'H')
+
+    moves = rng.permutation(np.repeat([0, 1], size - 1))
+    path_rows = np.concatenate([[0], np.cumsum(moves == 1)])
+    path_cols = np.concatenate([[0], np.cumsum(moves == 0)])
+    desc[path_rows, path_cols] = b'F'
+
+    desc[0, 0], desc[-1, -1] = b'S', b'G'
+    return [row.tobytes().decode() for row in desc]
+
+# Row and column offsets of moving LEFT, DOWN, RIGHT and UP
+MOVES = np.array([[0, -1], [1, 0], [0, 1], [-1, 0]])
+
+def lake_transitions(desc, is_slippery=True):
+    """
+    Transitions of every state and action of a lake, computed with array ops.
+
+    Lists the same transitions as FrozenLakeEnv in the same order, padded to
+    K = 3 per action on slippery lakes and K = 1 otherwise: a hole or goal
+    moves to itself with probability 1 in its first entry and 0 in the others.
+
+    Returns next_states, probs, rewards, dones, each of shape (nS, nA, K)
+    """
+    desc = np.asarray(desc, dtype='c')
+    nrow, ncol = desc.shape
+    nS, nA = nrow * ncol, 4
+
+    if is_slippery:
+        # Slip to either side of the intended direction
+        directions = (np.arange(nA)[:, None] + [-1, 0, 1]) % nA
+        probs = np.array([0.1, 0.8, 0.1])
+    else:
+        directions = np.arange(nA)[:, None]
+        probs = np.array([1.0])
+
+    row, col = np.divmod(np.arange(nS), ncol)
+    newrow = np.clip(row[:, None, None] + MOVES[directions, 0], 0, nrow - 1)
+    newcol = np.clip(col[:, None, None] + MOVES[directions, 1], 0, ncol - 1)
+    next_states = newrow * ncol + newcol
+
+    letters = desc.ravel()
+    newletters = letters[next_states]
+    probs = np.broadcast_to(probs, next_states.shape).copy()
+    rewards = (newletters == b'G').astype(float)
+    dones = (newletters == b'G') | (newletters == b'H')
+
+    terminal = (letters == b'G') | (letters == b'H')
+    next_states[terminal] = np.nonzero(terminal)[0][:, None, None]
+    probs[terminal] = 0.0
+    probs[terminal, :, 0] = 1.0
+    rewards[terminal] = 0.0
+    dones[terminal] = True
+    return next_states, probs, rewards, dones
+
+def red_black_states(desc):
+    """
+    Split the states of a lake into the two colors of a checkerboard.
+
+    Every move goes to a neighbour, which has the other color, or stays put,
+    so the states of one color never transition to each other.
+    """
+    nrow, ncol = np.asarray(desc, dtype='c').shape
+    row, col = np.divmod(np.arange(nrow * ncol), ncol)
+    red = (row + col) % 2 == 0
+    return [np.nonzero(red)[0], np.nonzero(~red)[0]]
+
 class FrozenLakeEnv(discrete_env.DiscreteEnv):
     """
     Winter is here. You and your friends were tossing around a frisbee at the park
@@ -72,45 +149,19 @@ class FrozenLakeEnv(discrete_env.DiscreteEnv):
         isd = np.array(desc == b'S').astype('float64').ravel()
         isd /= isd.sum()
 
-        P = {s : {a : [] for a in range(nA)} for s in range(nS)}
-
-        def to_s(row, col):
-            return row*ncol + col
-        def inc(row, col, a):
-            if a==0: # left
-                col = max(col-1,0)
-            elif a==1: # down
-                row = min(row+1,nrow-1)
-            elif a==2: # right
-                col = min(col+1,ncol-1)
-            elif a==3: # up
-                row = max(row-1,0)
-            return (row, col)
-
-        for row in range(nrow):
-            for col in range(ncol):
-                s = to_s(row, col)
-                for a in range(4):
-                    li = P[s][a]
-                    letter = desc[row, col]
-                    if letter in b'GH':
-                        li.append((1.0, s, 0, True))
-                    else:
-                        if is_slippery:
-                            for b in [(a-1)%4, a, (a+1)%4]:
-                                newrow, newcol = inc(row, col, b)
-                                newstate = to_s(newrow, newcol)
-                                newletter = desc[newrow, newcol]
-                                done = bytes(newletter) in b'GH'
-                                rew = float(newletter == b'G')
-                                li.append((0.8 if b==a else 0.1, newstate, rew, done))
-                        else:
-                            newrow, newcol = inc(row, col, a)
-                            newstate = to_s(newrow, newcol)
-                            newletter = desc[newrow, newcol]
-                            done = bytes(newletter) in b'GH'
-                            rew = float(newletter == b'G')
-                            li.append((1.0, newstate, rew, done))
+        # All the (probability, nextstate, reward, done) tuples in order
+        next_states, probs, rewards, dones = lake_transitions(desc, is_slippery)
+        K = probs.shape[2]
+        transitions = list(zip(probs.ravel().tolist(), next_states.ravel().tolist(),
+                               rewards.ravel().tolist(), dones.ravel().tolist()))
+        # Holes and goals only keep their first transition, a self-loop
+        terminal = np.isin(desc.ravel(), [b'G', b'H']).tolist()
+
+        P = {}
+        for s in range(nS):
+            n = 1 if terminal[s] else K
+            start = s * nA * K
+            P[s] = {a : transitions[start + a*K : start + a*K + n] for a in range(nA)}
 
         super(FrozenLakeEnv, self).__init__(nS, nA, P, isd)
 
@@ -0,0 +1,94 @@
+"""The vectorized lake builder, generated lakes and policy iteration cycles."""
+from collections import deque
+
+import numpy as np
+import pytest
+
+pytest.importorskip("gym")
+
+from frozen_lake import FrozenLakeEnv, generate_random_map
+from vi_and_pi import policy_evaluation, policy_iteration
+
+
+def loop_lake_P(desc, is_slippery=True):
+    """P of a lake built one transition at a time, as FrozenLakeEnv used to."""
+    desc = np.asarray(desc, dtype="c")
+    nrow, ncol = desc.shape
+    P = {s: {a: [] for a in range(4)} for s in range(nrow * ncol)}
+
+    def inc(row, col, a):
+        if a == 0:
+            col = max(col - 1, 0)
+        elif a == 1:
+            row = min(row + 1, nrow - 1)
+        elif a == 2:
+            col = min(col + 1, ncol - 1)
+        elif a == 3:
+            row = max(row - 1, 0)
+        return row, col
+
+    for row in range(nrow):
+        for col in range(ncol):
+            s = row * ncol + col
+            for a in range(4):
+                if desc[row, col] in b"GH":
+                    P[s][a].append((1.0, s, 0, True))
+                    continue
+                moves = [(a - 1) % 4, a, (a + 1) % 4] if is_slippery else [a]
+                for b in moves:
+                    newrow, newcol = inc(row, col, b)
+                    newletter = desc[newrow, newcol]
+                    prob = 1.0 if not is_slippery else 0.8 if b == a else 0.1
+                    P[s][a].append(
+                        (
+                            prob,
+                            newrow * ncol + newcol,
+                            float(newletter == b"G"),
+                            bytes(newletter) in b"GH",
+                        )
+                    )
+    return P
+
+
+def reachable(desc):
+    """Whether G can be reached from S without stepping into a hole."""
+    n = len(desc)
+    seen, queue = {(0, 0)}, deque([(0, 0)])
+    while queue:
+        row, col = queue.popleft()
+        if desc[row][col] == "G":
+            return True
+        if desc[row][col] == "H":
+            continue
+        for drow, dcol in ((0, 1), (1, 0), (0, -1), (-1, 0)):
+            cell = (row + drow, col + dcol)
+            if 0 <= cell[0] < n and 0 <= cell[1] < n and cell not in seen:
+                seen.add(cell)
+                queue.append(cell)
+    return False
+
+
+@pytest.mark.parametrize("is_slippery", [True, False])
+def test_lake_P_matches_loops(lake, is_slippery):
+    desc, _, _, _ = lake
+    env = FrozenLakeEnv(desc=desc, is_slippery=is_slippery)
+    # Equal in value: e.g. the rewards of holes and goals are 0.0 instead of 0
+    assert env.P == loop_lake_P(desc, is_slippery)
+
+
+def test_generate_random_map():
+    for seed in range(50):
+        desc = generate_random_map(10, p=0.4, seed=seed)
+        assert desc[0][0] == "S" and desc[-1][-1] == "G"
+        assert reachable(desc)
+    assert generate_random_map(20, seed=3) == generate_random_map(20, seed=3)
+    with pytest.raises(ValueError):
+        generate_random_map(1)
+
+
+def test_policy_iteration_returns_the_value_of_its_policy(lake):
+    _, env, _, _ = lake
+    # A loose tolerance, where evaluations stopping early can make policies cycle
+    V, policy = policy_iteration(env.P, env.nS, env.nA, gamma=0.9, tol=1e-2)
+    expected = policy_evaluation(env.P, env.nS, env.nA, policy, gamma=0.9, tol=1e-2)
+    np.testing.assert_array_equal(V, expected)
@@ -0,0 +1,38 @@
+"""The sparse backend against the dense arrays and the loops over P."""
+import numpy as np
+import pytest
+
+pytest.importorskip("gym")
+
+from vi_and_pi import (
+    compile_lake,
+    compile_mdp,
+    policy_iteration_vectorized,
+    value_iteration_vectorized,
+)
+
+
+def test_compile_lake_matches_compile_mdp(lake):
+    desc, env, _, _ = lake
+    T, R = compile_mdp(env.P, env.nS, env.nA)
+    for T_sparse, R_sparse in (
+        compile_mdp(env.P, env.nS, env.nA, sparse=True),
+        compile_lake(desc),
+    ):
+        np.testing.assert_array_equal(T_sparse.toarray().reshape(T.shape), T)
+        np.testing.assert_array_equal(R_sparse, R)
+
+
+def test_sparse_solvers_match_dense(lake):
+    desc, env, V, policy = lake
+    dense = compile_mdp(env.P, env.nS, env.nA)
+    T, R = compile_lake(desc)
+
+    V_, policy_ = value_iteration_vectorized(T, R, gamma=0.9, tol=1e-10)
+    np.testing.assert_allclose(V_, V, atol=1e-12)
+    np.testing.assert_array_equal(policy_, policy)
+
+    V_dense, policy_dense = policy_iteration_vectorized(*dense, gamma=0.9, tol=1e-3)
+    V_, policy_ = policy_iteration_vectorized(T, R, gamma=0.9, tol=1e-3)
+    np.testing.assert_allclose(V_, V_dense, atol=1e-12)
+    np.testing.assert_array_equal(policy_, policy_dense)
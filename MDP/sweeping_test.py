@@ -0,0 +1,55 @@
+"""In-place, prioritized and parallel sweeping against value iteration."""
+import numpy as np
+import pytest
+
+pytest.importorskip("gym")
+
+from frozen_lake import generate_random_map, red_black_states
+from vi_and_pi import (
+    compile_lake,
+    value_iteration_gauss_seidel,
+    value_iteration_parallel,
+    value_iteration_prioritized,
+)
+
+
+def test_red_black_colors_do_not_interact(lake):
+    desc, _, _, _ = lake
+    T, _ = compile_lake(desc)
+    nA = 4
+    for color in red_black_states(desc):
+        rows = (color[:, None] * nA + np.arange(nA)).ravel()
+        block = T[rows][:, color].tocoo()
+        # Only self-loops stay within a color
+        np.testing.assert_array_equal(color[block.row // nA], color[block.col])
+
+
+def test_asynchronous_value_iteration_matches_value_iteration(lake):
+    desc, _, V, _ = lake
+    T, R = compile_lake(desc)
+    colors = red_black_states(desc)
+    for V_, _ in (
+        value_iteration_gauss_seidel(T, R, gamma=0.9, tol=1e-10),
+        value_iteration_gauss_seidel(T, R, gamma=0.9, tol=1e-10, blocks=colors),
+        value_iteration_prioritized(T, R, gamma=0.9, tol=1e-10),
+        value_iteration_parallel(T, R, gamma=0.9, tol=1e-10, colors=colors),
+    ):
+        np.testing.assert_allclose(V_, V, atol=1e-8)
+
+
+def test_prioritized_sweeping_trace(lake):
+    desc, _, V, _ = lake
+    T, R = compile_lake(desc)
+    trace = []
+    V_, _ = value_iteration_prioritized(T, R, gamma=0.9, tol=1e-10, trace=trace)
+    np.testing.assert_allclose(V_, V, atol=1e-8)
+    assert [backups for _, backups, _ in trace] == sorted(b for _, b, _ in trace)
+    assert trace[-1][2] <= 1e-10
+
+
+def test_prioritized_sweeping_trace_after_the_heap_empties():
+    # The last backup empties the heap just as a trace entry is due
+    T, R = compile_lake(generate_random_map(2, p=0.3, seed=2))
+    trace = []
+    value_iteration_prioritized(T, R, gamma=0.9, tol=0.1, trace=trace)
+    assert all(residual <= 0.1 for _, _, residual in trace[-2:])
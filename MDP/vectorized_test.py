@@ -0,0 +1,43 @@
+"""The vectorized solvers on dense arrays against the loops over P."""
+import numpy as np
+import pytest
+
+pytest.importorskip("gym")
+
+from vi_and_pi import (
+    compile_mdp,
+    policy_iteration,
+    policy_iteration_vectorized,
+    value_iteration_vectorized,
+)
+
+
+def test_compile_mdp_matches_P(lake):
+    _, env, _, _ = lake
+    T, R = compile_mdp(env.P, env.nS, env.nA)
+    for s in range(env.nS):
+        for a in range(env.nA):
+            probs = np.zeros(env.nS)
+            reward = 0.0
+            for p, s_, r, _ in env.P[s][a]:
+                probs[s_] += p
+                reward += p * r
+            np.testing.assert_allclose(T[s, a], probs)
+            assert R[s, a] == pytest.approx(reward)
+
+
+def test_vectorized_value_iteration_matches_loops(lake):
+    _, env, V, policy = lake
+    T, R = compile_mdp(env.P, env.nS, env.nA)
+    V_, policy_ = value_iteration_vectorized(T, R, gamma=0.9, tol=1e-10)
+    np.testing.assert_allclose(V_, V, atol=1e-12)
+    np.testing.assert_array_equal(policy_, policy)
+
+
+def test_vectorized_policy_iteration_matches_loops(lake):
+    _, env, _, _ = lake
+    V, policy = policy_iteration(env.P, env.nS, env.nA, gamma=0.9, tol=1e-3)
+    T, R = compile_mdp(env.P, env.nS, env.nA)
+    V_, policy_ = policy_iteration_vectorized(T, R, gamma=0.9, tol=1e-3)
+    np.testing.assert_allclose(V_, V, atol=1e-12)
+    np.testing.assert_array_equal(policy_, policy)
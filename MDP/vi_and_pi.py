@@ -1,12 +1,24 @@
 ### MDP Value Iteration and Policy Iteration
 
+import collections
+import heapq
+import multiprocessing as mp
+import os
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
 import gym
 import time
+import warnings
+from frozen_lake import lake_transitions
 from lake_envs import *
 
 np.set_printoptions(precision=3)
 
+# Number of recent policies policy iteration checks for cycles. Cycles
+# between nearly tied policies are short, so older ones are forgotten
+RECENT_POLICIES = 4
+
 """
 For policy_evaluation, policy_improvement, policy_iteration and value_iteration,
 the parameters P, nS, nA, gamma are defined as follows:
@@ -112,7 +124,7 @@ def policy_improvement(P, nS, nA, value_from_policy, policy, gamma=0.9):
     return new_policy
 
 
-def policy_iteration(P, nS, nA, gamma=0.9, tol=10e-3):
+def policy_iteration(P, nS, nA, gamma=0.9, tol=10e-3, evaluation="sweeps", sweeps=5):
     """Runs policy iteration.
 
     You should call the policy_evaluation() and policy_improvement() methods to
@@ -124,6 +136,11 @@ def policy_iteration(P, nS, nA, gamma=0.9, tol=10e-3):
             defined at beginning of file
     tol: float
             tol parameter used in policy_evaluation()
+    evaluation: str
+            "sweeps" runs the loops below. Any other of EVALUATION_MODES
+            compiles P and runs policy_iteration_vectorized() with it.
+    sweeps: int
+            Sweeps per evaluation of the "modified" mode
     Returns:
     ----------
     value_function: np.ndarray[nS]
@@ -133,11 +150,31 @@ def policy_iteration(P, nS, nA, gamma=0.9, tol=10e-3):
     value_function = np.zeros(nS)
     policy = np.zeros(nS, dtype=int)
 
+    if evaluation != "sweeps":
+        T, R = compile_mdp(P, nS, nA, sparse=True)
+        value_function, policy, stats = policy_iteration_vectorized(
+            T, R, gamma, tol, evaluation, sweeps, return_stats=True
+        )
+        print(
+            f"Policy iteration ({evaluation}) converged in {stats['improvements']}"
+            + f" improvements, {stats['evaluation_iterations']} evaluation"
+            + f" iterations, {stats['evaluation_time']:.3f} s evaluating"
+            + f" of {stats['time']:.3f} s"
+        )
+        return value_function, policy
+
     ############################
     # YOUR IMPLEMENTATION HERE #
 
     prev_policy = np.ones(nS, dtype=int)  # Arbitrary initialization
+    recent = collections.deque(maxlen=RECENT_POLICIES)
     while not np.all(policy == prev_policy):
+        # Evaluations that stop at tol can make nearly tied policies cycle,
+        # then stop with the value of the policy that closed the cycle
+        if policy.tobytes() in recent:
+            value_function = policy_evaluation(P, nS, nA, policy, gamma, tol)
+            break
+        recent.append(policy.tobytes())
         prev_policy = policy.copy()
         value_function = policy_evaluation(P, nS, nA, policy, gamma, tol)
         policy = policy_improvement(P, nS, nA, value_function, policy, gamma)
@@ -193,6 +230,583 @@ def value_iteration(P, nS, nA, gamma=0.9, tol=1e-3):
     return value_function, policy
 
 
+"""
+The vectorized solvers below take the MDP compiled by compile_mdp instead of P:
+
+        T: np.ndarray[nS, nA, nS] or scipy.sparse.csr_matrix[nS * nA, nS]
+                T[s, a, s'], or T[s * nA + a, s'] when sparse, is the probability
+                of transitioning from s to s' with a
+        R: np.ndarray[nS, nA]
+                R[s, a] is the expected reward of taking a in s
+
+Every Bellman backup over all states is then one contraction R + gamma * T @ V.
+They follow the same update and stopping rules as the loops above, so they
+return the same value functions and policies. A dense T takes memory and time
+per backup growing with nS^2, which pays off up to a few thousand states. A
+frozen lake has at most 3 successors per action, so a sparse T stays linear
+in nS and scales to millions of states.
+"""
+
+
+def build_mdp(nS, nA, rows, probs, next_states, rewards, sparse=False):
+    """Build the compiled MDP from flat transition arrays.
+
+    Parameters
+    ----------
+    nS, nA:
+            defined at beginning of file
+    rows, probs, next_states, rewards: np.ndarray
+            Transition k goes from state-action row rows[k] = s * nA + a to
+            next_states[k] with probability probs[k] and reward rewards[k].
+            Repeated (s, a, s') entries, e.g. slipping into a wall, add up.
+    sparse: bool
+            Return T as a CSR matrix
+    Returns
+    -------
+    T: np.ndarray[nS, nA, nS] or scipy.sparse.csr_matrix[nS * nA, nS]
+    R: np.ndarray[nS, nA]
+    """
+    R = np.bincount(rows, weights=probs * rewards, minlength=nS * nA)
+    if sparse:
+        T = scipy.sparse.csr_matrix((probs, (rows, next_states)), shape=(nS * nA, nS))
+        T.eliminate_zeros()
+    else:
+        T = np.zeros((nS * nA, nS))
+        np.add.at(T, (rows, next_states), probs)
+        T = T.reshape(nS, nA, nS)
+    return T, R.reshape(nS, nA)
+
+
+def compile_mdp(P, nS, nA, sparse=False):
+    """Compile the nested P dictionary into transition and reward arrays.
+
+    Parameters
+    ----------
+    P, nS, nA:
+            defined at beginning of file
+    sparse: bool
+            Return T as a CSR matrix
+    Returns
+    -------
+    T: np.ndarray[nS, nA, nS] or scipy.sparse.csr_matrix[nS * nA, nS]
+    R: np.ndarray[nS, nA]
+    """
+    rows, probs, next_states, rewards = zip(
+        *[
+            (s * nA + a, p, s_, r)
+            for s in range(nS)
+            for a in range(nA)
+            for p, s_, r, _ in P[s][a]
+        ]
+    )
+    return build_mdp(
+        nS,
+        nA,
+        np.array(rows),
+        np.array(probs, dtype=float),
+        np.array(next_states),
+        np.array(rewards, dtype=float),
+        sparse,
+    )
+
+
+def compile_lake(desc, is_slippery=True, sparse=True):
+    """Compile a frozen lake map straight into the MDP arrays.
+
+    Skips building P, which takes too much time and memory for large lakes.
+
+    Parameters
+    ----------
+    desc: list(str)
+            The lake map, as in frozen_lake.MAPS
+    is_slippery: bool
+            As in frozen_lake.FrozenLakeEnv
+    sparse: bool
+            Return T as a CSR matrix
+    Returns
+    -------
+    T: np.ndarray[nS, nA, nS] or scipy.sparse.csr_matrix[nS * nA, nS]
+    R: np.ndarray[nS, nA]
+    """
+    next_states, probs, rewards, _ = lake_transitions(desc, is_slippery)
+    nS, nA, K = probs.shape
+    rows = np.repeat(np.arange(nS * nA), K)
+    return build_mdp(
+        nS, nA, rows, probs.ravel(), next_states.ravel(), rewards.ravel(), sparse
+    )
+
+
+def q_values(T, R, value_function, gamma=0.9):
+    """One Bellman backup: Q[s, a] = R[s, a] + gamma * sum_s' T[s, a, s'] V[s']."""
+    return R + gamma * (T @ value_function).reshape(R.shape)
+
+
+def policy_mdp(T, R, policy):
+    """Return the transitions T_pi[s, s'] and rewards R_pi[s] of following policy."""
+    states = np.arange(len(R))
+    if scipy.sparse.issparse(T):
+        return T[states * R.shape[1] + policy], R[states, policy]
+    return T[states, policy], R[states, policy]
+
+
+EVALUATION_MODES = ("sweeps", "direct", "gmres", "bicgstab", "modified")
+
+
+def evaluate_policy(
+    T, R, policy, gamma=0.9, tol=1e-3, mode="sweeps", value_function=None, sweeps=5
+):
+    """Evaluate a policy on the arrays from compile_mdp with one of EVALUATION_MODES.
+
+    Parameters
+    ----------
+    T, R, gamma:
+            defined above compile_mdp
+    policy: np.array[nS]
+            The policy to evaluate. Maps states to actions.
+    tol: float
+            Tolerance of the sweeps, or of the solution of the iterative solvers
+    mode: str
+            "sweeps" repeats V = R_pi + gamma * T_pi V until
+                    max |value_function(s) - prev_value_function(s)| <= tol
+            "direct" solves (I - gamma T_pi) V = R_pi with a sparse LU
+            factorization, or a dense one if T is dense
+            "gmres" and "bicgstab" solve the same system with a Krylov method,
+            stopping once ||R_pi - (I - gamma T_pi) V|| <= tol * (1 - gamma),
+            which bounds the error of every state by tol
+            "modified" does just sweeps sweeps, for modified policy iteration
+    value_function: np.ndarray[nS]
+            Initial guess, e.g. the value of the previous policy. Zeros if None.
+            The direct solve does not need one.
+    sweeps: int
+            Number of sweeps of the "modified" mode
+    Returns
+    -------
+    value_function: np.ndarray[nS]
+    iterations: int
+            Number of sweeps or Krylov iterations, 1 for the direct solve
+    fallback: bool
+            Whether the Krylov method stopped without converging, with a
+            warning, and the system was solved directly instead
+    """
+    assert mode in EVALUATION_MODES, f"Unknown evaluation mode {mode}"
+    T_pi, R_pi = policy_mdp(T, R, policy)
+    nS = len(R_pi)
+    if value_function is None:
+        value_function = np.zeros(nS)
+
+    if mode == "sweeps":
+        iterations = 0
+        while True:
+            iterations += 1
+            prev_value_function = value_function
+            value_function = R_pi + gamma * (T_pi @ prev_value_function)
+            if np.max(np.abs(value_function - prev_value_function)) <= tol:
+                return value_function, iterations, False
+
+    if mode == "modified":
+        for _ in range(sweeps):
+            value_function = R_pi + gamma * (T_pi @ value_function)
+        return value_function, sweeps, False
+
+    if not scipy.sparse.issparse(T_pi):
+        A = np.eye(nS) - gamma * T_pi
+        direct_solve = np.linalg.solve
+    else:
+        A = (scipy.sparse.identity(nS, format="csr") - gamma * T_pi).tocsr()
+
+        def direct_solve(A, b):
+            return scipy.sparse.linalg.spsolve(A.tocsc(), b)
+
+    if mode == "direct":
+        return direct_solve(A, R_pi), 1, False
+
+    iterations = 0
+
+    def count(_):
+        nonlocal iterations
+        iterations += 1
+
+    kwargs = dict(x0=value_function, rtol=0.0, atol=tol * (1 - gamma), callback=count)
+    if mode == "gmres":
+        value_function, info = scipy.sparse.linalg.gmres(
+            A, R_pi, callback_type="pr_norm", **kwargs
+        )
+    else:
+        value_function, info = scipy.sparse.linalg.bicgstab(A, R_pi, **kwargs)
+    if info != 0:
+        # Hit the iteration limit (info > 0) or broke down (info < 0)
+        warnings.warn(
+            f"{mode} did not converge (info={info}) after {iterations}"
+            + " iterations, solving the policy's system directly instead",
+            RuntimeWarning,
+        )
+        return direct_solve(A, R_pi), iterations, True
+    return value_function, iterations, False
+
+
+def policy_evaluation_vectorized(T, R, policy, gamma=0.9, tol=1e-3):
+    """Vectorized policy_evaluation on the arrays from compile_mdp."""
+    return evaluate_policy(T, R, policy, gamma, tol)[0]
+
+
+def policy_improvement_vectorized(T, R, value_from_policy, gamma=0.9):
+    """Vectorized policy_improvement on the arrays from compile_mdp."""
+    return np.argmax(q_values(T, R, value_from_policy, gamma), axis=1)
+
+
+def policy_iteration_vectorized(
+    T, R, gamma=0.9, tol=10e-3, evaluation="sweeps", sweeps=5, return_stats=False
+):
+    """Vectorized policy_iteration on the arrays from compile_mdp.
+
+    Parameters
+    ----------
+    T, R, gamma:
+            defined above compile_mdp
+    tol: float
+            tol parameter used in evaluate_policy()
+    evaluation: str
+            Policy evaluation mode, see evaluate_policy(). Except for "sweeps",
+            which restarts from zero like policy_iteration(), every evaluation
+            starts from the value of the previous policy, and an action only
+            changes if another is better by more than tol * (1 - gamma).
+            With "modified", iteration only stops once the policy is stable
+            and a sweep changes its value by at most tol.
+    sweeps: int
+            Sweeps per evaluation of the "modified" mode
+    return_stats: bool
+            Also return the number of improvements, the total number of
+            evaluation iterations, the number of Krylov evaluations that fell
+            back to the direct solve, and the evaluation and total wall-clock
+            time
+    Returns
+    -------
+    value_function: np.ndarray[nS]
+    policy: np.ndarray[nS]
+    stats: dict
+            Only if return_stats is true
+    """
+    start_time = time.perf_counter()
+    nS = len(R)
+    states = np.arange(nS)
+    value_function = None
+    policy = np.zeros(nS, dtype=int)
+    stats = {
+        "improvements": 0,
+        "evaluation_iterations": 0,
+        "fallbacks": 0,
+        "evaluation_time": 0.0,
+    }
+    recent = collections.deque(maxlen=RECENT_POLICIES)
+
+    while True:
+        evaluation_start = time.perf_counter()
+        value_function, iterations, fallback = evaluate_policy(
+            T,
+            R,
+            policy,
+            gamma,
+            tol,
+            evaluation,
+            None if evaluation == "sweeps" else value_function,
+            sweeps,
+        )
+        stats["evaluation_time"] += time.perf_counter() - evaluation_start
+        stats["evaluation_iterations"] += iterations
+        stats["fallbacks"] += fallback
+
+        Q = q_values(T, R, value_function, gamma)
+        new_policy = np.argmax(Q, axis=1)
+        if evaluation != "sweeps":
+            # Only switch actions that are better by more than the evaluation
+            # error, so round-off between tied actions cannot cycle forever
+            gain = Q[states, new_policy] - Q[states, policy]
+            new_policy = np.where(gain > tol * (1 - gamma), new_policy, policy)
+        stats["improvements"] += 1
+        if np.array_equal(new_policy, policy) and (
+            evaluation != "modified"
+            or np.max(np.abs(Q[states, policy] - value_function)) <= tol
+        ):
+            break
+        if evaluation == "sweeps":
+            recent.append(policy.tobytes())
+        policy = new_policy
+        # As in policy_iteration(), stop with the value of the policy that
+        # closed the cycle if sweeps from zero made policies cycle
+        if evaluation == "sweeps" and policy.tobytes() in recent:
+            value_function, iterations, _ = evaluate_policy(T, R, policy, gamma, tol)
+            stats["evaluation_iterations"] += iterations
+            break
+
+    stats["time"] = time.perf_counter() - start_time
+    if return_stats:
+        return value_function, policy, stats
+    return value_function, policy
+
+
+def value_iteration_vectorized(T, R, gamma=0.9, tol=1e-3, trace=None):
+    """Vectorized value_iteration on the arrays from compile_mdp.
+
+    If trace is a list, (seconds, sweeps, max |value change|) is appended to
+    it after every sweep.
+    """
+    start_time = time.perf_counter()
+    value_function = np.zeros(len(R))
+    sweeps = 0
+    while True:
+        sweeps += 1
+        prev_value_function = value_function
+        Q = q_values(T, R, prev_value_function, gamma)
+        value_function = np.max(Q, axis=1)
+        delta = np.max(np.abs(value_function - prev_value_function))
+        if trace is not None:
+            trace.append((time.perf_counter() - start_time, sweeps, delta))
+        if delta <= tol:
+            return value_function, np.argmax(Q, axis=1)
+
+
+"""
+Asynchronous value iteration. Unlike the synchronous sweeps above, these update
+the value function in place, so later updates already use the new values. They
+stop once no state's value would change by more than tol, and return the greedy
+policy of the final values. T may be dense, but is converted to CSR form.
+"""
+
+
+def as_csr(T):
+    """Return T as a CSR matrix of shape (nS * nA, nS)."""
+    if scipy.sparse.issparse(T):
+        return T.tocsr()
+    nS, nA, _ = T.shape
+    return scipy.sparse.csr_matrix(T.reshape(nS * nA, nS))
+
+
+def state_rows(states, nA):
+    """Rows s * nA + a of a CSR T for every state in states and every action."""
+    return (np.asarray(states)[:, None] * nA + np.arange(nA)).ravel()
+
+
+def state_q_values(T, R, value_function, s, gamma=0.9):
+    """Q[s, :] of a single state, reading the CSR arrays of T directly."""
+    nA = R.shape[1]
+    row_starts = T.indptr[s * nA : (s + 1) * nA + 1]
+    start, end = row_starts[0], row_starts[-1]
+    backups = T.data[start:end] * value_function[T.indices[start:end]]
+    # Every row has a transition, its probabilities sum to 1
+    return R[s] + gamma * np.add.reduceat(backups, row_starts[:-1] - start)
+
+
+def value_iteration_gauss_seidel(T, R, gamma=0.9, tol=1e-3, blocks=None, trace=None):
+    """Value iteration with in-place Gauss-Seidel sweeps.
+
+    Parameters
+    ----------
+    T, R, gamma:
+            defined above compile_mdp
+    tol: float
+            Terminate once a sweep changes no value by more than tol
+    blocks: list(np.ndarray)
+            Groups of states to back up together, in order, each with one
+            vectorized backup from the latest values. None updates one state
+            at a time from 0 to nS - 1 in a Python loop. If the states of a
+            block never transition to each other, e.g. the two colors of
+            frozen_lake.red_black_states, block sweeps are exact Gauss-Seidel.
+    trace: list
+            If given, (seconds, sweeps, max |value change|) is appended after
+            every sweep
+    Returns
+    -------
+    value_function: np.ndarray[nS]
+    policy: np.ndarray[nS]
+    """
+    start_time = time.perf_counter()
+    T = as_csr(T)
+    nS, nA = R.shape
+    value_function = np.zeros(nS)
+    if blocks is not None:
+        block_mdps = [(T[state_rows(block, nA)], R[block]) for block in blocks]
+
+    sweeps = 0
+    while True:
+        sweeps += 1
+        delta = 0.0
+        if blocks is None:
+            for s in range(nS):
+                v = np.max(state_q_values(T, R, value_function, s, gamma))
+                delta = max(delta, abs(v - value_function[s]))
+                value_function[s] = v
+        else:
+            for block, (T_block, R_block) in zip(blocks, block_mdps):
+                v = np.max(q_values(T_block, R_block, value_function, gamma), axis=1)
+                delta = max(delta, np.max(np.abs(v - value_function[block])))
+                value_function[block] = v
+        if trace is not None:
+            trace.append((time.perf_counter() - start_time, sweeps, delta))
+        if delta <= tol:
+            break
+
+    policy = np.argmax(q_values(T, R, value_function, gamma), axis=1)
+    return value_function, policy
+
+
+def predecessors(T, nA):
+    """CSR matrix whose row s' lists the states s with T[s, a, s'] > 0 for some a."""
+    T = as_csr(T)
+    nS = T.shape[1]
+    sources = np.repeat(np.arange(T.shape[0]) // nA, np.diff(T.indptr))
+    return scipy.sparse.csr_matrix(
+        (np.ones(T.nnz, dtype=np.int8), (T.indices, sources)), shape=(nS, nS)
+    )
+
+
+def value_iteration_prioritized(
+    T, R, gamma=0.9, tol=1e-3, max_updates=None, trace=None
+):
+    """Prioritized sweeping: always back up the state with the largest residual.
+
+    Keeps every Bellman residual |max_a Q(s, a) - V(s)| above tol in a max-heap.
+    Backing up a state only changes the residuals of its predecessors, which
+    are looked up in a precomputed index and pushed again. Outdated heap
+    entries are skipped when popped.
+
+    Parameters
+    ----------
+    T, R, gamma:
+            defined above compile_mdp
+    tol: float
+            Terminate once no residual is above tol
+    max_updates: int
+            Stop after this many state backups, if given
+    trace: list
+            If given, (seconds, backups, largest residual) is appended after
+            every nS backups and at the end
+    Returns
+    -------
+    value_function: np.ndarray[nS]
+    policy: np.ndarray[nS]
+    """
+    start_time = time.perf_counter()
+    T = as_csr(T)
+    nS, nA = R.shape
+    pred = predecessors(T, nA)
+
+    value_function = np.zeros(nS)
+    residuals = np.abs(np.max(q_values(T, R, value_function, gamma), axis=1))
+    heap = [(-r, s) for s, r in enumerate(residuals.tolist()) if r > tol]
+    heapq.heapify(heap)
+
+    updates = 0
+    while heap and (max_updates is None or updates < max_updates):
+        priority, s = heapq.heappop(heap)
+        if -priority != residuals[s]:
+            continue  # Outdated
+        value_function[s] = np.max(state_q_values(T, R, value_function, s, gamma))
+        residuals[s] = 0.0
+        updates += 1
+
+        for p in pred.indices[pred.indptr[s] : pred.indptr[s + 1]]:
+            q = state_q_values(T, R, value_function, p, gamma)
+            r = abs(np.max(q) - value_function[p])
+            if r != residuals[p]:
+                residuals[p] = r
+                if r > tol:
+                    heapq.heappush(heap, (-r, p))
+
+        if trace is not None and updates % nS == 0:
+            # The heap can be empty or hold outdated entries, so use residuals
+            trace.append((time.perf_counter() - start_time, updates, residuals.max()))
+    if trace is not None:
+        trace.append((time.perf_counter() - start_time, updates, residuals.max()))
+
+    policy = np.argmax(q_values(T, R, value_function, gamma), axis=1)
+    return value_function, policy
+
+
+# Set before forking the pool of value_iteration_parallel, read by its workers
+_parallel_state = {}
+
+
+def _update_block(block_id):
+    """Back up one block of value_iteration_parallel in place."""
+    T_block, R_block, block = _parallel_state["blocks"][block_id]
+    value_function = _parallel_state["value_function"]
+    gamma = _parallel_state["gamma"]
+    v = np.max(q_values(T_block, R_block, value_function, gamma), axis=1)
+    delta = np.max(np.abs(v - value_function[block]))
+    value_function[block] = v
+    return delta
+
+
+def value_iteration_parallel(
+    T, R, gamma=0.9, tol=1e-3, colors=None, num_workers=None, trace=None
+):
+    """Block-parallel value iteration over a pool of processes.
+
+    Every color of states is split into num_workers disjoint blocks, which the
+    workers back up in place in a value function in shared memory. Colors are
+    swept one after another, so with frozen_lake.red_black_states every
+    sweep is red-black Gauss-Seidel. With the default single color, blocks
+    read each other's values as they are written, i.e. asynchronous value
+    iteration.
+
+    Processes are forked, so this only runs on Linux.
+
+    Parameters
+    ----------
+    T, R, gamma:
+            defined above compile_mdp
+    tol: float
+            Terminate once a sweep changes no value by more than tol
+    colors: list(np.ndarray)
+            Groups of states swept one after another. All states if None.
+    num_workers: int
+            Number of processes. The number of CPUs if None.
+    trace: list
+            If given, (seconds, sweeps, max |value change|) is appended after
+            every sweep
+    Returns
+    -------
+    value_function: np.ndarray[nS]
+    policy: np.ndarray[nS]
+    """
+    start_time = time.perf_counter()
+    T = as_csr(T)
+    nS, nA = R.shape
+    if colors is None:
+        colors = [np.arange(nS)]
+    num_workers = num_workers or os.cpu_count()
+
+    ctx = mp.get_context("fork")
+    value_function = np.frombuffer(ctx.RawArray("d", nS))
+    blocks = []
+    phases = []
+    for color in colors:
+        phase = []
+        for block in np.array_split(color, num_workers):
+            if len(block):
+                phase.append(len(blocks))
+                blocks.append((T[state_rows(block, nA)], R[block], block))
+        phases.append(phase)
+    _parallel_state.update(blocks=blocks, value_function=value_function, gamma=gamma)
+
+    try:
+        with ctx.Pool(num_workers) as pool:
+            sweeps = 0
+            while True:
+                sweeps += 1
+                delta = max(max(pool.map(_update_block, phase)) for phase in phases)
+                if trace is not None:
+                    trace.append((time.perf_counter() - start_time, sweeps, delta))
+                if delta <= tol:
+                    break
+    finally:
+        _parallel_state.clear()
+
+    value_function = value_function.copy()
+    policy = np.argmax(q_values(T, R, value_function, gamma), axis=1)
+    return value_function, policy
+
+
 def render_single(env, policy, max_steps=100):
     """
     This function does not need to be modified
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Microbenchmarks for the REINFORCE and imitation rollouts."""
+import argparse
+import time
+
+import numpy as np
+
+from deeprl_hw3.imitation import get_policy_step, load_model
+
+
+def timeit(fn, num_iters):
+    """Return the mean wall-clock seconds per call of fn."""
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        fn()
+    return (time.perf_counter() - start) / num_iters
+
+
+def bench_policy_step(args):
+    """Per-step action selection latency, predict_on_batch vs PolicyStep."""
+    model = load_model(args.config)
+    observation = np.random.randn(1, *model.input_shape[1:]).astype(np.float32)
+    policy_step = get_policy_step(model)
+
+    # The original per-step path: Keras predict, then NumPy sampling
+    def predict_sample():
+        probs = model.predict_on_batch(observation)[0]
+        return np.random.choice(len(probs), p=probs)
+
+    predict_time = timeit(predict_sample, args.iters)
+    greedy_time = timeit(lambda: policy_step(observation), args.iters)
+    sample_time = timeit(lambda: policy_step(observation, sample=True), args.iters)
+    print(f"predict_on_batch:     {predict_time * 1e6:.1f} us/step")
+    print(f"PolicyStep (greedy):  {greedy_time * 1e6:.1f} us/step")
+    print(f"PolicyStep (sampled): {sample_time * 1e6:.1f} us/step")
+    print(f"Speedup: {predict_time / sample_time:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="REINFORCE microbenchmarks")
+    parser.add_argument("benchmark", choices=["policy_step"], help="What to benchmark")
+    parser.add_argument(
+        "--config", default="CartPole-v0_config.json", help="Model config file"
+    )
+    parser.add_argument("--iters", default=1000, type=int, help="Timed iterations")
+    args = parser.parse_args()
+
+    if args.benchmark == "policy_step":
+        bench_policy_step(args)
+
+
+if __name__ == "__main__":
+    main()
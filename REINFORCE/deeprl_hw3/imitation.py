@@ -4,8 +4,17 @@ from __future__ import division, absolute_import
 from __future__ import print_function, unicode_literals
 
 from keras.models import model_from_json
+import glob
+import json
+import multiprocessing as mp
+import os
+
+import gym
 import numpy as np
+import tensorflow as tf
 import time
+import uuid
+import weakref
 
 
 def load_model(model_config_path, model_weights_path=None):
@@ -34,6 +43,79 @@ def load_model(model_config_path, model_weights_path=None):
     return model
 
 
+class PolicyStep:
+    """Compiled action selection of a Keras policy model.
+
+    Calling predict_on_batch for every environment step spends most of
+    its time in Keras' per-call setup. PolicyStep instead wraps the
+    forward pass and the action choice in a single tf.function with a
+    fixed input signature, so it is traced once and every step is one
+    graph call. Actions are sampled in-graph with
+    tf.random.categorical, or taken greedily.
+
+    Parameters
+    ----------
+    model: keras.models.Model
+      Model mapping a batch of observations to action probabilities.
+    """
+
+    def __init__(self, model):
+        # Weak, so caching the step in get_policy_step keeps nothing alive
+        self.model_ref = weakref.ref(model)
+        self.step = tf.function(
+            self._step,
+            input_signature=[
+                tf.TensorSpec((None, *model.input_shape[1:]), tf.float32),
+                tf.TensorSpec((), tf.bool),
+            ],
+        )
+
+    def _step(self, observations, sample):
+        probs = self.model_ref()(observations, training=False)
+        actions = tf.cond(
+            sample,
+            lambda: tf.random.categorical(
+                tf.math.log(probs), 1, dtype=tf.int32
+            )[:, 0],
+            lambda: tf.argmax(probs, axis=1, output_type=tf.int32),
+        )
+        return probs, actions
+
+    def __call__(self, observations, sample=False):
+        """Choose an action for every observation of a batch.
+
+        Parameters
+        ----------
+        observations: ndarray
+          (B, *obs_shape) observations.
+        sample: bool, optional
+          Sample from the action probabilities instead of acting
+          greedily.
+
+        Returns
+        -------
+        probs: ndarray
+          (B, A) action probabilities.
+        actions: ndarray
+          (B,) chosen actions.
+        """
+        probs, actions = self.step(
+            tf.convert_to_tensor(observations, dtype=tf.float32),
+            tf.constant(sample),
+        )
+        return probs.numpy(), actions.numpy()
+
+
+_policy_steps = weakref.WeakKeyDictionary()
+
+
+def get_policy_step(model):
+    """Return the PolicyStep of a model, compiling it on first use."""
+    if model not in _policy_steps:
+        _policy_steps[model] = PolicyStep(model)
+    return _policy_steps[model]
+
+
 def generate_expert_training_data(expert, env, num_episodes=100, render=True):
     """Generate training dataset.
 
@@ -61,15 +143,52 @@ def generate_expert_training_data(expert, env, num_episodes=100, render=True):
 
     ############ TODO #############
 
-    states = []
-    actions = []
+    episodes = list(iter_expert_episodes(expert, env, num_episodes, render=render))
+    states = np.concatenate([episode_states for episode_states, _ in episodes])
+    actions = np.concatenate([episode_actions for _, episode_actions in episodes])
+    actions = np.eye(env.action_space.n)[actions]
+    ###############################
 
-    for _ in range(num_episodes):
-        state, _ = env.reset()
+    return states, actions
+
+
+def iter_expert_episodes(expert, env, num_episodes=100, render=False, seed=None):
+    """Play expert episodes one at a time.
+
+    Parameters
+    ----------
+    expert: keras.models.Model
+      Model with expert weights.
+    env: gym.core.Env
+      The gym environment associated with this expert.
+    num_episodes: int, optional
+      How many expert episodes should be run.
+    render: bool, optional
+      Render the environment, with a slight pause after each action.
+    seed: int, optional
+      Seed of the first reset. Environments whose reset takes no
+      arguments, like the one from wrap_cartpole, need None.
+
+    Yields
+    ------
+    states: ndarray
+      (T, *obs_shape) float32 states of one episode.
+    actions: ndarray
+      (T,) int8 indices of the actions the expert chose.
+    """
+    policy_step = get_policy_step(expert)
+
+    for i in range(num_episodes):
+        if i == 0 and seed is not None:
+            state, _ = env.reset(seed=seed)
+        else:
+            state, _ = env.reset()
+        states = []
+        actions = []
         is_done = False
         truncated = False
         while not is_done and not truncated:
-            action = np.argmax(expert.predict_on_batch(state[np.newaxis, ...])[0])
+            action = policy_step(state[np.newaxis, ...])[1][0]
             next_state, _, is_done, truncated, _ = env.step(action)
             states.append(state)
             actions.append(action)
@@ -77,11 +196,253 @@ def generate_expert_training_data(expert, env, num_episodes=100, render=True):
             if render:
                 env.render()
                 time.sleep(0.1)
-    states = np.stack(states)
-    actions = np.eye(env.action_space.n)[actions]
-    ###############################
+        yield np.array(states, dtype=np.float32), np.array(actions, dtype=np.int8)
 
-    return states, actions
+
+class ShardWriter:
+    """Writes (state, action) pairs to fixed-size shards on disk.
+
+    Pairs are copied into preallocated buffers of shard_size rows, and
+    every full buffer is saved as `<prefix>_<index>_states.npy`
+    (float32) and `<prefix>_<index>_actions.npy` (int8 action indices)
+    in path, so memory use does not grow with the dataset. Call close
+    to write the last, partial shard.
+
+    Parameters
+    ----------
+    path: str
+      Dataset directory.
+    obs_shape: tuple(int)
+      Shape of one state.
+    num_actions: int
+      Size of the action space, recorded in meta.json for the loader.
+    shard_size: int, optional
+      Number of pairs per shard.
+    prefix: str, optional
+      Shard file prefix. Must differ between concurrent writers.
+    """
+
+    def __init__(self, path, obs_shape, num_actions, shard_size=65536, prefix="shard"):
+        self.path = path
+        self.prefix = prefix
+        os.makedirs(path, exist_ok=True)
+
+        self.states = np.zeros((shard_size, *obs_shape), dtype=np.float32)
+        self.actions = np.zeros(shard_size, dtype=np.int8)
+        self.num_rows = 0
+        self.num_shards = 0
+        self.num_written = 0
+
+        meta = {"obs_shape": list(obs_shape), "num_actions": int(num_actions)}
+        tmp_path = os.path.join(path, f"meta.json.{prefix}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(path, "meta.json"))
+
+    def write(self, states, actions):
+        """Append a batch of states and action indices."""
+        start = 0
+        while start < len(states):
+            count = min(len(states) - start, len(self.states) - self.num_rows)
+            rows = slice(self.num_rows, self.num_rows + count)
+            self.states[rows] = states[start : start + count]
+            self.actions[rows] = actions[start : start + count]
+            self.num_rows += count
+            start += count
+            if self.num_rows == len(self.states):
+                self.flush()
+
+    def flush(self):
+        """Write the buffered pairs as a shard."""
+        if self.num_rows == 0:
+            return
+        name = os.path.join(self.path, f"{self.prefix}_{self.num_shards:05d}")
+        np.save(name + "_states.npy", self.states[: self.num_rows])
+        np.save(name + "_actions.npy", self.actions[: self.num_rows])
+        self.num_written += self.num_rows
+        self.num_shards += 1
+        self.num_rows = 0
+
+    def close(self):
+        """Write the last shard."""
+        self.flush()
+
+
+def write_expert_shards(
+    expert, env, path, num_episodes=100, shard_size=65536, prefix="shard", seed=None
+):
+    """Stream expert episodes into dataset shards.
+
+    Returns
+    -------
+    int
+      Number of (state, action) pairs written.
+    """
+    writer = ShardWriter(
+        path,
+        env.observation_space.shape,
+        env.action_space.n,
+        shard_size=shard_size,
+        prefix=prefix,
+    )
+    for states, actions in iter_expert_episodes(expert, env, num_episodes, seed=seed):
+        writer.write(states, actions)
+    writer.close()
+    return writer.num_written
+
+
+def _expert_shard_worker(args):
+    """Worker process entry point of collect_expert_shards."""
+    (
+        config_path,
+        weights_path,
+        env_id,
+        path,
+        prefix,
+        num_episodes,
+        shard_size,
+        seed,
+    ) = args
+    expert = load_model(config_path, weights_path)
+    env = gym.make(env_id)
+    return write_expert_shards(
+        expert,
+        env,
+        path,
+        num_episodes,
+        shard_size=shard_size,
+        prefix=prefix,
+        seed=seed,
+    )
+
+
+def collect_expert_shards(
+    model_config_path,
+    model_weights_path,
+    env_id,
+    path,
+    num_episodes=100,
+    num_workers=4,
+    shard_size=65536,
+    seed=None,
+):
+    """Collect expert episodes into dataset shards with worker processes.
+
+    Every worker loads its own copy of the expert, plays its share of
+    the episodes in its own environment and writes its own shards.
+    Workers are spawned rather than forked, which TensorFlow does not
+    support. Shard names start with an id unique to the call, so
+    calling it again on the same path adds to the dataset.
+
+    Parameters
+    ----------
+    model_config_path: str
+      The expert's model configuration file.
+    model_weights_path: str
+      The expert's weights.
+    env_id: str
+      Name of the gym environment.
+    path: str
+      Dataset directory.
+    num_episodes: int, optional
+      Total number of expert episodes.
+    num_workers: int, optional
+      Number of worker processes.
+    shard_size: int, optional
+      Number of pairs per shard.
+    seed: int, optional
+      Seed the workers' environment seeds are derived from. Fresh
+      seeds are drawn if None.
+
+    Returns
+    -------
+    int
+      Number of (state, action) pairs written.
+    """
+    episodes = np.full(num_workers, num_episodes // num_workers)
+    episodes[: num_episodes % num_workers] += 1
+    seeds = np.random.SeedSequence(seed).generate_state(num_workers)
+    run_id = uuid.uuid4().hex[:8]
+    jobs = [
+        (
+            model_config_path,
+            model_weights_path,
+            env_id,
+            path,
+            f"{run_id}_worker{worker_id:03d}",
+            int(worker_episodes),
+            shard_size,
+            int(worker_seed),
+        )
+        for worker_id, (worker_episodes, worker_seed) in enumerate(zip(episodes, seeds))
+        if worker_episodes > 0
+    ]
+    with mp.get_context("spawn").Pool(len(jobs)) as pool:
+        return sum(pool.map(_expert_shard_worker, jobs))
+
+
+def load_expert_dataset(path, batch_size=32, shuffle=True, one_hot=True):
+    """Create a tf.data pipeline over the shards in path.
+
+    Shards are memory-mapped, so only the minibatches being read are
+    loaded. With shuffle, the shards are visited in random order and
+    each one is read in a random permutation.
+
+    Parameters
+    ----------
+    path: str
+      Dataset directory written by ShardWriter.
+    batch_size: int, optional
+      Pairs per minibatch.
+    shuffle: bool, optional
+      Reshuffle every epoch.
+    one_hot: bool, optional
+      Return one-hot float32 actions, as generate_expert_training_data
+      does, instead of int8 indices.
+
+    Returns
+    -------
+    tf.data.Dataset
+      Dataset of (states, actions) minibatches, e.g. for model.fit.
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    shard_names = sorted(
+        name[: -len("_states.npy")]
+        for name in glob.glob(os.path.join(path, "*_states.npy"))
+    )
+
+    def batches():
+        order = np.random.permutation(len(shard_names)) if shuffle else None
+        for i in order if shuffle else range(len(shard_names)):
+            states = np.load(shard_names[i] + "_states.npy", mmap_mode="r")
+            actions = np.load(shard_names[i] + "_actions.npy", mmap_mode="r")
+            if shuffle:
+                indices = np.random.permutation(len(states))
+            else:
+                indices = np.arange(len(states))
+            for start in range(0, len(indices), batch_size):
+                # Sorted, so each batch reads the memory map in order
+                batch = np.sort(indices[start : start + batch_size])
+                yield states[batch], actions[batch]
+
+    dataset = tf.data.Dataset.from_generator(
+        batches,
+        output_signature=(
+            tf.TensorSpec((None, *meta["obs_shape"]), tf.float32),
+            tf.TensorSpec((None,), tf.int8),
+        ),
+    )
+    if one_hot:
+        num_actions = meta["num_actions"]
+        dataset = dataset.map(
+            lambda states, actions: (
+                states,
+                tf.one_hot(tf.cast(actions, tf.int32), num_actions),
+            ),
+            num_parallel_calls=tf.data.AUTOTUNE,
+        )
+    return dataset.prefetch(tf.data.AUTOTUNE)
 
 
 def test_cloned_policy(env, cloned_policy, num_episodes=50, render=True):
@@ -103,6 +464,7 @@ def test_cloned_policy(env, cloned_policy, num_episodes=50, render=True):
       after each action.
     """
     total_rewards = []
+    policy_step = get_policy_step(cloned_policy)
 
     for i in range(num_episodes):
         print("Starting episode {}".format(i))
@@ -114,9 +476,7 @@ def test_cloned_policy(env, cloned_policy, num_episodes=50, render=True):
         is_done = False
         truncated = False
         while not is_done and not truncated:
-            action = np.argmax(
-                cloned_policy.predict_on_batch(state[np.newaxis, ...])[0]
-            )
+            action = policy_step(state[np.newaxis, ...])[1][0]
             state, reward, is_done, truncated, _ = env.step(action)
             total_reward += reward
             if render:
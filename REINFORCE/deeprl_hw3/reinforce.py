@@ -1,7 +1,12 @@
+import functools
+import time
+
 import gym
 import numpy as np
 import tensorflow as tf
-from .imitation import test_cloned_policy
+from scipy.signal import lfilter
+
+from .imitation import get_policy_step, test_cloned_policy
 
 
 def get_total_reward(env, model, training=True):
@@ -18,11 +23,12 @@ def get_total_reward(env, model, training=True):
     total_reward: float
     """
     total_reward = 0
+    policy_step = get_policy_step(model)
     state, _ = env.reset()
     is_done = False
     truncated = False
     while not is_done and not truncated:
-        action = np.argmax(model.predict_on_batch(state[np.newaxis, ...])[0])
+        action = policy_step(state[np.newaxis, ...])[1][0]
         state, reward, is_done, truncated, _ = env.step(action)
         total_reward += reward
     return total_reward
@@ -44,13 +50,11 @@ def choose_action(model, observation, training=True):
         the action you choose
     """
 
-    probs = model.predict_on_batch(observation[np.newaxis, ...])[0]
-
-    if training:
-        action = np.random.choice(len(probs), p=probs)
-    else:
-        action = np.argmax(probs)
-    p = probs[action]
+    probs, actions = get_policy_step(model)(
+        observation[np.newaxis, ...], sample=training
+    )
+    action = actions[0]
+    p = probs[0, action]
 
     return p, action
 
@@ -71,100 +75,420 @@ class pseudo_loss:
         return loss
 
 
-def reinforce(env, model, optimizer):
-    """Policy gradient algorithm
+def collect_episodes(envs, model, training=True, max_steps=None):
+    """Run one episode in each environment, stepping them in lockstep.
+
+    Every step makes one model call on the observations of all the
+    environments that are still running. The episodes are returned
+    padded to the longest one.
+
+    Parameters
+    ----------
+    envs: list(gym.core.Env)
+      The environments, one episode each.
+    model: (your action model, which can be anything)
+    training: bool, optional
+      Sample actions from the policy if true, otherwise act greedily.
+    max_steps: int, optional
+      Cut episodes off after this many steps. Defaults to the time
+      limit of the environment.
+
+    Returns
+    -------
+    observations: ndarray
+      (K, T, *obs_shape) observations.
+    actions: ndarray
+      (K, T) actions.
+    rewards: ndarray
+      (K, T) rewards, 0 after the end of an episode.
+    lengths: ndarray
+      (K,) episode lengths.
+    """
+    num_envs = len(envs)
+    if max_steps is None:
+        max_steps = envs[0].spec.max_episode_steps or 1000
+    obs_shape = envs[0].observation_space.shape
+
+    observations = np.zeros((num_envs, max_steps, *obs_shape), dtype=np.float32)
+    actions = np.zeros((num_envs, max_steps), dtype=np.int32)
+    rewards = np.zeros((num_envs, max_steps), dtype=np.float32)
+    lengths = np.zeros(num_envs, dtype=np.int64)
+
+    policy_step = get_policy_step(model)
+    obs = np.stack([env.reset()[0] for env in envs])
+    active = np.arange(num_envs)
+    for t in range(max_steps):
+        observations[active, t] = obs
+
+        # One model call for all running environments
+        _, step_actions = policy_step(obs, sample=training)
+        actions[active, t] = step_actions
+
+        next_obs = []
+        still_active = []
+        for i, action in zip(active, step_actions):
+            state, reward, is_done, truncated, _ = envs[i].step(int(action))
+            rewards[i, t] = reward
+            lengths[i] += 1
+            if not is_done and not truncated:
+                still_active.append(i)
+                next_obs.append(state)
+
+        if not still_active:
+            break
+        active = np.array(still_active)
+        obs = np.stack(next_obs)
+
+    return observations, actions, rewards, lengths
+
+
+def compute_returns(rewards, gamma=1.0, reward_to_go=True):
+    """Compute the return weighting every step of a batch of episodes.
 
     Parameters
     ----------
-    env: your environment
+    rewards: ndarray
+      (K, T) rewards padded with 0, as from collect_episodes.
+    gamma: float, optional
+      Discount factor.
+    reward_to_go: bool, optional
+      Weight each step by the discounted reward from that step on. If
+      false, every step gets the return of the whole episode, as in
+      vanilla REINFORCE.
 
     Returns
     -------
+    ndarray
+      (K, T) returns.
     """
+    # G_t = r_t + gamma * G_{t+1}, run backwards over every episode at once
+    returns = lfilter([1.0], [1.0, -gamma], rewards[:, ::-1], axis=1)[:, ::-1]
+    if not reward_to_go:
+        returns = np.repeat(returns[:, :1], rewards.shape[1], axis=1)
+    return returns.astype(np.float32)
 
-    # Implement training algorithm here
-    # loss = pseudo_loss()
 
-    @tf.function
-    def apply_gradients(gradients):
+def make_update_fn(model, optimizer):
+    """Create the compiled policy gradient step of a model.
+
+    Built once per model so the tf.function is traced once, not on
+    every call of reinforce.
+
+    Returns
+    -------
+    callable
+      update(observations, actions, weights) taking one gradient step
+      on -sum(weights * log pi(actions | observations)) and returning
+      the loss.
+    """
+
+    @tf.function(reduce_retracing=True)
+    def update(observations, actions, weights):
+        with tf.GradientTape() as tape:
+            action_probs = model(observations, training=True)
+            action_masks = tf.one_hot(actions, tf.shape(action_probs)[1])
+            log_probs = tf.reduce_sum(action_masks * tf.math.log(action_probs), axis=1)
+            loss = -tf.reduce_sum(log_probs * weights)
+        gradients = tape.gradient(loss, model.trainable_variables)
         optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        return loss
 
-    batch_observation = []
-    batch_action = []
-    batch_reward = []
+    return update
+
+
+def compute_gae(rewards, values, gamma=1.0, lam=0.95):
+    """Compute generalized advantage estimates of a batch of episodes.
+
+    Based on Schulman et al., "High-Dimensional Continuous Control Using
+    Generalized Advantage Estimation", ICLR 2016. Every episode end is
+    treated as terminal.
+
+    Parameters
+    ----------
+    rewards: ndarray
+      (K, T) rewards padded with 0, as from collect_episodes.
+    values: ndarray
+      (K, T) value estimates of the states, padded with 0.
+    gamma: float, optional
+      Discount factor.
+    lam: float, optional
+      GAE lambda, trading bias (0) for variance (1).
+
+    Returns
+    -------
+    ndarray
+      (K, T) advantages.
+    """
+    # The padding makes the value after the last step 0
+    next_values = np.zeros_like(values)
+    next_values[:, :-1] = values[:, 1:]
+    deltas = rewards + gamma * next_values - values
+    # A_t = delta_t + gamma * lam * A_{t+1}, over every episode at once
+    advantages = lfilter([1.0], [1.0, -gamma * lam], deltas[:, ::-1], axis=1)
+    return advantages[:, ::-1].astype(np.float32)
+
+
+def make_value_model(obs_shape, hidden_units=16):
+    """Create a state-value network shaped like the CartPole policy."""
+    return tf.keras.Sequential(
+        [
+            tf.keras.Input(shape=obs_shape),
+            tf.keras.layers.Dense(hidden_units, activation="relu"),
+            tf.keras.layers.Dense(hidden_units, activation="relu"),
+            tf.keras.layers.Dense(hidden_units, activation="relu"),
+            tf.keras.layers.Dense(1),
+        ]
+    )
+
+
+def make_value_fns(value_model, optimizer):
+    """Create the compiled prediction and regression step of a value model.
+
+    Returns
+    -------
+    predict: callable
+      predict(observations) returning the (N,) values as an ndarray.
+    update: callable
+      update(observations, returns) taking one gradient step on the
+      mean squared error and returning the loss.
+    """
+
+    @tf.function(reduce_retracing=True)
+    def predict(observations):
+        return value_model(observations, training=False)[:, 0]
+
+    @tf.function(reduce_retracing=True)
+    def update(observations, returns):
+        with tf.GradientTape() as tape:
+            values = value_model(observations, training=True)[:, 0]
+            loss = tf.reduce_mean(tf.square(returns - values))
+        gradients = tape.gradient(loss, value_model.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, value_model.trainable_variables))
+        return loss
+
+    return lambda observations: predict(observations).numpy(), update
+
+
+ADVANTAGES = ("returns", "baseline", "gae")
+
+
+def reinforce(
+    envs,
+    model,
+    optimizer,
+    update_fn=None,
+    gamma=1.0,
+    reward_to_go=False,
+    advantage="returns",
+    value_fns=None,
+    lam=0.95,
+):
+    """Policy gradient algorithm
+
+    Collects one episode in each environment with batched model calls,
+    then takes a single gradient step on all of them.
+
+    Episodes cut off by the time limit count as terminal: neither the
+    returns nor the GAE advantages bootstrap from the value of the
+    last state. That is exact when the objective is the reward within
+    the limit, as for CartPole-v0, but biases the value targets of
+    tasks where the limit only shortens training episodes.
+
+    Parameters
+    ----------
+    envs: gym.core.Env or list(gym.core.Env)
+      The environments. Each contributes one episode to the batch.
+    model: (your action model, which can be anything)
+    optimizer: keras.optimizers.Optimizer
+    update_fn: callable, optional
+      The result of make_update_fn(model, optimizer). Pass it in when
+      calling reinforce repeatedly so it is only traced once.
+    gamma: float, optional
+      Discount factor.
+    reward_to_go: bool, optional
+      See compute_returns. Always true unless advantage is "returns".
+    advantage: str, optional
+      What weights the log-probabilities: the "returns" themselves,
+      the returns minus a learned value "baseline", or "gae"
+      advantages built on the same value network.
+    value_fns: tuple(callable), optional
+      The result of make_value_fns, required unless advantage is
+      "returns". The value network is fit to the reward-to-go returns
+      after every batch.
+    lam: float, optional
+      GAE lambda.
+
+    Returns
+    -------
+    episode_rewards: ndarray
+      The total reward of every collected episode.
+    episode_lengths: ndarray
+      The length of every collected episode.
+    """
+    assert advantage in ADVANTAGES, f"Unknown advantage {advantage}"
+    if not isinstance(envs, (list, tuple)):
+        envs = [envs]
+    if update_fn is None:
+        update_fn = make_update_fn(model, optimizer)
+
+    observations, actions, rewards, lengths = collect_episodes(envs, model)
+    returns = compute_returns(
+        rewards, gamma, reward_to_go or advantage != "returns"
+    )
+
+    # Flatten the valid steps of all episodes into one batch
+    mask = np.arange(rewards.shape[1]) < lengths[:, np.newaxis]
+    step_observations = observations[mask]
+    if advantage == "returns":
+        weights = returns[mask]
+    else:
+        predict_values, update_values = value_fns
+        values = np.zeros_like(rewards)
+        values[mask] = predict_values(step_observations)
+        if advantage == "baseline":
+            weights = (returns - values)[mask]
+        else:
+            weights = compute_gae(rewards, values, gamma, lam)[mask]
+        update_values(step_observations, returns[mask])
+
+    # Average over episodes so the step size does not depend on K
+    weights = weights / len(envs)
+    update_fn(step_observations, actions[mask], weights)
+
+    return rewards.sum(axis=1), lengths
+
+
+def evaluate(envs, model, num_episodes=100):
+    """Return the total rewards of num_episodes greedy episodes.
+
+    The episodes are played len(envs) at a time with batched model
+    calls.
+    """
+    total_rewards = []
+    while len(total_rewards) < num_episodes:
+        num_envs = min(len(envs), num_episodes - len(total_rewards))
+        _, _, rewards, _ = collect_episodes(envs[:num_envs], model, training=False)
+        total_rewards.extend(rewards.sum(axis=1))
+    return total_rewards
+
+
+def train(
+    env,
+    model,
+    optimizer,
+    num_step=500,
+    num_envs=1,
+    eval_episodes=100,
+    reward_to_go=False,
+    advantage="returns",
+    gamma=1.0,
+    lam=0.95,
+    value_lr=1e-2,
+    target_reward=None,
+    make_env=None,
+):
+    """Train with REINFORCE on batches of num_envs episodes.
+
+    Parameters
+    ----------
+    env: gym.core.Env
+      The environment. num_envs - 1 more are created with make_env.
+    model: (your action model, which can be anything)
+    optimizer: keras.optimizers.Optimizer
+    num_step: int, optional
+      Number of gradient steps.
+    num_envs: int, optional
+      Episodes per gradient step.
+    eval_episodes: int, optional
+      Greedy episodes of every evaluation.
+    reward_to_go: bool, optional
+      See compute_returns. Always true unless advantage is "returns".
+    advantage: str, optional
+      "returns", "baseline" or "gae", see reinforce.
+    gamma: float, optional
+      Discount factor.
+    lam: float, optional
+      GAE lambda.
+    value_lr: float, optional
+      Learning rate of the value network, if there is one.
+    target_reward: float, optional
+      Stop once an evaluation averages at least this reward.
+    make_env: callable, optional
+      Creates one more environment like env. Defaults to
+      gym.make(env.spec.id), which loses anything applied after
+      gym.make, e.g. imitation.wrap_cartpole, so pass a factory that
+      wraps its environment the same way.
+
+    Returns
+    -------
+    dict
+      Evaluation rewards by epoch, the number of training episodes and
+      environment steps at each evaluation, and training throughput in
+      episodes/sec and updates/sec.
+    """
+    if make_env is None:
+        make_env = functools.partial(gym.make, env.spec.id)
+    envs = [env] + [make_env() for _ in range(num_envs - 1)]
+    update_fn = make_update_fn(model, optimizer)
+    value_fns = None
+    if advantage != "returns":
+        value_model = make_value_model(env.observation_space.shape)
+        value_fns = make_value_fns(
+            value_model, tf.keras.optimizers.Adam(learning_rate=value_lr)
+        )
 
-    obs, _ = env.reset()
-    done = False
-    truncated = False
-    eps_len = 0
-    eps_reward = 0
-
-    do_update = False
-    while not do_update:
-        batch_observation.append(obs)
-
-        _, action = choose_action(model, obs)
-        batch_action.append(action)
-        eps_len += 1
-
-        # Take action
-        obs, reward, done, truncated, _ = env.step(action)
-        eps_reward += reward
-
-        # If end of episode, append reward
-        if done or truncated:
-            batch_reward += [eps_reward] * eps_len
-
-            # Reset
-            obs, _ = env.reset()
-            done = False
-            truncated = False
-            eps_len = 0
-            eps_reward = 0
-
-            do_update = True
-            # If enough samples
-            # OpenAI's implementation uses batching but the vanila REINFORCE does not
-            # if len(batch_observation) >= batch_size:
-            #     do_update = True
-
-    # Update model
-    batch_observation = np.stack(batch_observation)
-    batch_action = np.array(batch_action)
-    batch_reward = np.array(batch_reward)
-    with tf.GradientTape() as tape:
-        # loss = loss.call(model, batch_observation, batch_action, batch_reward)
-        action_probs = model(batch_observation, training=True)
-        action_masks = tf.one_hot(batch_action, action_probs.shape[1])
-        log_probs = tf.reduce_sum(action_masks * tf.math.log(action_probs), axis=1)
-        loss = -tf.reduce_sum(log_probs * batch_reward)
-    gradients = tape.gradient(loss, model.trainable_variables)
-    # optimizer.apply_gradients(zip(gradients, model.trainable_variables))
-    apply_gradients(gradients)
-    return
-
-
-def train(env, model, optimizer, num_step=500):
     mean_rewards = []
     min_rewards = []
     max_rewards = []
     eval_epochs = []
+    eval_num_episodes = []
+    eval_env_steps = []
+    env_steps = 0
+    train_time = 0.0
+    num_updates = 0
     for i in range(num_step):
-        reinforce(env, model, optimizer)
-
-        if i % (num_step // 20) == 0:
-            eval_rewards = []
-            for _ in range(100):
-                eval_rewards.append(get_total_reward(env, model, training=False))
-            print(f"Epoch: {i}, Mean Reward: {np.mean(eval_rewards)}")
+        start_time = time.time()
+        _, lengths = reinforce(
+            envs,
+            model,
+            optimizer,
+            update_fn=update_fn,
+            gamma=gamma,
+            reward_to_go=reward_to_go,
+            advantage=advantage,
+            value_fns=value_fns,
+            lam=lam,
+        )
+        train_time += time.time() - start_time
+        env_steps += int(lengths.sum())
+        num_updates += 1
+
+        if i % max(num_step // 20, 1) == 0 or i == num_step - 1:
+            eval_rewards = evaluate(envs, model, eval_episodes)
+            num_episodes = num_updates * num_envs
+            print(
+                f"Epoch: {i}, Episodes: {num_episodes}, Env steps: {env_steps},"
+                + f" Mean Reward: {np.mean(eval_rewards)},"
+                + f" Episodes/sec: {num_episodes / train_time:.1f},"
+                + f" Updates/sec: {num_updates / train_time:.1f}"
+            )
             # test_cloned_policy(env, model, num_episodes=10, render=False)
             mean_rewards.append(np.mean(eval_rewards))
             min_rewards.append(np.min(eval_rewards))
             max_rewards.append(np.max(eval_rewards))
             eval_epochs.append(i)
+            eval_num_episodes.append(num_episodes)
+            eval_env_steps.append(env_steps)
+            if target_reward is not None and np.mean(eval_rewards) >= target_reward:
+                print(f"Reached {target_reward} after {env_steps} env steps")
+                break
     return {
         "mean_rewards": mean_rewards,
         "min_rewards": min_rewards,
         "max_rewards": max_rewards,
         "eval_epochs": eval_epochs,
+        "eval_episodes": eval_num_episodes,
+        "eval_env_steps": eval_env_steps,
+        "episodes_per_sec": num_updates * num_envs / train_time,
+        "updates_per_sec": num_updates / train_time,
     }
@@ -0,0 +1,15 @@
+import pytest
+
+
+@pytest.fixture
+def policy_model():
+    """Return a small softmax policy over the two CartPole actions."""
+    tf = pytest.importorskip("tensorflow")
+    tf.keras.utils.set_random_seed(0)
+    return tf.keras.Sequential(
+        [
+            tf.keras.Input(shape=(4,)),
+            tf.keras.layers.Dense(16, activation="relu"),
+            tf.keras.layers.Dense(2, activation="softmax"),
+        ]
+    )
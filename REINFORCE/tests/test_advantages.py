@@ -0,0 +1,60 @@
+"""Vectorized returns and GAE match their per-step definitions."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from deeprl_hw3.reinforce import compute_gae, compute_returns
+
+LENGTHS = np.array([5, 3, 7])
+
+
+@pytest.fixture
+def episodes():
+    """Return padded rewards and values of episodes of LENGTHS steps."""
+    rng = np.random.default_rng(0)
+    rewards = np.zeros((len(LENGTHS), LENGTHS.max()), dtype=np.float32)
+    values = np.zeros_like(rewards)
+    for k, length in enumerate(LENGTHS):
+        rewards[k, :length] = rng.random(length)
+        values[k, :length] = rng.random(length)
+    return rewards, values
+
+
+@pytest.mark.parametrize("reward_to_go", [True, False])
+def test_returns_match_the_loop(episodes, reward_to_go):
+    rewards, _ = episodes
+    returns = compute_returns(rewards, 0.99, reward_to_go)
+    for k, length in enumerate(LENGTHS):
+        expected = np.zeros(length)
+        future = 0.0
+        for t in reversed(range(length)):
+            future = rewards[k, t] + 0.99 * future
+            expected[t] = future
+        if not reward_to_go:
+            expected[:] = expected[0]
+        np.testing.assert_allclose(returns[k, :length], expected, atol=1e-5)
+
+
+def test_gae_matches_the_loop(episodes):
+    rewards, values = episodes
+    advantages = compute_gae(rewards, values, 0.99, 0.9)
+    for k, length in enumerate(LENGTHS):
+        expected = np.zeros(length)
+        advantage = 0.0
+        for t in reversed(range(length)):
+            next_value = values[k, t + 1] if t + 1 < length else 0.0
+            delta = rewards[k, t] + 0.99 * next_value - values[k, t]
+            advantage = delta + 0.99 * 0.9 * advantage
+            expected[t] = advantage
+        np.testing.assert_allclose(advantages[k, :length], expected, atol=1e-5)
+
+
+def test_gae_with_lambda_one_is_returns_minus_values(episodes):
+    rewards, values = episodes
+    np.testing.assert_allclose(
+        compute_gae(rewards, values, 0.99, 1.0),
+        compute_returns(rewards, 0.99) - values,
+        atol=1e-5,
+    )
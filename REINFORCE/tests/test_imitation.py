@@ -0,0 +1,56 @@
+"""Expert episodes streamed into dataset shards and read back."""
+
+import os
+
+import numpy as np
+import pytest
+
+gym = pytest.importorskip("gym")
+tf = pytest.importorskip("tensorflow")
+
+from deeprl_hw3.imitation import (
+    collect_expert_shards,
+    iter_expert_episodes,
+    load_expert_dataset,
+    wrap_cartpole,
+    write_expert_shards,
+)
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "CartPole-v0_config.json")
+
+
+def test_iter_expert_episodes_resets_without_a_seed(policy_model):
+    # The harder reset of wrap_cartpole takes no arguments
+    env = wrap_cartpole(gym.make("CartPole-v0"))
+    episodes = list(iter_expert_episodes(policy_model, env, num_episodes=2))
+    assert len(episodes) == 2
+    for states, actions in episodes:
+        assert abs(states[0, 0]) == 1.5 and len(states) == len(actions)
+
+
+def test_shards_round_trip(policy_model, tmp_path):
+    env = gym.make("CartPole-v0")
+    episodes = list(iter_expert_episodes(policy_model, env, num_episodes=3, seed=0))
+    num_written = write_expert_shards(
+        policy_model, env, str(tmp_path), num_episodes=3, shard_size=64, seed=0
+    )
+    assert num_written == sum(len(states) for states, _ in episodes)
+
+    batches = list(load_expert_dataset(str(tmp_path), shuffle=False, one_hot=False))
+    states = np.concatenate([states.numpy() for states, _ in batches])
+    actions = np.concatenate([actions.numpy() for _, actions in batches])
+    np.testing.assert_array_equal(states, np.concatenate([s for s, _ in episodes]))
+    np.testing.assert_array_equal(actions, np.concatenate([a for _, a in episodes]))
+
+
+def test_collect_expert_shards_adds_to_the_dataset(tmp_path):
+    path = str(tmp_path)
+    first = collect_expert_shards(
+        CONFIG_PATH, None, "CartPole-v0", path, num_episodes=2, num_workers=2
+    )
+    second = collect_expert_shards(
+        CONFIG_PATH, None, "CartPole-v0", path, num_episodes=2, num_workers=2
+    )
+
+    batches = load_expert_dataset(path, shuffle=False, one_hot=False)
+    assert sum(len(actions) for _, actions in batches) == first + second
@@ -0,0 +1,31 @@
+"""The compiled policy step acts like the Keras model it wraps."""
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from deeprl_hw3.imitation import get_policy_step
+
+
+def test_greedy_step_takes_the_most_probable_action(policy_model):
+    observations = np.random.default_rng(0).standard_normal((32, 4))
+    probs, actions = get_policy_step(policy_model)(observations)
+
+    expected = policy_model.predict_on_batch(observations.astype(np.float32))
+    np.testing.assert_allclose(probs, expected, rtol=1e-5)
+    np.testing.assert_array_equal(actions, expected.argmax(axis=1))
+
+
+def test_sampled_actions_follow_the_probabilities(policy_model):
+    observations = np.zeros((4000, 4))
+    probs, actions = get_policy_step(policy_model)(observations, sample=True)
+    assert abs(actions.mean() - probs[0, 1]) < 0.05
+
+
+def test_policy_step_is_compiled_once_per_model(policy_model):
+    step = get_policy_step(policy_model)
+    step(np.zeros((1, 4)))
+    step(np.zeros((7, 4)), sample=True)
+    assert get_policy_step(policy_model) is step
+    assert step.step.experimental_get_tracing_count() == 1
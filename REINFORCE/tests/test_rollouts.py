@@ -0,0 +1,40 @@
+"""Batched REINFORCE rollouts over several CartPole environments."""
+
+import numpy as np
+import pytest
+
+gym = pytest.importorskip("gym")
+tf = pytest.importorskip("tensorflow")
+
+from deeprl_hw3.imitation import wrap_cartpole
+from deeprl_hw3.reinforce import collect_episodes, train
+
+
+def test_collect_episodes_pads_after_each_episode_end(policy_model):
+    envs = [gym.make("CartPole-v0") for _ in range(3)]
+    observations, actions, rewards, lengths = collect_episodes(envs, policy_model)
+
+    assert observations.shape == (3, 200, 4) and actions.shape == (3, 200)
+    steps = np.arange(200) < lengths[:, np.newaxis]
+    # CartPole pays 1 per step until the episode ends
+    np.testing.assert_array_equal(rewards, steps.astype(np.float32))
+    assert not observations[~steps].any()
+
+
+def test_train_creates_the_other_envs_with_make_env(policy_model):
+    made = []
+
+    def make_env():
+        made.append(wrap_cartpole(gym.make("CartPole-v0")))
+        return made[-1]
+
+    train(
+        make_env(),
+        policy_model,
+        tf.keras.optimizers.Adam(learning_rate=1e-3),
+        num_step=1,
+        num_envs=3,
+        eval_episodes=3,
+        make_env=make_env,
+    )
+    assert len(made) == 3
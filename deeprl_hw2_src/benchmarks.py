@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+"""Microbenchmarks for the DQN host-side hot paths."""
+import argparse
+import time
+
+import numpy as np
+
+from deeprl_hw2.core import ReplayMemory
+
+
+def fill_memory(memory, num_samples, episode_length=200):
+    """Fill the replay memory with random frames and periodic episode ends."""
+    for i in range(num_samples):
+        frame = np.random.randint(2, 256, size=memory.state_shape, dtype=np.uint8)
+        done = (i + 1) % episode_length == 0
+        memory.append(frame, np.random.randint(4), np.random.randn(), done)
+    return memory
+
+
+def timeit(fn, num_iters):
+    """Return the mean wall-clock seconds per call of fn."""
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        fn()
+    return (time.perf_counter() - start) / num_iters
+
+
+def bench_sample(args):
+    """Compare the batched sampler against the per-sample loop."""
+    memory = fill_memory(
+        ReplayMemory(args.size, args.window, state_shape=(84, 84)), args.size
+    )
+
+    def loop_sample():
+        indices = np.random.randint(0, memory.size - 1, size=args.batch_size)
+        states = np.array(
+            [memory._get_stacked_frames(idx) for idx in indices], dtype=np.uint8
+        )
+        next_states = np.array(
+            [
+                memory._get_stacked_frames((idx + 1) % memory.max_size)
+                for idx in indices
+            ],
+            dtype=np.uint8,
+        )
+        return states, next_states
+
+    def batched_sample():
+        return memory.sample(args.batch_size)
+
+    # Sanity check: both paths agree on the same indices
+    indices = np.random.randint(0, memory.size - 1, size=args.batch_size)
+    expected = np.array([memory._get_stacked_frames(idx) for idx in indices])
+    assert np.array_equal(expected, memory._get_stacked_frames_batch(indices))
+
+    loop_time = timeit(loop_sample, args.iters)
+    batched_time = timeit(batched_sample, args.iters)
+    print(f"Per-sample loop: {loop_time * 1e6:.1f} us/batch")
+    print(f"Batched gather:  {batched_time * 1e6:.1f} us/batch")
+    print(f"Speedup: {loop_time / batched_time:.2f}x")
+
+
+def bench_preprocess(args):
+    """Frames/sec of the PIL pipeline, the array pipeline and its batched form."""
+    from PIL import Image
+
+    from deeprl_hw2.preprocessors import AtariPreprocessor, VectorAtariPreprocessor
+
+    frames = np.random.randint(
+        0, 256, size=(args.num_envs, 210, 160, 3), dtype=np.uint8
+    )
+
+    # The original per-frame PIL round trip with a list history
+    past_frames = [np.zeros((84, 84), dtype=np.uint8) for _ in range(args.window)]
+
+    def pil_process():
+        img = Image.fromarray(frames[0]).resize((84, 84)).convert("L")
+        past_frames.append(np.array(img, dtype=np.uint8))
+        past_frames.pop(0)
+        return np.stack(past_frames, axis=0)
+
+    preprocessor = AtariPreprocessor((84, 84), window=args.window)
+    vector_preprocessor = VectorAtariPreprocessor(
+        (84, 84), window=args.window, num_envs=args.num_envs
+    )
+
+    pil_time = timeit(pil_process, args.iters)
+    array_time = timeit(
+        lambda: preprocessor.process_state_for_memory(frames[0]), args.iters
+    )
+    batch_time = timeit(
+        lambda: vector_preprocessor.process_state_for_memory(frames), args.iters
+    )
+    print(f"PIL per frame:   {1 / pil_time:.0f} frames/sec")
+    print(f"Array per frame: {1 / array_time:.0f} frames/sec")
+    print(f"Array batch:     {args.num_envs / batch_time:.0f} frames/sec")
+
+
+def make_agent(model_type, memory, batch_size, **kwargs):
+    """Build a compiled DQNAgent around a model from dqn_atari.create_model."""
+    import torch
+
+    from deeprl_hw2.dqn import DQNAgent
+    from deeprl_hw2.objectives import mean_huber_loss
+    from deeprl_hw2.policy import GreedyEpsilonPolicy
+    from deeprl_hw2.preprocessors import AtariPreprocessor
+    from dqn_atari import create_model
+
+    agent = DQNAgent(
+        q_network=create_model(memory.window_length, 4, model_type=model_type),
+        policy=GreedyEpsilonPolicy(0.1),
+        preprocessor=AtariPreprocessor(
+            memory.state_shape, window=memory.window_length
+        ),
+        memory=memory,
+        gamma=0.99,
+        target_update_freq=int(1e4),
+        train_freq=1,
+        num_burn_in=0,
+        batch_size=batch_size,
+        **kwargs,
+    )
+    agent.compile(optimizer=torch.optim.Adam, loss_func=mean_huber_loss, lr=1e-4)
+    return agent
+
+
+def bench_validation(args):
+    """Training steps/sec with the debug-mode checks on and off."""
+    from deeprl_hw2 import utils
+
+    memory = fill_memory(
+        ReplayMemory(args.size, args.window, state_shape=(84, 84)), args.size
+    )
+    for model_type in ["cnn", "duel"]:
+        agent = make_agent(model_type, memory, args.batch_size)
+        for debug in [True, False]:
+            utils.set_debug(debug)
+            step_time = timeit(agent.train_step, args.iters)
+            mode = "debug" if debug else "production"
+            print(f"{model_type} {mode}: {1 / step_time:.1f} steps/sec")
+
+
+def bench_storage(args):
+    """Storage footprint and sampling throughput of the replay memories.
+
+    Runs at the 1e6 transitions of dqn_atari by default, where the
+    frames alone take 6.6 GiB per memory; pass a smaller --size on
+    machines without that much free memory.
+    """
+    from deeprl_hw2.core import EpisodeReplayMemory
+
+    frame_bytes = 84 * 84
+    stacked_bytes = args.size * 2 * args.window * frame_bytes
+    print(f"Stacked (s, s') storage: {stacked_bytes / 2**30:.2f} GiB")
+
+    for memory_cls in [ReplayMemory, EpisodeReplayMemory]:
+        memory = fill_memory(
+            memory_cls(args.size, args.window, state_shape=(84, 84)), args.size
+        )
+        storage_bytes = sum(
+            array.nbytes for array in vars(memory).values() if hasattr(array, "nbytes")
+        )
+        sample_time = timeit(lambda: memory.sample(args.batch_size), args.iters)
+        print(
+            f"{memory_cls.__name__}: {storage_bytes / 2**30:.2f} GiB,"
+            + f" {1 / sample_time:.0f} batches/sec"
+        )
+        del memory
+
+
+def bench_target(args):
+    """Target network update cost and training steps/sec of DQNCNN."""
+    import torch
+
+    from deeprl_hw2.utils import (
+        get_hard_target_model_updates,
+        get_soft_target_model_updates,
+    )
+
+    memory = fill_memory(
+        ReplayMemory(args.size, args.window, state_shape=(84, 84)), args.size
+    )
+    agent = make_agent("cnn", memory, args.batch_size, ddqn=True)
+
+    # The original state_dict copy followed by an equality check
+    def legacy_hard_update():
+        agent.Q_target.load_state_dict(agent.Q.state_dict())
+        for target_param, param in zip(
+            agent.Q_target.parameters(), agent.Q.parameters()
+        ):
+            assert torch.equal(target_param.data, param.data)
+
+    # The original soft update with two temporaries per parameter
+    def legacy_soft_update():
+        for target_param, param in zip(
+            agent.Q_target.parameters(), agent.Q.parameters()
+        ):
+            target_param.data.copy_(
+                0.005 * param.data + (1.0 - 0.005) * target_param.data
+            )
+
+    updates = {
+        "Legacy hard update": legacy_hard_update,
+        "Foreach hard update": lambda: get_hard_target_model_updates(
+            agent.Q_target, agent.Q
+        ),
+        "Legacy soft update": legacy_soft_update,
+        "Foreach soft update": lambda: get_soft_target_model_updates(
+            agent.Q_target, agent.Q, 0.005
+        ),
+    }
+    for name, update in updates.items():
+        print(f"{name}: {timeit(update, args.iters) * 1e6:.1f} us")
+
+    # The fused DDQN forward should cost about as much as plain DQN
+    for ddqn in [False, True]:
+        agent.ddqn = ddqn
+        step_time = timeit(agent.train_step, args.iters)
+        print(f"{'DDQN' if ddqn else 'DQN'} train_step: {1 / step_time:.1f} steps/sec")
+
+
+def bench_inference(args):
+    """Per-step action selection latency of DQNCNN for each backend."""
+    import torch
+
+    from deeprl_hw2.inference import BACKENDS, InferenceEngine
+    from deeprl_hw2.policy import GreedyEpsilonPolicy
+    from dqn_atari import create_model
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = create_model(args.window, 4, model_type="cnn")().to(device)
+    policy = GreedyEpsilonPolicy(0.1)
+
+    for batch_size in [1, args.num_envs]:
+        states = np.random.randint(
+            1, 256, size=(batch_size, args.window, 84, 84), dtype=np.uint8
+        )
+
+        # The original path: fresh tensor, eager forward, NumPy policy
+        def legacy_select():
+            state_ = torch.tensor(states / 255.0, dtype=torch.float32).to(device)
+            with torch.no_grad():
+                q_values = model(state_).detach().squeeze(0).cpu().numpy()
+            return [policy.select_action(q) for q in q_values.reshape(batch_size, -1)]
+
+        legacy_time = timeit(legacy_select, args.iters)
+        print(f"Batch {batch_size} legacy: {legacy_time * 1e6:.1f} us/step")
+        for backend in BACKENDS:
+            engine = InferenceEngine(
+                model, (args.window, 84, 84), device, backend, batch_size
+            )
+            engine_time = timeit(lambda: engine.select_actions(states, 0.1), args.iters)
+            print(f"Batch {batch_size} {backend}: {engine_time * 1e6:.1f} us/step")
+
+
+def bench_env(args):
+    """Frames/sec of the Atari wrappers, single and batched.
+
+    Frames are the observations handed to the agent, one per action.
+    """
+    import ale_py
+    import gymnasium as gym
+
+    from deeprl_hw2.utils import make_atari_env, make_vector_atari_env
+
+    gym.register_envs(ale_py)
+    env_name = "BreakoutNoFrameskip-v4"
+
+    # The original wrapper step: an extra env.step, then max over
+    # full-resolution RGB frames kept in a list
+    legacy_env = gym.make(env_name)
+    frame_buffer = [None, None]
+
+    def legacy_step():
+        legacy_env.step(legacy_env.action_space.sample())
+        for idx in range(4):
+            next_state, _, done, truncated, _ = legacy_env.step(
+                legacy_env.action_space.sample()
+            )
+            frame_buffer[idx - 2] = next_state
+            if done or truncated:
+                legacy_env.reset()
+                break
+        return np.maximum(frame_buffer[0], frame_buffer[1])
+
+    legacy_env.reset(seed=0)
+    print(f"Legacy wrapper: {1 / timeit(legacy_step, args.iters):.0f} frames/sec")
+
+    for obs_type in ["rgb", "grayscale"]:
+        env = make_atari_env(env_name, obs_type=obs_type)
+        env.reset(seed=0)
+
+        def step():
+            _, _, done, truncated, _ = env.step(env.action_space.sample())
+            if done or truncated:
+                env.reset()
+
+        print(f"Wrapper {obs_type}: {1 / timeit(step, args.iters):.0f} frames/sec")
+
+        for backend in ["gym", "ale"]:
+            envs = make_vector_atari_env(
+                env_name, args.num_envs, obs_type=obs_type, backend=backend
+            )
+            envs.reset(seed=0)
+            step_time = timeit(
+                lambda: envs.step(envs.action_space.sample()), args.iters // 4
+            )
+            envs.close()
+            print(
+                f"Vector {backend} {obs_type} x{args.num_envs}:"
+                + f" {args.num_envs / step_time:.0f} frames/sec"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DQN microbenchmarks")
+    parser.add_argument(
+        "benchmark",
+        choices=[
+            "sample",
+            "preprocess",
+            "validation",
+            "storage",
+            "target",
+            "inference",
+            "env",
+        ],
+        help="What to benchmark",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        help="Memory size, 1e6 for storage and 1e5 for the others by default",
+    )
+    parser.add_argument("--window", default=4, type=int, help="Frames per state")
+    parser.add_argument("--batch_size", default=32, type=int, help="Batch size")
+    parser.add_argument("--iters", default=1000, type=int, help="Timed iterations")
+    parser.add_argument("--num_envs", default=8, type=int, help="Frames per batch")
+    args = parser.parse_args()
+    if args.size is None:
+        args.size = int(1e6) if args.benchmark == "storage" else int(1e5)
+
+    if args.benchmark == "sample":
+        bench_sample(args)
+    elif args.benchmark == "preprocess":
+        bench_preprocess(args)
+    elif args.benchmark == "validation":
+        bench_validation(args)
+    elif args.benchmark == "storage":
+        bench_storage(args)
+    elif args.benchmark == "target":
+        bench_target(args)
+    elif args.benchmark == "inference":
+        bench_inference(args)
+    elif args.benchmark == "env":
+        bench_env(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
+from . import apex
 from . import core
 from . import dqn
+from . import inference
+from . import metrics
 from . import objectives
 from . import policy
+from . import prefetcher
 from . import preprocessors
 from . import utils
@@ -0,0 +1,271 @@
+"""Ape-X style asynchronous actors and learner on a single machine.
+
+Based on Horgan et al., "Distributed Prioritized Experience Replay",
+ICLR 2018, minus the prioritization. Actor processes step their own
+Atari environment with a local copy of the Q-network and append to
+their shard of a shared-memory replay buffer, while the learner in the
+main process trains continuously and periodically publishes its
+weights.
+
+Processes are forked, so this only runs on Linux.
+"""
+
+import copy
+import multiprocessing as mp
+import time
+
+import gymnasium as gym
+import numpy as np
+import torch
+
+from deeprl_hw2.core import SharedReplayMemory, VectorReplayMemory
+from deeprl_hw2.policy import GreedyEpsilonPolicy
+from deeprl_hw2.utils import (
+    get_hard_target_model_updates,
+    get_soft_target_model_updates,
+    make_atari_env,
+)
+
+
+def actor_epsilons(num_actors, base=0.4, alpha=7.0):
+    """Return the fixed exploration rate of every actor.
+
+    Actor i uses base ** (1 + alpha * i / (num_actors - 1)), so the
+    actors cover a range of exploration levels instead of sharing one
+    decaying schedule.
+    """
+    if num_actors == 1:
+        return np.array([base])
+    return base ** (1 + alpha * np.arange(num_actors) / (num_actors - 1))
+
+
+def run_actor(
+    env_name,
+    obs_type,
+    memory,
+    preprocessor,
+    q_network,
+    shared_Q,
+    weights_version,
+    epsilon,
+    env_steps,
+    stop_event,
+    seed,
+):
+    """Act in one environment until stop_event is set.
+
+    Parameters
+    ----------
+    env_name: str
+      Name of the gymnasium Atari environment.
+    obs_type: str
+      Observation type of the environment, "rgb" or "grayscale".
+    memory: deeprl_hw2.core.SharedReplayMemory
+      Shard of the replay memory owned by this actor.
+    preprocessor: deeprl_hw2.preprocessors.AtariPreprocessor
+      This actor's copy of the preprocessor.
+    q_network: type
+      Q-network class, used to build the local copy.
+    shared_Q: torch.nn.Module
+      Q-network in shared memory holding the latest learner weights.
+    weights_version: multiprocessing.Value
+      Incremented by the learner every time shared_Q is updated.
+    epsilon: float
+      Exploration rate of this actor.
+    env_steps: multiprocessing.Value
+      Environment steps taken by all actors.
+    stop_event: multiprocessing.Event
+      Set by the learner when training is done.
+    seed: int
+      Seed of the environment and the exploration noise.
+    """
+    import ale_py
+
+    torch.set_num_threads(1)
+    np.random.seed(seed)
+    gym.register_envs(ale_py)
+    env = make_atari_env(env_name, obs_type)
+
+    Q = q_network()
+    Q.eval()
+    local_version = -1
+    policy = GreedyEpsilonPolicy(epsilon)
+
+    state = env.reset(seed=seed)
+    preprocessor.reset()
+    processed_state = preprocessor.process_state_for_memory(state)
+    while not stop_event.is_set():
+        # Pull the latest weights
+        if weights_version.value != local_version:
+            local_version = weights_version.value
+            Q.load_state_dict(shared_Q.state_dict())
+
+        state_ = preprocessor.process_state_for_network(processed_state)
+        with torch.no_grad():
+            q_values = Q(torch.from_numpy(state_[np.newaxis, ...])).squeeze()
+        action = policy.select_action(q_values.numpy())
+
+        next_state, reward, done, _, _ = env.step(action)
+        memory.append(
+            processed_state[-1], action, preprocessor.process_reward(reward), done
+        )
+        with env_steps.get_lock():
+            env_steps.value += 1
+
+        if done:
+            preprocessor.reset()
+            next_state = env.reset()
+        processed_state = preprocessor.process_state_for_memory(next_state)
+
+
+def make_apex_memory(num_actors, max_size, window_length, state_shape, **kwargs):
+    """Create a replay memory with one shared-memory shard per actor."""
+    return VectorReplayMemory(
+        num_actors,
+        max_size,
+        window_length,
+        state_shape,
+        memory_cls=SharedReplayMemory,
+        **kwargs,
+    )
+
+
+def fit_apex(
+    agent,
+    env_name,
+    num_actors,
+    num_updates,
+    weight_sync_freq=100,
+    log_freq=1000,
+    obs_type="rgb",
+):
+    """Train a compiled DQNAgent with asynchronous actor processes.
+
+    The agent's memory must come from make_apex_memory with one shard
+    per actor. The learner runs train_step back to back once the memory
+    holds num_burn_in samples, updates the target network every
+    target_update_freq / train_freq updates (the same ratio as fit),
+    or softly after every update if target_update_freq is below 1,
+    and publishes its weights to the actors every weight_sync_freq
+    updates.
+
+    Parameters
+    ----------
+    agent: deeprl_hw2.dqn.DQNAgent
+      Compiled agent acting as the learner.
+    env_name: str
+      Name of the gymnasium Atari environment.
+    num_actors: int
+      Number of actor processes.
+    num_updates: int
+      Number of learner updates to perform.
+    weight_sync_freq: int, optional
+      How many updates between weight broadcasts.
+    log_freq: int, optional
+      How many updates between log lines.
+    obs_type: str, optional
+      Observation type of the actors' environments, "rgb" or "grayscale".
+
+    Returns
+    -------
+    dict
+      The agent's training log.
+    """
+    assert isinstance(agent.memory, VectorReplayMemory)
+    assert len(agent.memory.shards) == num_actors
+    assert all(isinstance(s, SharedReplayMemory) for s in agent.memory.shards)
+
+    ctx = mp.get_context("fork")
+
+    # Weights the actors copy from, kept on the CPU
+    shared_Q = agent.q_network()
+    shared_Q.load_state_dict(agent.Q.state_dict())
+    shared_Q.share_memory()
+
+    weights_version = ctx.Value("l", 0)
+    env_steps = ctx.Value("l", 0)
+    stop_event = ctx.Event()
+
+    actors = [
+        ctx.Process(
+            target=run_actor,
+            args=(
+                env_name,
+                obs_type,
+                agent.memory.shards[i],
+                copy.deepcopy(agent.preprocessor),
+                agent.q_network,
+                shared_Q,
+                weights_version,
+                epsilon,
+                env_steps,
+                stop_event,
+                i,
+            ),
+            daemon=True,
+        )
+        for i, epsilon in enumerate(actor_epsilons(num_actors))
+    ]
+    for actor in actors:
+        actor.start()
+
+    target_update_period = max(agent.target_update_freq // agent.train_freq, 1)
+    start_time = time.time()
+    start_updates = agent.training_log["n_updates"]
+    try:
+        while agent.training_log["n_updates"] - start_updates < num_updates:
+            if len(agent.memory) < agent.num_burn_in:
+                time.sleep(0.1)
+                continue
+
+            loss, _ = agent.train_step()
+            agent.metrics.add("Loss", loss)
+            agent.training_log["iter"] = env_steps.value
+            n_updates = agent.training_log["n_updates"]
+
+            if agent.soft_target_update:
+                agent.Q_target = get_soft_target_model_updates(
+                    agent.Q_target, agent.Q, agent.target_update_freq
+                )
+            elif n_updates % target_update_period == 0:
+                agent.Q_target = get_hard_target_model_updates(agent.Q_target, agent.Q)
+
+            if n_updates % weight_sync_freq == 0:
+                with torch.no_grad():
+                    for shared_param, param in zip(
+                        shared_Q.parameters(), agent.Q.parameters()
+                    ):
+                        shared_param.copy_(param)
+                with weights_version.get_lock():
+                    weights_version.value += 1
+
+            if n_updates % log_freq == 0:
+                elapsed = time.time() - start_time
+                agent.metrics.flush()
+                loss = agent.metrics.collect()["Loss"]
+                log = {
+                    "Iteration": agent.training_log["iter"],
+                    "Updates": n_updates,
+                    "Loss": loss,
+                    "Env steps/sec": env_steps.value / elapsed,
+                    "Updates/sec": (n_updates - start_updates) / elapsed,
+                }
+                print(
+                    f"Updates: {n_updates}"
+                    + f" Env steps: {env_steps.value}"
+                    + f" Loss: {loss:.4f}"
+                    + f" Env steps/sec: {log['Env steps/sec']:.1f}"
+                    + f" Updates/sec: {log['Updates/sec']:.1f}"
+                    + f" Current memory size: {len(agent.memory)}"
+                )
+                agent.log(log)
+    finally:
+        stop_event.set()
+        for actor in actors:
+            actor.join(timeout=10)
+            if actor.is_alive():
+                actor.terminate()
+        agent.close_prefetcher()
+        agent.close_logs()
+
+    return agent.training_log
@@ -1,8 +1,14 @@
 """Core classes."""
 
+import json
+import os
+
 import numpy as np
 import matplotlib.pyplot as plt
 import time
+import torch
+
+from deeprl_hw2 import utils
 
 
 class Sample:
@@ -210,7 +216,7 @@ class ReplayMemory:
       Reset the memory. Deletes all references to the samples.
     """
 
-    def __init__(self, max_size, window_length, state_shape):
+    def __init__(self, max_size, window_length, state_shape, n_step=1, gamma=0.99):
         """Setup memory.
 
         You should specify the maximum size o the memory. Once the
@@ -220,32 +226,55 @@ class ReplayMemory:
 
         We recommend using a list as a ring buffer. Just track the
         index where the next sample should be inserted in the list.
+
+        With n_step > 1, sampled rewards are discounted n-step returns,
+        next states are n steps ahead and the agent should bootstrap
+        with gamma ** n_step. Returns are truncated at episode ends.
         """
         self.max_size = max_size
         self.window_length = window_length
         self.state_shape = state_shape
+        self.n_step = n_step
+        self.gamma = gamma
 
         # Implement a ring buffer but differentiate each elements
         # easier to retrieve without for loops
         # store state and next_state together since we know their order
         # Store individual frames
-        self.frames = np.zeros((max_size, *state_shape), dtype=np.uint8)
-        self.actions = np.zeros((max_size,), dtype=np.int32)
-        self.rewards = np.zeros((max_size,), dtype=np.float32)
-        self.dones = np.zeros((max_size,), dtype=np.bool_)
+        self._allocate_storage()
         self.position = 0
         self.size = 0
+        self.total_steps = 0  # appends since the memory was created
+
+        # total_steps at the last checkpoint, None if never saved
+        self.saved_steps = None
+
+        # Offsets of every frame in a stack relative to its newest frame,
+        # e.g. [-3, -2, -1, 0] for a window of 4
+        self.window_offsets = np.arange(1 - window_length, 1)
+
+        # Offsets and discounts of the rewards summed into a return
+        self.step_offsets = np.arange(n_step)
+        self.discounts = gamma ** np.arange(n_step, dtype=np.float32)
+
+    def _allocate_storage(self):
+        """Allocate the ring buffer arrays."""
+        self.frames = np.zeros((self.max_size, *self.state_shape), dtype=np.uint8)
+        self.actions = np.zeros((self.max_size,), dtype=np.int32)
+        self.rewards = np.zeros((self.max_size,), dtype=np.float32)
+        self.dones = np.zeros((self.max_size,), dtype=np.bool_)
 
     def append(self, state, action, reward, done):
         """
         Add a sample to the replay memory.
         """
 
-        # Check not normalized
-        assert np.max(state) > 1
-        assert state.shape == self.state_shape
-        assert state.dtype == np.uint8
-        assert state.ndim == 2  # must not be stacked
+        if utils.DEBUG:
+            # Check not normalized
+            assert np.max(state) > 1
+            assert state.shape == self.state_shape
+            assert state.dtype == np.uint8
+            assert state.ndim == 2  # must not be stacked
 
         # Insert and update the pointer
         self.frames[self.position] = state
@@ -253,7 +282,8 @@ class ReplayMemory:
         self.rewards[self.position] = reward
         self.dones[self.position] = done
         self.position = (self.position + 1) % self.max_size
-        self.size = max(self.size, self.position)
+        self.size = min(self.size + 1, self.max_size)
+        self.total_steps += 1
 
     # Not planning to use this
     def end_episode(self, final_state, is_terminal):
@@ -262,7 +292,7 @@ class ReplayMemory:
         """
         if self.size == 0:
             return
-        last_idx = (self.position - 1) % self.size
+        last_idx = (self.position - 1) % self.max_size
         self.dones[last_idx] = is_terminal
 
     def _get_stacked_frames(self, idx):
@@ -273,7 +303,7 @@ class ReplayMemory:
         end_idx = idx + 1  # The index is inclusive for the latest frame
         start_idx = end_idx - self.window_length  # Window of frames
 
-        indices = np.arange(start_idx, end_idx) % self.size
+        indices = np.arange(start_idx, end_idx) % self.max_size
         candidates = self.frames[indices]
 
         valid = self.dones[indices[:-1]] == False  # Ignore current frame
@@ -286,43 +316,216 @@ class ReplayMemory:
             padding = np.repeat(padding, padding_size, axis=0)
             frames_stack = np.concatenate([padding, candidates[padding_size:]], axis=0)
 
-        assert frames_stack.shape == (self.window_length, *self.state_shape)
+        if utils.DEBUG:
+            assert frames_stack.shape == (self.window_length, *self.state_shape)
 
         return frames_stack
 
-    # Retrieve samples
-    def sample(self, batch_size):
+    def _get_stacked_frames_batch(self, indices):
         """
-        Return a batch of stacked states, actions, rewards, next_states, and dones.
+        Retrieve stacked frames for a batch of indices with one gather.
+        Same semantics as _get_stacked_frames, vectorized over the batch.
         """
-        assert self.size >= batch_size, "Not enough samples in memory!"
+        # (B, window) matrix of frame indices ending at each sampled index
+        frame_indices = (indices[:, np.newaxis] + self.window_offsets) % self.max_size
+        frames_stack = self.frames[frame_indices]  # (B, window, H, W)
 
-        indices = np.random.randint(0, self.size - 1, size=batch_size)
+        # Zero out every frame up to and including the last episode end
+        # before the current frame (reverse cumulative OR over the window)
+        dones = self.dones[frame_indices[:, :-1]]
+        padding = np.logical_or.accumulate(dones[:, ::-1], axis=1)[:, ::-1]
+        frames_stack[:, :-1][padding] = 0
 
-        state_batch = np.array(
-            [self._get_stacked_frames(idx) for idx in indices], dtype=np.uint8
-        )
-        next_state_batch = np.array(
-            [self._get_stacked_frames((idx + 1) % self.max_size) for idx in indices],
-            dtype=np.uint8,
+        return frames_stack
+
+    def _get_n_step_returns(self, indices):
+        """
+        Compute discounted n-step rewards and dones for a batch of indices.
+        Rewards after the first episode end in the window are dropped.
+        """
+        # (B, n_step) matrix of the transitions making up each return
+        step_indices = (indices[:, np.newaxis] + self.step_offsets) % self.max_size
+        dones = self.dones[step_indices]
+
+        # A reward counts only if no earlier step in the window ended
+        ended = np.logical_or.accumulate(dones, axis=1)
+        alive = np.ones_like(dones)
+        alive[:, 1:] = ~ended[:, :-1]
+
+        returns = (self.rewards[step_indices] * alive) @ self.discounts
+        return returns.astype(np.float32), ended[:, -1]
+
+    def _get_next_state_indices(self, indices, dones):
+        """
+        Return the index of the newest frame of each next state.
+        """
+        return (indices + self.n_step) % self.max_size
+
+    def _get_batch(self, indices):
+        """
+        Assemble stacked states, actions, n-step rewards, next_states and dones.
+        """
+        batch_size = len(indices)
+        reward_batch, done_batch = self._get_n_step_returns(indices)
+
+        # Gather states and next states together
+        stacked = self._get_stacked_frames_batch(
+            np.concatenate([indices, self._get_next_state_indices(indices, done_batch)])
         )
+        state_batch = stacked[:batch_size]
+        next_state_batch = stacked[batch_size:]
         action_batch = self.actions[indices]
-        reward_batch = self.rewards[indices]
-        done_batch = self.dones[indices]
 
         return state_batch, action_batch, reward_batch, next_state_batch, done_batch
 
+    # Retrieve samples
+    def sample(self, batch_size, rng=None):
+        """
+        Return a batch of stacked states, actions, rewards, next_states, and dones.
+
+        Indices are drawn from rng, a np.random.Generator, if given,
+        e.g. by a sampling thread, otherwise from the global NumPy RNG.
+        """
+        assert self.size >= batch_size, "Not enough samples in memory!"
+        return self._get_batch(self._sample_indices(batch_size, rng))
+
+    def _sample_indices(self, batch_size, rng=None):
+        """
+        Draw uniform indices of the transitions whose next state is stored.
+        """
+        # The n_step transitions just behind position do not have their
+        # next state yet, and once the buffer has wrapped the oldest
+        # transition is the one at position
+        oldest = (self.position - self.size) % self.max_size
+        high = self.size - self.n_step
+        if rng is None:
+            offsets = np.random.randint(0, high, size=batch_size)
+        else:
+            offsets = rng.integers(0, high, size=batch_size)
+        return (oldest + offsets) % self.max_size
+
     def clear(self):
         """
         Reset the memory. Deletes all references to the samples.
         """
         # Reinitialize
-        self.frames = np.zeros((self.max_size, *self.state_shape), dtype=np.uint8)
-        self.actions = np.zeros((self.max_size,), dtype=np.int32)
-        self.rewards = np.zeros((self.max_size,), dtype=np.float32)
-        self.dones = np.zeros((self.max_size,), dtype=np.bool_)
+        self._allocate_storage()
         self.position = 0
         self.size = 0
+        self.total_steps = 0
+        self.saved_steps = None
+
+    # Names of the arrays indexed by ring buffer slot, saved in chunks
+    CHUNKED_ARRAYS = ("frames", "actions", "rewards", "dones")
+
+    def _checkpoint_meta(self):
+        """Return the scalar state saved next to the arrays."""
+        return {
+            "max_size": self.max_size,
+            "window_length": self.window_length,
+            "state_shape": list(self.state_shape),
+            "position": self.position,
+            "size": self.size,
+            "total_steps": self.total_steps,
+        }
+
+    def _restore_meta(self, meta):
+        assert meta["max_size"] == self.max_size, "Buffer size mismatch!"
+        assert tuple(meta["state_shape"]) == tuple(self.state_shape), (
+            "Shape mismatch!"
+        )
+        self.position = meta["position"]
+        self.size = meta["size"]
+        self.total_steps = meta["total_steps"]
+
+    def _dirty_chunks(self, chunk_size):
+        """Return the chunks holding slots written since the last save."""
+        num_chunks = -(-self.max_size // chunk_size)
+        if self.saved_steps is None:
+            return range(-(-self.size // chunk_size))
+        num_new = self.total_steps - self.saved_steps
+        if num_new >= self.max_size:
+            return range(num_chunks)
+
+        slots = (self.saved_steps + np.arange(num_new)) % self.max_size
+        return np.unique(slots // chunk_size)
+
+    def save_checkpoint(self, path, chunk_size=int(5e4), compress=False):
+        """Write the memory to path, only rewriting chunks that changed.
+
+        Every array in CHUNKED_ARRAYS is split into chunks of
+        chunk_size slots, stored as `<name>_<chunk>.npy` (or `.npz` if
+        compress). Only chunks containing slots appended since the
+        previous save_checkpoint are written. The scalar state goes to
+        meta.json, written last. Every file is replaced atomically, so
+        a crash mid-save never truncates one, but chunks rewritten
+        before the crash already hold the newer transitions.
+
+        Parameters
+        ----------
+        path: str
+          Checkpoint directory of the memory.
+        chunk_size: int, optional
+          Number of slots per chunk file. Must not change between
+          saves to the same directory.
+        compress: bool, optional
+          Store compressed .npz chunks. They are smaller but cannot be
+          memory-mapped on load.
+        """
+        os.makedirs(path, exist_ok=True)
+        for chunk in self._dirty_chunks(chunk_size):
+            start = chunk * chunk_size
+            end = min(start + chunk_size, self.max_size)
+            for name in self.CHUNKED_ARRAYS:
+                chunk_path = os.path.join(path, f"{name}_{chunk:05d}")
+                array = getattr(self, name)[start:end]
+                if compress:
+                    with utils.atomic_write(chunk_path + ".npz") as f:
+                        np.savez_compressed(f, array=array)
+                else:
+                    with utils.atomic_write(chunk_path + ".npy") as f:
+                        np.save(f, array)
+        self._save_extra(path)
+
+        meta = self._checkpoint_meta()
+        meta["chunk_size"] = chunk_size
+        meta["compress"] = compress
+        with utils.atomic_write(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        self.saved_steps = self.total_steps
+
+    def load_checkpoint(self, path):
+        """Restore the memory written by save_checkpoint.
+
+        Raw chunks are memory-mapped and copied into the ring buffer
+        slice by slice, so nothing is unpickled.
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self._restore_meta(meta)
+
+        chunk_size = meta["chunk_size"]
+        for chunk in range(-(-self.max_size // chunk_size)):
+            start = chunk * chunk_size
+            for name in self.CHUNKED_ARRAYS:
+                chunk_path = os.path.join(path, f"{name}_{chunk:05d}")
+                if meta["compress"] and os.path.exists(chunk_path + ".npz"):
+                    with np.load(chunk_path + ".npz") as data:
+                        array = data["array"]
+                elif os.path.exists(chunk_path + ".npy"):
+                    array = np.load(chunk_path + ".npy", mmap_mode="r")
+                else:
+                    continue  # never written
+                getattr(self, name)[start : start + len(array)] = array
+        self._load_extra(path)
+        self.saved_steps = self.total_steps
+        print(f"Loaded replay memory from {path} with {self.size} samples")
+
+    def _save_extra(self, path):
+        """Save state that is not indexed by slot. Nothing by default."""
+
+    def _load_extra(self, path):
+        """Load the state written by _save_extra. Nothing by default."""
 
     def __len__(self):
         return self.size
@@ -339,3 +542,594 @@ class ReplayMemory:
     def __iter__(self):
         for i in range(self.size):
             yield self[i]
+
+
+class EpisodeReplayMemory(ReplayMemory):
+    """Replay memory that indexes where every episode starts.
+
+    Alongside each frame it records the absolute step number at which
+    the frame was appended and the step at which its episode started.
+    A stacked state is then a single gather: frames from before the
+    episode start (or already overwritten by the ring buffer) point at
+    a reserved all-zero row at index max_size instead of being zeroed
+    after the gather.
+
+    Next states never cross episode boundaries: when the n-step window
+    reaches a terminal, the next state is the sampled state itself.
+    The terminal observation is not stored, but its value is masked
+    out of the target by the done flag anyway.
+    """
+
+    CHUNKED_ARRAYS = ReplayMemory.CHUNKED_ARRAYS + ("steps", "episode_starts")
+
+    def __init__(self, max_size, window_length, state_shape, **kwargs):
+        super().__init__(max_size, window_length, state_shape, **kwargs)
+        self.current_episode_start = 0
+
+    def _allocate_storage(self):
+        """Allocate the ring buffer, a zero padding row and the side index."""
+        self.frames = np.zeros((self.max_size + 1, *self.state_shape), dtype=np.uint8)
+        self.actions = np.zeros((self.max_size,), dtype=np.int32)
+        self.rewards = np.zeros((self.max_size,), dtype=np.float32)
+        self.dones = np.zeros((self.max_size,), dtype=np.bool_)
+        self.steps = np.zeros((self.max_size,), dtype=np.int64)
+        self.episode_starts = np.zeros((self.max_size,), dtype=np.int64)
+
+    def append(self, state, action, reward, done):
+        """
+        Add a sample and record its step and episode start.
+        """
+        self.steps[self.position] = self.total_steps
+        self.episode_starts[self.position] = self.current_episode_start
+        super().append(state, action, reward, done)
+
+        if done:
+            self.current_episode_start = self.total_steps
+
+    def _get_stacked_frames_batch(self, indices):
+        """
+        Retrieve stacked frames for a batch of indices with one gather.
+        """
+        # Absolute step of every frame in each stack
+        frame_steps = self.steps[indices][:, np.newaxis] + self.window_offsets
+
+        # Oldest step that is part of the same episode and still stored
+        oldest = np.maximum(
+            self.episode_starts[indices], self.total_steps - self.max_size
+        )
+        frame_indices = np.where(
+            frame_steps >= oldest[:, np.newaxis],
+            (indices[:, np.newaxis] + self.window_offsets) % self.max_size,
+            self.max_size,  # the zero padding row
+        )
+        return self.frames[frame_indices]
+
+    def _get_next_state_indices(self, indices, dones):
+        """
+        Return the index of the newest frame of each next state.
+        """
+        return np.where(dones, indices, (indices + self.n_step) % self.max_size)
+
+    def clear(self):
+        """
+        Reset the memory. Deletes all references to the samples.
+        """
+        super().clear()
+        self.current_episode_start = 0
+
+    def _checkpoint_meta(self):
+        meta = super()._checkpoint_meta()
+        meta["current_episode_start"] = self.current_episode_start
+        return meta
+
+    def _restore_meta(self, meta):
+        super()._restore_meta(meta)
+        self.current_episode_start = meta["current_episode_start"]
+
+    def __getitem__(self, idx):
+        state, action, reward, next_state, done = self._get_batch(np.array([idx]))
+        return state[0], action[0], reward[0], next_state[0], done[0]
+
+
+class MemmapReplayMemory(ReplayMemory):
+    """Replay memory whose ring buffer lives in np.memmap files on disk.
+
+    Same interface as ReplayMemory, but frames, actions, rewards and
+    dones are stored in `<path>/{frames,actions,rewards,dones}.dat` so
+    a million-transition buffer only costs page cache instead of
+    resident memory. The ring buffer pointers are written to
+    `<path>/meta.json` on every flush, which makes it possible to
+    reopen an existing buffer. Those files change with every append, so
+    save_checkpoint still copies the chunks written since the previous
+    save to its own directory, keeping a snapshot that matches the
+    agent's checkpoint.
+
+    Parameters
+    ----------
+    max_size: int
+      Capacity of the ring buffer.
+    window_length: int
+      Number of frames stacked into a state.
+    state_shape: tuple(int, int)
+      Shape of a single frame.
+    path: str
+      Directory holding the memmap files.
+    resume: bool, optional
+      Reopen the buffer found in `path` instead of creating a new one.
+    flush_freq: int, optional
+      Flush the memmaps and the metadata every this many appends.
+    kwargs:
+      Forwarded to ReplayMemory, e.g. n_step and gamma.
+    """
+
+    META_FILE = "meta.json"
+
+    def __init__(
+        self,
+        max_size,
+        window_length,
+        state_shape,
+        path,
+        resume=False,
+        flush_freq=10000,
+        **kwargs,
+    ):
+        self.path = path
+        self.resume = resume
+        self.flush_freq = flush_freq
+        os.makedirs(path, exist_ok=True)
+
+        self.meta = self._read_meta() if resume else None
+        super().__init__(max_size, window_length, tuple(state_shape), **kwargs)
+
+        if resume:
+            self.position = self.meta["position"]
+            self.size = self.meta["size"]
+            self.total_steps = self.meta.get("total_steps", self.size)
+            print(f"Resumed replay memory from {path} with {self.size} samples")
+        else:
+            self.flush()
+
+    def _read_meta(self):
+        with open(os.path.join(self.path, self.META_FILE)) as f:
+            return json.load(f)
+
+    def _memmap(self, name, dtype, shape):
+        return np.memmap(
+            os.path.join(self.path, f"{name}.dat"),
+            dtype=dtype,
+            mode="r+" if self.resume else "w+",
+            shape=shape,
+        )
+
+    def _allocate_storage(self):
+        """Open (or create) the memmap files backing the ring buffer."""
+        if self.resume:
+            assert self.meta["max_size"] == self.max_size, "Buffer size mismatch!"
+            assert tuple(self.meta["state_shape"]) == self.state_shape, (
+                "Shape mismatch!"
+            )
+
+        self.frames = self._memmap(
+            "frames", np.uint8, (self.max_size, *self.state_shape)
+        )
+        self.actions = self._memmap("actions", np.int32, (self.max_size,))
+        self.rewards = self._memmap("rewards", np.float32, (self.max_size,))
+        self.dones = self._memmap("dones", np.bool_, (self.max_size,))
+
+    def append(self, state, action, reward, done):
+        """
+        Add a sample to the replay memory, flushing to disk periodically.
+        """
+        super().append(state, action, reward, done)
+        if self.position % self.flush_freq == 0:
+            self.flush()
+
+    def flush(self):
+        """Write dirty pages and the ring buffer pointers to disk."""
+        for array in (self.frames, self.actions, self.rewards, self.dones):
+            array.flush()
+
+        meta = self._checkpoint_meta()
+        with utils.atomic_write(os.path.join(self.path, self.META_FILE), "w") as f:
+            json.dump(meta, f)
+
+    def clear(self):
+        """
+        Reset the memory without reallocating the files on disk.
+        """
+        # Stale frames are unreachable once size is 0, so only the
+        # small per-step arrays need to be reset
+        self.actions[:] = 0
+        self.rewards[:] = 0
+        self.dones[:] = False
+        self.position = 0
+        self.size = 0
+        self.total_steps = 0
+        self.saved_steps = None
+        self.flush()
+
+
+class SharedReplayMemory(ReplayMemory):
+    """Replay memory living in shared memory.
+
+    The ring buffer arrays and the position/size/total_steps pointers
+    are backed by torch shared-memory tensors, so a process forked after construction
+    can append transitions that the parent process then samples. Only
+    one process should append to a given SharedReplayMemory.
+    """
+
+    def __init__(self, max_size, window_length, state_shape, **kwargs):
+        # [position, size, total_steps], shared so the sampling process
+        # sees appends and checkpoints the chunks they wrote
+        self.pointers = torch.zeros(3, dtype=torch.int64).share_memory_().numpy()
+        super().__init__(max_size, window_length, state_shape, **kwargs)
+
+    @staticmethod
+    def _shared_zeros(shape, dtype):
+        return torch.zeros(shape, dtype=dtype).share_memory_().numpy()
+
+    def _allocate_storage(self):
+        """Allocate the ring buffer arrays in shared memory."""
+        self.frames = self._shared_zeros(
+            (self.max_size, *self.state_shape), torch.uint8
+        )
+        self.actions = self._shared_zeros((self.max_size,), torch.int32)
+        self.rewards = self._shared_zeros((self.max_size,), torch.float32)
+        self.dones = self._shared_zeros((self.max_size,), torch.bool)
+
+    @property
+    def position(self):
+        return int(self.pointers[0])
+
+    @position.setter
+    def position(self, value):
+        self.pointers[0] = value
+
+    @property
+    def size(self):
+        return int(self.pointers[1])
+
+    @size.setter
+    def size(self, value):
+        self.pointers[1] = value
+
+    @property
+    def total_steps(self):
+        return int(self.pointers[2])
+
+    @total_steps.setter
+    def total_steps(self, value):
+        self.pointers[2] = value
+
+    def clear(self):
+        """
+        Reset the memory in place so other processes keep seeing it.
+        """
+        self.actions[:] = 0
+        self.rewards[:] = 0
+        self.dones[:] = False
+        self.position = 0
+        self.size = 0
+        self.total_steps = 0
+        self.saved_steps = None
+
+
+class VectorReplayMemory:
+    """Replay memory for transitions from several environments at once.
+
+    The frame-per-step ring buffer of ReplayMemory relies on consecutive
+    appends coming from the same episode, so each environment of a
+    vectorized env gets its own ReplayMemory shard of
+    max_size // num_envs frames. Batches are drawn from the shards in
+    proportion to how many transitions they hold.
+
+    Parameters
+    ----------
+    num_envs: int
+      Number of environments, i.e. number of shards.
+    max_size: int
+      Total capacity over all shards.
+    window_length: int
+      Number of frames stacked into a state.
+    state_shape: tuple(int, int)
+      Shape of a single frame.
+    memory_cls: type, optional
+      ReplayMemory class used for the shards.
+    kwargs:
+      Forwarded to ReplayMemory, e.g. n_step and gamma.
+    """
+
+    def __init__(
+        self,
+        num_envs,
+        max_size,
+        window_length,
+        state_shape,
+        memory_cls=ReplayMemory,
+        **kwargs,
+    ):
+        self.num_envs = num_envs
+        self.max_size = max_size
+        self.window_length = window_length
+        self.state_shape = state_shape
+        self.shards = [
+            memory_cls(max_size // num_envs, window_length, state_shape, **kwargs)
+            for _ in range(num_envs)
+        ]
+        self.n_step = self.shards[0].n_step
+
+    def append(self, states, actions, rewards, dones):
+        """
+        Add one transition per environment.
+        """
+        for shard, state, action, reward, done in zip(
+            self.shards, states, actions, rewards, dones
+        ):
+            shard.append(state, action, reward, done)
+
+    def sample(self, batch_size, rng=None):
+        """
+        Return a batch of stacked states, actions, rewards, next_states, and dones.
+
+        Drawn from rng, a np.random.Generator, if given.
+        """
+        assert len(self) >= batch_size, "Not enough samples in memory!"
+
+        valid = np.array(
+            [max(shard.size - self.n_step, 0) for shard in self.shards],
+            dtype=np.float64,
+        )
+        assert valid.sum() > 0, (
+            f"No shard holds more than n_step={self.n_step} transitions yet!"
+        )
+        probs = valid / valid.sum()
+        if rng is None:
+            counts = np.random.multinomial(batch_size, probs)
+        else:
+            counts = rng.multinomial(batch_size, probs)
+
+        batches = [
+            shard._get_batch(shard._sample_indices(count, rng))
+            for shard, count in zip(self.shards, counts)
+            if count > 0
+        ]
+        return tuple(np.concatenate(parts) for parts in zip(*batches))
+
+    def clear(self):
+        """
+        Reset every shard.
+        """
+        for shard in self.shards:
+            shard.clear()
+
+    def save_checkpoint(self, path, **kwargs):
+        """Save every shard to its own subdirectory of path."""
+        for i, shard in enumerate(self.shards):
+            shard.save_checkpoint(os.path.join(path, f"shard_{i:03d}"), **kwargs)
+
+    def load_checkpoint(self, path):
+        """Restore the shards written by save_checkpoint."""
+        for i, shard in enumerate(self.shards):
+            shard.load_checkpoint(os.path.join(path, f"shard_{i:03d}"))
+
+    @property
+    def total_steps(self):
+        """Number of transitions appended over all shards."""
+        return sum(shard.total_steps for shard in self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+
+class SegmentTree:
+    """Array-based binary segment tree over a fixed number of leaves.
+
+    Node 1 is the root and node i has children 2i and 2i + 1, so the
+    leaves occupy `tree[capacity:2 * capacity]`. All updates and
+    queries are vectorized over a batch of leaves and touch O(log N)
+    nodes each.
+
+    Parameters
+    ----------
+    capacity: int
+      Number of leaves. Rounded up to the next power of two.
+    operation: np.ufunc
+      Associative binary operation used to combine children.
+    neutral_element: float
+      Identity of `operation`, used for empty leaves.
+    """
+
+    def __init__(self, capacity, operation, neutral_element):
+        self.capacity = 1 << int(np.ceil(np.log2(max(capacity, 1))))
+        self.operation = operation
+        self.neutral_element = neutral_element
+        self.tree = np.full(2 * self.capacity, neutral_element, dtype=np.float64)
+
+    def update(self, indices, values):
+        """Set the given leaves and recompute their ancestors."""
+        nodes = np.asarray(indices, dtype=np.int64) + self.capacity
+        self.tree[nodes] = values
+
+        # All leaves are at the same depth, so walk up level by level
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.operation(
+                self.tree[2 * nodes], self.tree[2 * nodes + 1]
+            )
+            nodes = np.unique(nodes // 2)
+
+    def reduce(self):
+        """Return the operation applied over all leaves."""
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.capacity]
+
+    def clear(self):
+        self.tree[:] = self.neutral_element
+
+
+class SumTree(SegmentTree):
+    """Segment tree of sums supporting proportional sampling."""
+
+    def __init__(self, capacity):
+        super().__init__(capacity, np.add, 0.0)
+
+    def find_prefixsum_idx(self, prefixsums):
+        """Return, for each prefix sum, the leaf i with
+        sum(tree[:i]) <= prefixsum < sum(tree[:i + 1]).
+        """
+        prefixsums = np.array(prefixsums, dtype=np.float64)
+        nodes = np.ones(len(prefixsums), dtype=np.int64)
+        while nodes[0] < self.capacity:
+            left = 2 * nodes
+            go_right = prefixsums >= self.tree[left]
+            prefixsums -= np.where(go_right, self.tree[left], 0.0)
+            nodes = left + go_right
+        return nodes - self.capacity
+
+
+class MinTree(SegmentTree):
+    """Segment tree of minimums, used to normalize importance weights."""
+
+    def __init__(self, capacity):
+        super().__init__(capacity, np.minimum, np.inf)
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """Proportional prioritized experience replay.
+
+    Based on Schaul et al., "Prioritized Experience Replay", ICLR 2016.
+    Transitions are sampled with probability p_i^alpha / sum_k p_k^alpha
+    using a sum-tree, and the returned importance-sampling weights
+    (N * P(i))^-beta are normalized by their maximum, found with a
+    min-tree. New transitions get the maximum priority seen so far.
+
+    A transition only becomes sampleable once the n_step frames
+    following it have been appended, matching the uniform sampler which
+    never draws the n_step transitions just behind the write position.
+
+    Parameters
+    ----------
+    alpha: float
+      How much prioritization is used (0 is uniform).
+    beta: float
+      Initial importance-sampling exponent, annealed linearly to 1.
+    beta_steps: int
+      Number of calls to sample over which beta reaches 1.
+    eps: float
+      Added to every priority so no transition is starved.
+    kwargs:
+      Forwarded to ReplayMemory, e.g. n_step and gamma.
+    """
+
+    def __init__(
+        self,
+        max_size,
+        window_length,
+        state_shape,
+        alpha=0.6,
+        beta=0.4,
+        beta_steps=int(1e6),
+        eps=1e-6,
+        **kwargs,
+    ):
+        super().__init__(max_size, window_length, state_shape, **kwargs)
+        self.alpha = alpha
+        self.beta_start = beta
+        self.beta = beta
+        self.beta_steps = beta_steps
+        self.eps = eps
+        self.n_samples = 0
+
+        self.sum_tree = SumTree(max_size)
+        self.min_tree = MinTree(max_size)
+        self.max_priority = 1.0
+
+    def append(self, state, action, reward, done):
+        """
+        Add a sample and make the one n_step behind it sampleable.
+        """
+        position = self.position
+        super().append(state, action, reward, done)
+
+        # The newest transitions have no next state yet
+        self.sum_tree.update([position], 0.0)
+        self.min_tree.update([position], np.inf)
+        if self.size > self.n_step:
+            previous = (position - self.n_step) % self.max_size
+            priority = self.max_priority**self.alpha
+            self.sum_tree.update([previous], priority)
+            self.min_tree.update([previous], priority)
+
+    def sample(self, batch_size, rng=None):
+        """
+        Return a prioritized batch along with importance-sampling
+        weights and the sampled indices for update_priorities.
+
+        Drawn from rng, a np.random.Generator, if given.
+        """
+        assert self.size >= batch_size, "Not enough samples in memory!"
+        if rng is None:
+            rng = np.random
+
+        # Stratified sampling: one draw per equal slice of the total mass
+        total = self.sum_tree.reduce()
+        bounds = np.linspace(0.0, total, batch_size + 1)
+        prefixsums = rng.uniform(bounds[:-1], bounds[1:])
+        # Guard against rounding past the last non-empty leaf
+        prefixsums = np.minimum(prefixsums, total * (1 - 1e-9))
+        indices = self.sum_tree.find_prefixsum_idx(prefixsums)
+
+        # (N * P(i))^-beta / max_k (N * P(k))^-beta, where N cancels out
+        # and the largest weight belongs to the smallest priority
+        weights = (self.sum_tree[indices] / self.min_tree.reduce()) ** (-self.beta)
+
+        self.n_samples += 1
+        beta_increment = (1.0 - self.beta_start) / self.beta_steps
+        self.beta = min(1.0, self.beta_start + self.n_samples * beta_increment)
+
+        return (*self._get_batch(indices), weights.astype(np.float32), indices)
+
+    def update_priorities(self, indices, td_errors):
+        """Set the priorities of sampled transitions from their TD errors."""
+        priorities = np.abs(td_errors) + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        priorities = priorities**self.alpha
+        self.sum_tree.update(indices, priorities)
+        self.min_tree.update(indices, priorities)
+
+    def clear(self):
+        """
+        Reset the memory and all priorities.
+        """
+        super().clear()
+        self.sum_tree.clear()
+        self.min_tree.clear()
+        self.max_priority = 1.0
+        self.n_samples = 0
+        self.beta = self.beta_start
+
+    def _checkpoint_meta(self):
+        meta = super()._checkpoint_meta()
+        meta["max_priority"] = float(self.max_priority)
+        meta["n_samples"] = self.n_samples
+        meta["beta"] = self.beta
+        return meta
+
+    def _restore_meta(self, meta):
+        super()._restore_meta(meta)
+        self.max_priority = meta["max_priority"]
+        self.n_samples = meta["n_samples"]
+        self.beta = meta["beta"]
+
+    def _save_extra(self, path):
+        """Save both trees whole; priorities change all over the buffer."""
+        for name, tree in (("sum_tree", self.sum_tree), ("min_tree", self.min_tree)):
+            with utils.atomic_write(os.path.join(path, f"{name}.npy")) as f:
+                np.save(f, tree.tree)
+
+    def _load_extra(self, path):
+        self.sum_tree.tree[:] = np.load(os.path.join(path, "sum_tree.npy"))
+        self.min_tree.tree[:] = np.load(os.path.join(path, "min_tree.npy"))
@@ -1,18 +1,34 @@
 """Main DQN agent."""
 
+import contextlib
+import multiprocessing as mp
+import os
 from os import name
 from random import seed
 import torch
 import copy
+from deeprl_hw2.core import PrioritizedReplayMemory
+from deeprl_hw2.inference import InferenceEngine
+from deeprl_hw2.metrics import LocalLogger, MetricsAccumulator, ThroughputMeter
+from deeprl_hw2.policy import (
+    GreedyEpsilonPolicy,
+    GreedyPolicy,
+    LinearDecayGreedyEpsilonPolicy,
+)
+from deeprl_hw2.prefetcher import BatchPrefetcher
+from deeprl_hw2.preprocessors import VectorAtariPreprocessor
 from deeprl_hw2.utils import (
     get_hard_target_model_updates,
     get_soft_target_model_updates,
+    make_atari_env,
+    make_vector_atari_env,
 )
 import tqdm
 import numpy as np
 from torch.nn import utils as nn_utils
 import matplotlib.pyplot as plt
 import time
+import gymnasium as gym
 import wandb
 
 
@@ -42,7 +58,9 @@ class DQNAgent:
     target_update_freq: float
       Frequency to update the target network. You can either provide a
       number representing a soft target update (see utils.py) or a
-      hard target update (see utils.py and Atari paper.)
+      hard target update (see utils.py and Atari paper.) Values below
+      1 are the tau of a soft update after every training step, others
+      the number of iterations between hard updates.
     num_burn_in: int
       Before you begin updating the Q-network your replay memory has
       to be filled up with some number of samples. This number says
@@ -53,6 +71,33 @@ class DQNAgent:
       replay memory, for every Q-network update that you run.
     batch_size: int
       How many samples in each minibatch.
+    num_prefetch: int
+      If positive, sample this many minibatches ahead in a background
+      thread (see deeprl_hw2.prefetcher.BatchPrefetcher).
+    eval_episodes: int
+      Number of episodes of each periodic evaluation during fit.
+    eval_num_envs: int
+      If greater than 1, the periodic evaluation plays its episodes
+      on this many vectorized environments with batched inference.
+    eval_async: bool
+      Run the periodic evaluation in a forked process against a
+      snapshot of the target network so training continues meanwhile.
+    checkpoint_dir: str
+      If given, fit saves a resumable checkpoint of the agent and its
+      replay memory here (see save_checkpoint).
+    checkpoint_freq: int
+      Minimum number of iterations between checkpoints. They are only
+      written at the end of an episode.
+    inference_backend: str
+      How the networks are run when acting: "eager" or "compile"
+      (see deeprl_hw2.inference.InferenceEngine).
+    log_dir: str
+      If given, log entries are also written to a local file here
+      (see deeprl_hw2.metrics.LocalLogger).
+    log_format: str
+      "csv" or "parquet".
+    print_freq: int
+      Print a log line every this many episodes.
     """
 
     def __init__(
@@ -70,18 +115,46 @@ class DQNAgent:
         wandb_name="DQN",
         eval_freq=int(1e4),
         ddqn=False,
+        num_prefetch=0,
+        eval_episodes=20,
+        eval_num_envs=1,
+        eval_async=False,
+        checkpoint_dir=None,
+        checkpoint_freq=int(1e5),
+        inference_backend="eager",
+        log_dir=None,
+        log_format="csv",
+        print_freq=1,
     ):
         self.q_network = q_network
         self.preprocessor = preprocessor
         self.memory = memory
         self.gamma = gamma
         self.target_update_freq = target_update_freq
+        self.soft_target_update = target_update_freq < 1
         self.train_freq = train_freq
         self.num_burn_in = num_burn_in
         self.batch_size = batch_size
         self.policy = policy
         self.eval_freq = eval_freq
         self.ddqn = ddqn
+        self.num_prefetch = num_prefetch
+        self.eval_episodes = eval_episodes
+        self.eval_num_envs = eval_num_envs
+        self.eval_async = eval_async
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_freq = checkpoint_freq
+        self.inference_backend = inference_backend
+        self.last_checkpoint_iter = 0
+
+        # State of the periodic evaluation run by fit
+        self.eval_process = None
+        self.eval_queue = None
+        self.eval_result = None
+
+        # Created on the first update, once the memory is burnt in
+        self.prefetcher = None
+        self.memory_lock = contextlib.nullcontext()
 
         if ddqn:
             print("Using Double DQN")
@@ -92,6 +165,7 @@ class DQNAgent:
             "iter": 0,
             "n_updates": 0,
             "n_episodes": 0,
+            "env_steps": 0,
             "eval_rewards": [],
             "eval_rewards_std": [],
         }
@@ -101,11 +175,64 @@ class DQNAgent:
         self.use_wandb = use_wandb
         if use_wandb:
             wandb.init(project="drl", name=wandb_name)
+        self.logger = LocalLogger(log_dir, log_format) if log_dir else None
+        self.print_freq = print_freq
+
+        # Loss and Q-values are averaged on the device between log lines
+        self.metrics = MetricsAccumulator(self.device)
+        self.throughput = ThroughputMeter()
 
     def wandb_log(self, dict):
         if self.use_wandb:
             wandb.log(dict)
 
+    def log(self, entry):
+        """Send a log entry to wandb and the local log, if enabled."""
+        self.wandb_log(entry)
+        if self.logger is not None:
+            self.logger.log(entry)
+
+    def episode_log(self, episode_reward, episode_length):
+        """Return the log entry of a finished episode.
+
+        Collects the loss and Q-values accumulated since the previous
+        entry, which is the only point where fit waits for the device.
+        """
+        self.training_log["n_episodes"] += 1
+        self.metrics.flush()
+        means = self.metrics.collect()
+        log = {
+            "Iteration": self.training_log["iter"],
+            "Episode reward": episode_reward,
+            "Episode length": episode_length,
+            "Loss": means.get("Loss", np.nan),
+            "Q-values": means.get("Q-values", np.nan),
+            "Epsilon": self.policy.policy.epsilon,
+        }
+        log.update(
+            self.throughput.rates(
+                self.training_log["env_steps"], self.training_log["n_updates"]
+            )
+        )
+        return log
+
+    def print_log(self, log, prefix=""):
+        """Print an episode log entry every print_freq episodes."""
+        if self.training_log["n_episodes"] % self.print_freq != 0:
+            return
+        print(
+            f"Iteration: {log['Iteration']}"
+            + prefix
+            + f" Episode reward: {log['Episode reward']}"
+            + f" Episode length: {log['Episode length']}"
+            + f" Loss: {log['Loss']:.4f}"
+            + f" Q-values: {log['Q-values']:.4f}"
+            + f" Epsilon: {log['Epsilon']:.4f}"
+            + f" Env steps/sec: {log['Env steps/sec']:.1f}"
+            + f" Updates/sec: {log['Updates/sec']:.1f}"
+            + f" Current memory size: {len(self.memory)}"
+        )
+
     def compile(self, optimizer, loss_func, lr):
         """Setup all of the TF graph variables/ops.
 
@@ -137,6 +264,17 @@ class DQNAgent:
         # gradient flow from the target network
         self.optimizer = optimizer(self.Q.parameters(), lr=lr)
 
+        # Acting goes through the online network, evaluation through the
+        # target network
+        self.online_engine = self._make_engine(self.Q)
+        self.target_engine = self._make_engine(self.Q_target)
+
+    def _make_engine(self, model):
+        state_shape = (self.preprocessor.window, *self.preprocessor.new_size)
+        return InferenceEngine(
+            model, state_shape, self.device, backend=self.inference_backend
+        )
+
     @torch.no_grad()
     def calc_q_values(self, state):
         """Given a state (or batch of states) calculate the Q-values.
@@ -162,10 +300,8 @@ class DQNAgent:
                 *self.preprocessor.new_size,
             )
 
-        state_ = self.preprocessor.process_batch(state)
-
-        input = torch.tensor(state_, dtype=torch.float32).to(self.device)
-        return self.Q_target(input).detach().cpu().squeeze()  # (B, A) or (A)
+        q_values = self.target_engine.q_values(state)
+        return q_values.cpu().squeeze()  # (B, A) or (A)
 
     def select_action(self, state, policy, **kwargs):
         """Select the action based on the current state.
@@ -186,7 +322,7 @@ class DQNAgent:
 
         Returns
         --------
-        selected action
+        selected action, or an array of actions for a batch of states
         """
 
         if state.ndim == 3:
@@ -197,21 +333,152 @@ class DQNAgent:
             state = state[np.newaxis, ...]
         else:
             assert state.shape[1:] == (
-                self.preprocessor.window_length,
+                self.preprocessor.window,
                 *self.preprocessor.new_size,
             )
 
-        # Always get the action from the Q network
-        state_ = self.preprocessor.process_batch(state)
-        state_ = torch.tensor(state_, dtype=torch.float32).to(self.device)
-        with torch.no_grad():
-            q_values = self.Q(state_).detach().squeeze()  # (B, A) or (A)
-            q_values = q_values.cpu().numpy()
+        # Epsilon-greedy policies are run by the engine on the torch side
+        epsilon = self._policy_epsilon(policy, **kwargs)
+        if epsilon is not None:
+            actions = self.online_engine.select_actions(state, epsilon)
+            return actions if len(actions) > 1 else actions[0]
 
+        # Always get the action from the Q network
+        q_values = self.online_engine.q_values(state).squeeze()  # (B, A) or (A)
+        q_values = q_values.cpu().numpy()
+
+        if q_values.ndim == 2:
+            return np.array(
+                [
+                    policy.select_action(
+                        q, agent_step=self.training_log["iter"], **kwargs
+                    )
+                    for q in q_values
+                ]
+            )
         return policy.select_action(
             q_values, agent_step=self.training_log["iter"], **kwargs
         )
 
+    def _policy_epsilon(self, policy, is_training=True, **kwargs):
+        """Return the exploration rate of policy for this step.
+
+        None if the policy is not epsilon-greedy, in which case it has
+        to pick the action from the Q-values itself.
+        """
+        if isinstance(policy, LinearDecayGreedyEpsilonPolicy):
+            return policy.step(
+                is_training=is_training, agent_step=self.training_log["iter"]
+            )
+        if isinstance(policy, GreedyEpsilonPolicy):
+            return policy.epsilon
+        if isinstance(policy, GreedyPolicy):
+            return 0.0
+        return None
+
+    def sample_batch(self):
+        """Sample a minibatch and move it to the device as tensors.
+
+        Returns
+        -------
+        states, actions, rewards, next_states, dones, weights, indices
+          weights and indices are None unless the memory is prioritized.
+        """
+        weights, indices = None, None
+        if isinstance(self.memory, PrioritizedReplayMemory):
+            (states, actions, rewards, next_states, dones, weights, indices) = (
+                self.memory.sample(self.batch_size)
+            )
+            weights = torch.tensor(weights, dtype=torch.float32).to(self.device)
+        else:
+            states, actions, rewards, next_states, dones = self.memory.sample(
+                self.batch_size
+            )
+
+        # Preprocess the states
+        states = self.preprocessor.process_batch(states)
+        next_states = self.preprocessor.process_batch(next_states)
+        # Rewards are processed on append, before n-step summation
+
+        # Convert to tensors
+        states = torch.tensor(states, dtype=torch.float32).to(self.device)
+        actions = torch.tensor(actions, dtype=torch.long).to(self.device)
+        rewards = torch.tensor(rewards, dtype=torch.float32).to(self.device)
+        next_states = torch.tensor(next_states, dtype=torch.float32).to(self.device)
+        dones = torch.tensor(dones, dtype=torch.float32).to(self.device)
+
+        return states, actions, rewards, next_states, dones, weights, indices
+
+    def train_step(self):
+        """Run one gradient step on a minibatch sampled from the memory.
+
+        Returns
+        -------
+        The loss and the Q-values of the sampled actions.
+        """
+
+        # Sample a minibatch
+        prioritized = isinstance(self.memory, PrioritizedReplayMemory)
+        if self.num_prefetch > 0:
+            if self.prefetcher is None:
+                # Seeded from the global RNG, so seeding the run seeds it too
+                self.prefetcher = BatchPrefetcher(
+                    self.memory,
+                    self.batch_size,
+                    self.device,
+                    self.num_prefetch,
+                    seed=np.random.randint(2**31),
+                )
+                self.memory_lock = self.prefetcher.lock
+            batch = self.prefetcher.get()
+        else:
+            batch = self.sample_batch()
+        states, actions, rewards, next_states, dones, weights, indices = batch
+
+        # Calculate the target values
+        with torch.no_grad():
+            next_q_values = self.Q_target(next_states)
+
+        self.optimizer.zero_grad()
+        if self.ddqn:
+            # Double DQN: one online forward over states and next states,
+            # only the states half gets gradients
+            batch_size = states.shape[0]
+            online_q_values = self.Q(torch.cat([states, next_states]))
+            q_values = online_q_values[:batch_size]  # (B, A)
+            next_online_q_values = online_q_values[batch_size:].detach()
+            target_actions = torch.argmax(next_online_q_values, dim=1)  # (B)
+        else:
+            q_values = self.Q(states)  # (B, A)
+            target_actions = torch.argmax(next_q_values, dim=1)  # (B)
+        max_next_q_values = torch.gather(
+            next_q_values, 1, target_actions.unsqueeze(1)
+        ).squeeze()
+        # Bootstrap n_step transitions ahead (n_step is 1 by default)
+        discount = self.gamma**self.memory.n_step
+        target_values = rewards + discount * max_next_q_values * (1 - dones)
+
+        # Update your network
+        selected_q_values = torch.gather(
+            q_values, 1, actions.unsqueeze(1)
+        ).squeeze()  # (B, 1) -> (B)
+        if prioritized:
+            loss = self.loss_func(target_values, selected_q_values, weights=weights)
+        else:
+            loss = self.loss_func(target_values, selected_q_values)
+        loss.backward()
+        # Clip the gradients
+        nn_utils.clip_grad_norm_(self.Q.parameters(), 10.0)
+        self.optimizer.step()
+
+        if prioritized:
+            td_errors = (target_values - selected_q_values).detach().cpu().numpy()
+            with self.memory_lock:
+                self.memory.update_priorities(indices, td_errors)
+        self.training_log["n_updates"] += 1
+
+        return loss, selected_q_values
+
     def update_policy(self):
         """Update your policy.
 
@@ -236,53 +503,16 @@ class DQNAgent:
             return loss, selected_q_values
 
         if self.training_log["iter"] % self.train_freq == 0:
+            loss, selected_q_values = self.train_step()
+            if self.soft_target_update:
+                self.Q_target = get_soft_target_model_updates(
+                    self.Q_target, self.Q, self.target_update_freq
+                )
 
-            # Sample a minibatch
-            states, actions, rewards, next_states, dones = self.memory.sample(
-                self.batch_size
-            )
-
-            # Preprocess the states
-            states = self.preprocessor.process_batch(states)
-            next_states = self.preprocessor.process_batch(next_states)
-            rewards = self.preprocessor.process_reward(rewards)
-
-            # Convert to tensors
-            states = torch.tensor(states, dtype=torch.float32).to(self.device)
-            actions = torch.tensor(actions, dtype=torch.long).to(self.device)
-            rewards = torch.tensor(rewards, dtype=torch.float32).to(self.device)
-            next_states = torch.tensor(next_states, dtype=torch.float32).to(self.device)
-            dones = torch.tensor(dones, dtype=torch.float32).to(self.device)
-
-            # Calculate the target values
-            with torch.no_grad():
-                next_q_values = self.Q_target(next_states)
-
-            # Pick actions
-            if self.ddqn:
-                # Double DQN
-                target_actions = torch.argmax(self.Q(next_states), dim=1)  # (B)
-            else:
-                target_actions = torch.argmax(next_q_values, dim=1)  # (B)
-            max_next_q_values = torch.gather(
-                next_q_values, 1, target_actions.unsqueeze(1)
-            ).squeeze()
-            target_values = rewards + self.gamma * max_next_q_values * (1 - dones)
-
-            # Update your network
-            self.optimizer.zero_grad()
-            q_values = self.Q(states)  # (B, A)
-            selected_q_values = torch.gather(
-                q_values, 1, actions.unsqueeze(1)
-            ).squeeze()  # (B, 1) -> (B)
-            loss = self.loss_func(target_values, selected_q_values)
-            loss.backward()
-            # Clip the gradients
-            nn_utils.clip_grad_norm_(self.Q.parameters(), 10.0)
-            self.optimizer.step()
-            self.training_log["n_updates"] += 1
-
-        if self.training_log["iter"] % self.target_update_freq == 0:
+        if (
+            not self.soft_target_update
+            and self.training_log["iter"] % self.target_update_freq == 0
+        ):
             self.Q_target = get_hard_target_model_updates(self.Q_target, self.Q)
             print(f"Updated target network at {self.training_log['iter']}")
 
@@ -313,15 +543,21 @@ class DQNAgent:
           How long a single episode should last before the agent
           resets. Can help exploration.
         """
+        try:
+            return self._fit(env, num_iterations, max_episode_length)
+        finally:
+            self.close_prefetcher()
 
+    def _fit(self, env, num_iterations, max_episode_length):
         # Training
 
         # Log the episode
         episode_reward = 0
         episode_length = 0
-        losses = []
-        q_values = []
         is_eval = False
+        self.throughput.reset(
+            self.training_log["env_steps"], self.training_log["n_updates"]
+        )
 
         state = copy.deepcopy(env.reset())
         self.preprocessor.reset()
@@ -341,14 +577,19 @@ class DQNAgent:
             next_state, reward, done, _, _ = env.step(action)
             episode_reward += reward
             episode_length += 1
+            self.training_log["env_steps"] += 1
 
             processed_next_state = self.preprocessor.process_state_for_memory(
                 next_state
             )
 
-            self.memory.append(
-                processed_state[-1], action, reward, done
-            )  # processed_next_state is not needed
+            with self.memory_lock:
+                self.memory.append(
+                    processed_state[-1],
+                    action,
+                    self.preprocessor.process_reward(reward),
+                    done,
+                )  # processed_next_state is not needed
 
             if not in_burn_in:
                 self.training_log["iter"] += 1
@@ -356,8 +597,8 @@ class DQNAgent:
             # Update the policy
             loss, q_value = self.update_policy()
             if loss is not None and q_value is not None:
-                losses.append(loss.item())
-                q_values.append(q_value.detach().flatten().cpu().numpy())
+                self.metrics.add("Loss", loss)
+                self.metrics.add("Q-values", q_value)
 
             # Prepare to evaluate after the episode
             if not in_burn_in and self.training_log["iter"] % self.eval_freq == 0:
@@ -369,48 +610,281 @@ class DQNAgent:
             if done or (max_episode_length and episode_length >= max_episode_length):
 
                 if not in_burn_in:
-                    log = {
-                        "Iteration": self.training_log["iter"],
-                        "Episode reward": episode_reward,
-                        "Episode length": episode_length,
-                        "Loss": np.mean(losses),
-                        "Q-values": np.mean(np.concatenate(q_values)),
-                        "Epsilon": self.policy.policy.epsilon,
-                    }
+                    log = self.episode_log(episode_reward, episode_length)
 
                     if is_eval:
                         is_eval = False
-                        eval_rewards = self.evaluate(env, num_episodes=20)
-                        eval_rewards_mean = np.mean(eval_rewards)
-                        eval_rewards_std = np.std(eval_rewards)
-                        log["Eval rewards"] = eval_rewards_mean
-                        self.training_log["eval_rewards"].append(eval_rewards_mean)
-                        self.training_log["eval_rewards_std"].append(eval_rewards_std)
-
-                    print(
-                        f"Iteration: {self.training_log['iter']}"
-                        + f" Episode reward: {episode_reward}"
-                        + f" Episode length: {episode_length}"
-                        + f" Loss: {np.mean(losses):.4f}"
-                        + f" Q-values: {np.mean(np.concatenate(q_values)):.4f}"
-                        + f" Epsilon: {self.policy.policy.epsilon:.4f}"
-                        + f" Current memory size: {len(self.memory)}"
-                    )
+                        self.start_evaluation(env)
+                    self.finish_evaluation(log)
 
-                    self.wandb_log(log)
+                    self.print_log(log)
+                    self.log(log)
+                    self.maybe_save_checkpoint()
 
                 # Reset the environment
                 self.preprocessor.reset()
                 state = copy.deepcopy(env.reset())
                 processed_state = self.preprocessor.process_state_for_memory(state)
 
-                losses = []
-                q_values = []
                 episode_reward = 0
                 episode_length = 0
 
+        self.finish_evaluation({}, wait=True)
+        self.close_logs()
         return self.training_log
 
+    def fit_vectorized(self, envs, num_iterations, eval_env=None):
+        """Fit your model while stepping several environments in lockstep.
+
+        Same as fit, but every tick runs one batched forward pass over
+        the observations of all environments and appends one transition
+        per environment to the replay memory. Each environment keeps
+        its own frame history in a VectorAtariPreprocessor.
+
+        Parameters
+        ----------
+        envs: gym.vector.VectorEnv
+          Environments created with utils.make_vector_atari_env, so
+          that finished environments reset within the same step.
+        num_iterations: int
+          How many samples/updates to perform.
+        eval_env: gym.Env, optional
+          Environment used for the periodic evaluation. Evaluation is
+          skipped if not given.
+        """
+        try:
+            return self._fit_vectorized(envs, num_iterations, eval_env)
+        finally:
+            self.close_prefetcher()
+
+    def _fit_vectorized(self, envs, num_iterations, eval_env):
+        num_envs = envs.num_envs
+        preprocessor = VectorAtariPreprocessor(
+            self.preprocessor.new_size, self.preprocessor.window, num_envs
+        )
+
+        episode_rewards = np.zeros(num_envs)
+        episode_lengths = np.zeros(num_envs, dtype=int)
+        is_eval = False
+        self.throughput.reset(
+            self.training_log["env_steps"], self.training_log["n_updates"]
+        )
+
+        states, _ = envs.reset()
+        preprocessor.reset()
+        processed_states = preprocessor.process_state_for_memory(states)
+        while self.training_log["iter"] < num_iterations:
+            # Determine if we are in the burn-in period
+            in_burn_in = len(self.memory) < self.num_burn_in
+
+            # Select the actions with one forward pass for all envs
+            if not in_burn_in:
+                actions = self.select_action(processed_states, policy=self.policy)
+            else:
+                actions = envs.action_space.sample()
+
+            next_states, rewards, terminated, truncated, _ = envs.step(actions)
+            dones = np.logical_or(terminated, truncated)
+            episode_rewards += rewards
+            episode_lengths += 1
+            self.training_log["env_steps"] += num_envs
+
+            with self.memory_lock:
+                self.memory.append(
+                    processed_states[:, -1],
+                    actions,
+                    self.preprocessor.process_reward(rewards),
+                    dones,
+                )
+
+            # Keep the ratio of updates to samples the same as fit
+            for _ in range(num_envs):
+                if not in_burn_in:
+                    self.training_log["iter"] += 1
+
+                loss, q_value = self.update_policy()
+                if loss is not None and q_value is not None:
+                    self.metrics.add("Loss", loss)
+                    self.metrics.add("Q-values", q_value)
+
+                if not in_burn_in and self.training_log["iter"] % self.eval_freq == 0:
+                    is_eval = True
+
+            # Done envs already returned the first frame of a new episode
+            preprocessor.reset(np.flatnonzero(dones))
+            processed_states = preprocessor.process_state_for_memory(next_states)
+
+            for i in np.flatnonzero(dones):
+                if not in_burn_in:
+                    log = self.episode_log(episode_rewards[i], episode_lengths[i])
+
+                    if is_eval and eval_env is not None:
+                        is_eval = False
+                        self.start_evaluation(eval_env)
+                    self.finish_evaluation(log)
+
+                    self.print_log(log, prefix=f" Env: {i}")
+                    self.log(log)
+                    self.maybe_save_checkpoint()
+
+                episode_rewards[i] = 0
+                episode_lengths[i] = 0
+
+        self.finish_evaluation({}, wait=True)
+        self.close_logs()
+        return self.training_log
+
+    def close_prefetcher(self):
+        """Stop the background sampling thread, if one was started."""
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+            self.memory_lock = contextlib.nullcontext()
+
+    def close_logs(self):
+        """Write out the buffered local log entries."""
+        if self.logger is not None:
+            self.logger.flush()
+
+    def run_evaluation(self, env):
+        """Play eval_episodes greedy episodes and return their rewards.
+
+        Uses eval_num_envs vectorized copies of env if there are more
+        than one, otherwise env itself.
+        """
+        if self.eval_num_envs > 1:
+            envs = make_vector_atari_env(
+                env.spec.id, self.eval_num_envs, obs_type=env.obs_type
+            )
+            rewards = self.evaluate_vectorized(envs, self.eval_episodes)
+            envs.close()
+            return rewards
+        return self.evaluate(env, num_episodes=self.eval_episodes)
+
+    def _evaluate_snapshot(self, snapshot, env_id, obs_type, result_queue):
+        """Evaluation process entry point. Runs on a forked copy of the agent."""
+        torch.set_num_threads(1)
+        self.Q_target = snapshot
+        self.device = torch.device("cpu")
+        self.target_engine = self._make_engine(snapshot)
+        env = make_atari_env(env_id, obs_type)
+        result_queue.put(self.run_evaluation(env))
+
+    def start_evaluation(self, env):
+        """Start the periodic evaluation, in the background if eval_async.
+
+        Does nothing while a previous background evaluation is still
+        running.
+        """
+        if self.eval_process is not None:
+            return
+
+        if self.eval_async:
+            # Frozen CPU copy, so the process does not touch the GPU
+            snapshot = copy.deepcopy(self.Q_target).cpu()
+            ctx = mp.get_context("fork")
+            self.eval_queue = ctx.Queue()
+            self.eval_process = ctx.Process(
+                target=self._evaluate_snapshot,
+                args=(snapshot, env.spec.id, env.obs_type, self.eval_queue),
+                daemon=True,
+            )
+            self.eval_process.start()
+        else:
+            self.eval_result = self.run_evaluation(env)
+
+    def finish_evaluation(self, log, wait=False):
+        """Record the rewards of a finished evaluation in log and training_log.
+
+        Parameters
+        ----------
+        log: dict
+          Log entry receiving "Eval rewards" if an evaluation finished.
+        wait: bool, optional
+          Block until a running background evaluation finishes.
+        """
+        if self.eval_process is not None and (wait or not self.eval_queue.empty()):
+            self.eval_result = self.eval_queue.get()
+            self.eval_process.join()
+            self.eval_process = None
+
+        if self.eval_result is None:
+            return
+
+        eval_rewards_mean = np.mean(self.eval_result)
+        eval_rewards_std = np.std(self.eval_result)
+        log["Eval rewards"] = eval_rewards_mean
+        self.training_log["eval_rewards"].append(eval_rewards_mean)
+        self.training_log["eval_rewards_std"].append(eval_rewards_std)
+        self.eval_result = None
+
+    @torch.no_grad()
+    def evaluate_vectorized(self, envs, num_episodes, max_episode_length=None):
+        """Test your agent on vectorized environments.
+
+        Same as evaluate, but plays the episodes on all environments of
+        envs at once with one batched greedy forward pass per step. The
+        episodes are split evenly over the environments so short
+        episodes do not crowd out long ones.
+
+        Parameters
+        ----------
+        envs: gym.vector.VectorEnv
+          Environments created with utils.make_vector_atari_env.
+        num_episodes: int
+          Total number of episodes to play.
+        max_episode_length: int, optional
+          Cut episodes off after this many steps.
+
+        Returns
+        -------
+        list(float)
+          The undiscounted reward of every episode.
+        """
+        num_envs = envs.num_envs
+        preprocessor = VectorAtariPreprocessor(
+            self.preprocessor.new_size, self.preprocessor.window, num_envs
+        )
+
+        quotas = np.full(num_envs, num_episodes // num_envs)
+        quotas[: num_episodes % num_envs] += 1
+        finished = np.zeros(num_envs, dtype=int)
+        episode_rewards = np.zeros(num_envs)
+        episode_lengths = np.zeros(num_envs, dtype=int)
+        total_rewards = []
+
+        states, _ = envs.reset(seed=list(range(num_envs)))
+        preprocessor.reset()
+        processed_states = preprocessor.process_state_for_memory(states)
+        while np.any(finished < quotas):
+            actions = self.target_engine.select_actions(processed_states)
+
+            next_states, rewards, terminated, truncated, _ = envs.step(actions)
+            episode_rewards += rewards  # not discounted
+            episode_lengths += 1
+            dones = np.logical_or(terminated, truncated)
+
+            if max_episode_length is not None:
+                cut_off = ~dones & (episode_lengths >= max_episode_length)
+                if cut_off.any():
+                    next_states, _ = envs.reset(options={"reset_mask": cut_off})
+                    dones |= cut_off
+
+            for i in np.flatnonzero(dones):
+                if finished[i] < quotas[i]:
+                    total_rewards.append(episode_rewards[i])
+                    finished[i] += 1
+                episode_rewards[i] = 0
+                episode_lengths[i] = 0
+
+            preprocessor.reset(np.flatnonzero(dones))
+            processed_states = preprocessor.process_state_for_memory(next_states)
+
+        print(f"Average rewards: {np.mean(total_rewards)}")
+        print(f"All rewards: {total_rewards}")
+
+        return total_rewards
+
     @torch.no_grad()
     def evaluate(self, env, num_episodes, max_episode_length=None):
         """Test your agent with a provided environment.
@@ -439,8 +913,7 @@ class DQNAgent:
             while not done and (
                 max_episode_length is None or step < max_episode_length
             ):
-                q_value = self.calc_q_values(processed_state).numpy()
-                action = np.argmax(q_value)
+                action = self.target_engine.select_actions(processed_state[None])[0]
 
                 next_state, reward, done, _, _ = env.step(action)
                 processed_next_state = self.preprocessor.process_state_for_memory(
@@ -476,8 +949,7 @@ class DQNAgent:
         step = 0
         total_reward = 0
         while not done and (max_episode_length is None or step < max_episode_length):
-            q_value = self.calc_q_values(processed_state).numpy()
-            action = np.argmax(q_value)
+            action = self.target_engine.select_actions(processed_state[None])[0]
             # for i in range(processed_state.shape[0]):
             #     plt.subplot(1, processed_state.shape[0], i + 1)
             #     plt.imshow(processed_state[i], cmap="gray")
@@ -491,16 +963,18 @@ class DQNAgent:
             )
             total_reward += reward  # not discounted
             processed_state = processed_next_state
-            frames.append(next_state)
+            frames.append(next_state.copy())  # the wrapper reuses its buffer
             step += 1
 
         print(f"Total reward: {total_reward}")
 
-        height, width, layers = frames[0].shape
+        height, width = frames[0].shape[:2]
 
         # Define the codec and create a VideoWriter object
         fourcc = cv2.VideoWriter_fourcc(*"mp4v")  # Codec for mp4
-        video = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+        video = cv2.VideoWriter(
+            output_path, fourcc, fps, (width, height), isColor=frames[0].ndim == 3
+        )
 
         # Write each frame to the video file
         for frame in frames:
@@ -510,6 +984,82 @@ class DQNAgent:
         video.release()
         print(f"Video saved at {output_path}")
 
+    def maybe_save_checkpoint(self):
+        """Save a checkpoint if checkpoint_freq iterations have passed."""
+        if self.checkpoint_dir is None:
+            return
+        if self.training_log["iter"] - self.last_checkpoint_iter < self.checkpoint_freq:
+            return
+        self.save_checkpoint(self.checkpoint_dir)
+
+    def save_checkpoint(self, path):
+        """Save everything needed to resume training to path.
+
+        The networks, optimizer, exploration schedule, training log and
+        RNG states go to agent.pt. The replay memory is saved to the
+        memory subdirectory with its own save_checkpoint, which only
+        rewrites the chunks appended since the previous checkpoint.
+        agent.pt is replaced last and records the memory's total_steps,
+        so load_checkpoint can tell if a crash interrupted the save.
+        """
+        os.makedirs(path, exist_ok=True)
+        state = {
+            "Q": self.Q.state_dict(),
+            "Q_target": self.Q_target.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "training_log": self.training_log,
+            "policy": (
+                self.policy.state_dict() if hasattr(self.policy, "state_dict") else None
+            ),
+            "numpy_rng": np.random.get_state(),
+            "torch_rng": torch.get_rng_state(),
+        }
+
+        start_time = time.time()
+        with self.memory_lock:
+            state["memory_steps"] = self.memory.total_steps
+            self.memory.save_checkpoint(os.path.join(path, "memory"))
+        # Write then rename so a crash never leaves a truncated file
+        tmp_path = os.path.join(path, "agent.pt.tmp")
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, os.path.join(path, "agent.pt"))
+
+        self.last_checkpoint_iter = self.training_log["iter"]
+        print(
+            f"Saved checkpoint to {path} at {self.training_log['iter']}"
+            + f" in {time.time() - start_time:.1f}s"
+        )
+
+    def load_checkpoint(self, path):
+        """Resume from a checkpoint written by save_checkpoint.
+
+        The agent must be compiled with the same network, optimizer and
+        memory configuration as the one that saved it. Raises
+        RuntimeError if the memory does not match agent.pt, i.e. the
+        save that wrote it was interrupted.
+        """
+        state = torch.load(
+            os.path.join(path, "agent.pt"), map_location=self.device, weights_only=False
+        )
+        self.Q.load_state_dict(state["Q"])
+        self.Q_target.load_state_dict(state["Q_target"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.training_log = state["training_log"]
+        if state["policy"] is not None:
+            self.policy.load_state_dict(state["policy"])
+        np.random.set_state(state["numpy_rng"])
+        torch.set_rng_state(state["torch_rng"])
+
+        self.memory.load_checkpoint(os.path.join(path, "memory"))
+        if self.memory.total_steps != state["memory_steps"]:
+            raise RuntimeError(
+                f"Replay memory in {path} holds {self.memory.total_steps} steps"
+                + f" but agent.pt expects {state['memory_steps']}; the"
+                + " checkpoint was interrupted while saving"
+            )
+        self.last_checkpoint_iter = self.training_log["iter"]
+        print(f"Resumed from {path} at {self.training_log['iter']}")
+
     def load_model(self, ckpt_path):
         self.Q.load_state_dict(torch.load(ckpt_path))
         self.Q_target.load_state_dict(torch.load(ckpt_path))
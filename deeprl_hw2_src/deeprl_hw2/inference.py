@@ -0,0 +1,123 @@
+"""Low-latency Q-network inference for acting."""
+
+import numpy as np
+import torch
+
+from deeprl_hw2 import utils
+
+BACKENDS = ("eager", "compile")
+
+
+class InferenceEngine:
+    """Runs a Q-network on uint8 frame stacks and picks actions.
+
+    Acting only ever needs a handful of states at a time, so the cost
+    is dominated by per-call overhead rather than compute. The engine
+    copies the states into a persistent uint8 input buffer on the
+    device, converts them to float in a second persistent buffer, runs
+    the network under torch.inference_mode and does the epsilon-greedy
+    choice on the torch side, so only the chosen actions come back to
+    NumPy.
+
+    The network runs as is ("eager", the default) or compiled with
+    torch.compile ("compile"). The compiled module keeps sharing the
+    parameters of the model, so in-place weight updates (optimizer
+    steps, load_state_dict, the target network updates in utils) are
+    seen without rebuilding the engine. Compiling takes a while on the
+    first calls and mostly pays off on a GPU, where fusing the
+    network's kernels cuts the launch overhead of every step; on a CPU
+    it can be slower than eager. In debug mode the module always runs
+    eagerly so its checks still run.
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+      The Q-network, already on device.
+    state_shape: tuple(int)
+      Shape of one state, e.g. (window, 84, 84).
+    device: torch.device
+      Device of the model.
+    backend: str, optional
+      One of BACKENDS.
+    batch_size: int, optional
+      Initial capacity of the input buffers. They grow on demand.
+    """
+
+    def __init__(self, model, state_shape, device, backend="eager", batch_size=1):
+        assert backend in BACKENDS, f"Unknown inference backend {backend}"
+        self.model = model
+        self.state_shape = tuple(state_shape)
+        self.device = device
+        self.backend = backend
+        self.pin_memory = device.type == "cuda"
+
+        self._allocate_buffers(batch_size)
+        self.forward = self._build_forward()
+
+    def _allocate_buffers(self, batch_size):
+        shape = (batch_size, *self.state_shape)
+        self.staging = torch.empty(shape, dtype=torch.uint8, pin_memory=self.pin_memory)
+        self.input = torch.empty(shape, dtype=torch.uint8, device=self.device)
+        self.float_input = torch.empty(shape, dtype=torch.float32, device=self.device)
+
+    def _build_forward(self):
+        if utils.DEBUG or self.backend == "eager":
+            return self.model
+        return torch.compile(self.model, dynamic=True)
+
+    def _load(self, states):
+        """Copy a batch of uint8 states into the input buffers."""
+        batch_size = len(states)
+        if batch_size > len(self.input):
+            self._allocate_buffers(batch_size)
+
+        staging = self.staging[:batch_size]
+        staging.copy_(torch.from_numpy(np.ascontiguousarray(states)))
+        self.input[:batch_size].copy_(staging, non_blocking=True)
+
+        float_input = self.float_input[:batch_size]
+        float_input.copy_(self.input[:batch_size]).div_(255.0)
+        return float_input
+
+    def q_values(self, states):
+        """Return the Q-values of a batch of uint8 states.
+
+        Parameters
+        ----------
+        states: np.ndarray
+          uint8 array of shape (B, *state_shape).
+
+        Returns
+        -------
+        torch.Tensor
+          (B, A) Q-values on the device.
+        """
+        with torch.inference_mode():
+            return self.forward(self._load(states))
+
+    def select_actions(self, states, epsilon=0.0):
+        """Pick an epsilon-greedy action for every state.
+
+        Parameters
+        ----------
+        states: np.ndarray
+          uint8 array of shape (B, *state_shape).
+        epsilon: float, optional
+          Probability of a uniformly random action.
+
+        Returns
+        -------
+        np.ndarray
+          The (B,) chosen actions.
+        """
+        with torch.inference_mode():
+            q_values = self.forward(self._load(states))
+            actions = torch.argmax(q_values, dim=1)
+            if epsilon > 0:
+                batch_size, num_actions = q_values.shape
+                explore = torch.rand(batch_size, device=self.device) < epsilon
+                random_actions = torch.randint(
+                    num_actions, (batch_size,), device=self.device
+                )
+                actions = torch.where(explore, random_actions, actions)
+            return actions.cpu().numpy()
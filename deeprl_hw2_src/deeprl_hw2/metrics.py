@@ -0,0 +1,212 @@
+"""Cheap training metrics: device-side accumulators and local logs."""
+
+import csv
+import os
+import time
+
+import torch
+
+
+class MetricsAccumulator:
+    """Running means of training metrics kept on the device.
+
+    Calling loss.item() or q_values.cpu() after every update forces the
+    host to wait for the device each time. Instead, add puts the sum
+    and element count of each value into device tensors without
+    synchronizing, and flush copies all the sums to the host in one
+    non-blocking transfer (into pinned memory on a GPU). collect waits
+    for the transfer and returns the means, so the host only
+    synchronizes once per flush.
+
+    Parameters
+    ----------
+    device: torch.device
+      Device the metrics are computed on.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.pin_memory = device.type == "cuda"
+        self.sums = {}
+        self.counts = {}
+        self.pending = None
+
+    def add(self, name, value):
+        """Add every element of a tensor to the running mean of name."""
+        value = value.detach()
+        if name not in self.sums:
+            self.sums[name] = torch.zeros((), dtype=torch.float64, device=self.device)
+            self.counts[name] = 0
+        self.sums[name] += value.sum()
+        self.counts[name] += value.numel()
+
+    def __len__(self):
+        return len(self.sums)
+
+    def flush(self):
+        """Start copying the running means to the host and reset them."""
+        names = [name for name in self.sums if self.counts[name] > 0]
+        if not names:
+            self.pending = ({}, None, None)
+            return
+
+        sums = torch.stack([self.sums[name] for name in names])
+        host_sums = torch.empty(
+            sums.shape, dtype=sums.dtype, pin_memory=self.pin_memory
+        )
+        host_sums.copy_(sums, non_blocking=True)
+        event = None
+        if self.pin_memory:
+            event = torch.cuda.Event()
+            event.record()
+
+        counts = {name: self.counts[name] for name in names}
+        self.pending = (counts, host_sums, event)
+        self.sums = {}
+        self.counts = {}
+
+    def collect(self):
+        """Wait for the last flush and return its means by name."""
+        if self.pending is None:
+            return {}
+        counts, host_sums, event = self.pending
+        self.pending = None
+        if event is not None:
+            event.synchronize()
+        return {
+            name: host_sums[i].item() / count
+            for i, (name, count) in enumerate(counts.items())
+        }
+
+
+class ThroughputMeter:
+    """Counts environment steps and updates per second between reports."""
+
+    def __init__(self):
+        self.last_time = time.time()
+        self.last_env_steps = 0
+        self.last_updates = 0
+
+    def reset(self, env_steps=0, updates=0):
+        """Start measuring from the given totals."""
+        self.last_time = time.time()
+        self.last_env_steps = env_steps
+        self.last_updates = updates
+
+    def rates(self, env_steps, updates):
+        """Return the rates since the previous call given the totals.
+
+        Returns
+        -------
+        dict
+          "Env steps/sec" and "Updates/sec".
+        """
+        now = time.time()
+        elapsed = max(now - self.last_time, 1e-9)
+        rates = {
+            "Env steps/sec": (env_steps - self.last_env_steps) / elapsed,
+            "Updates/sec": (updates - self.last_updates) / elapsed,
+        }
+        self.reset(env_steps, updates)
+        return rates
+
+
+class LocalLogger:
+    """Writes log entries to a local CSV or Parquet file.
+
+    A file-based alternative to wandb. Entries are kept in a ring
+    buffer of buffer_size rows that is written out whenever it fills
+    up and on flush/close, so logging an entry never touches the disk.
+
+    CSV entries are appended to `metrics.csv`; if an entry brings new
+    keys, the file is rewritten once with the wider header. Parquet
+    output needs pyarrow and writes every batch of rows as its own
+    `metrics-<part>.parquet` file, which pyarrow/pandas read back as
+    one dataset.
+
+    Parameters
+    ----------
+    log_dir: str
+      Directory to write to.
+    log_format: str, optional
+      "csv" or "parquet".
+    buffer_size: int, optional
+      Number of entries buffered before writing.
+    """
+
+    def __init__(self, log_dir, log_format="csv", buffer_size=1000):
+        assert log_format in ("csv", "parquet"), f"Unknown log format {log_format}"
+        if log_format == "parquet":
+            import pyarrow  # noqa: F401, fail early if it is missing
+
+        self.log_dir = log_dir
+        self.log_format = log_format
+        os.makedirs(log_dir, exist_ok=True)
+
+        self.rows = [None] * buffer_size
+        self.num_rows = 0
+        self.fieldnames = []
+        self.num_parts = 0
+
+        # Keep appending to the logs of a resumed run
+        csv_path = os.path.join(log_dir, "metrics.csv")
+        if log_format == "csv" and os.path.exists(csv_path):
+            with open(csv_path, newline="") as f:
+                self.fieldnames = next(csv.reader(f), [])
+        while os.path.exists(
+            os.path.join(log_dir, f"metrics-{self.num_parts:05d}.parquet")
+        ):
+            self.num_parts += 1
+
+    def log(self, entry):
+        """Buffer one entry, writing the buffer out once it is full."""
+        self.rows[self.num_rows] = dict(entry)
+        self.num_rows += 1
+        if self.num_rows == len(self.rows):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered entries."""
+        if self.num_rows == 0:
+            return
+        rows = self.rows[: self.num_rows]
+        if self.log_format == "csv":
+            self._write_csv(rows)
+        else:
+            self._write_parquet(rows)
+        self.rows[: self.num_rows] = [None] * self.num_rows
+        self.num_rows = 0
+
+    def _write_csv(self, rows):
+        path = os.path.join(self.log_dir, "metrics.csv")
+        new_fields = [
+            key for row in rows for key in row if key not in self.fieldnames
+        ]
+        new_fields = list(dict.fromkeys(new_fields))
+
+        if new_fields and self.fieldnames:
+            # Widen the header of what was written so far
+            with open(path, newline="") as f:
+                rows = list(csv.DictReader(f)) + rows
+            mode = "w"
+        else:
+            mode = "a"
+        self.fieldnames += new_fields
+
+        with open(path, mode, newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=self.fieldnames, restval="")
+            if mode == "w" or f.tell() == 0:
+                writer.writeheader()
+            writer.writerows(rows)
+
+    def _write_parquet(self, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        path = os.path.join(self.log_dir, f"metrics-{self.num_parts:05d}.parquet")
+        pq.write_table(pa.Table.from_pylist(rows), path)
+        self.num_parts += 1
+
+    def close(self):
+        """Write whatever is still buffered."""
+        self.flush()
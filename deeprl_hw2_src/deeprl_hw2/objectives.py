@@ -44,11 +44,12 @@ def huber_loss(y_true, y_pred, max_grad=1.0):
     return loss
 
 
-def mean_huber_loss(y_true, y_pred, max_grad=1.0):
+def mean_huber_loss(y_true, y_pred, max_grad=1.0, weights=None):
     """Return mean huber loss.
 
     Same as huber_loss, but takes the mean over all values in the
-    output tensor.
+    output tensor. If weights are given (e.g. importance-sampling
+    weights from prioritized replay), the mean is weighted.
 
     Parameters
     ----------
@@ -59,6 +60,8 @@ def mean_huber_loss(y_true, y_pred, max_grad=1.0):
     max_grad: float, optional
       Positive floating point value. Represents the maximum possible
       gradient magnitude.
+    weights: torch.Tensor, optional
+      Per-sample weights with the same shape as y_true.
 
     Returns
     -------
@@ -67,4 +70,8 @@ def mean_huber_loss(y_true, y_pred, max_grad=1.0):
     """
     batch_loss = huber_loss(y_true, y_pred, max_grad)
 
+    if weights is not None:
+        assert weights.shape == batch_loss.shape
+        batch_loss = weights * batch_loss
+
     return torch.mean(batch_loss)
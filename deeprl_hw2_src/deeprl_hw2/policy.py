@@ -159,7 +159,15 @@ class LinearDecayGreedyEpsilonPolicy(Policy):
         Any:
           Selected action.
         """
+        self.step(is_training=is_training, agent_step=agent_step)
+        return self.policy.select_action(self.policy, q_values, **kwargs)
+
+    def step(self, is_training=True, agent_step=None):
+        """Decay the parameter by one step and return its new value.
 
+        Used on its own by agents that pick the action themselves,
+        e.g. deeprl_hw2.inference.InferenceEngine.
+        """
         if agent_step is not None:
             self.current_step = agent_step
 
@@ -180,9 +188,21 @@ class LinearDecayGreedyEpsilonPolicy(Policy):
         else:
             # Reduce to GreedyPolicy
             setattr(self.policy, self.attr_name, 0)
-        return self.policy.select_action(self.policy, q_values, **kwargs)
+        return getattr(self.policy, self.attr_name)
 
     def reset(self):
         """Start the decay over at the start value."""
         self.current_step = 0
         setattr(self.policy, self.attr_name, self.start_value)
+
+    def state_dict(self):
+        """Return the decay position, e.g. for checkpointing."""
+        return {
+            "current_step": self.current_step,
+            "value": getattr(self.policy, self.attr_name),
+        }
+
+    def load_state_dict(self, state):
+        """Resume the decay from a state_dict."""
+        self.current_step = state["current_step"]
+        setattr(self.policy, self.attr_name, state["value"])
@@ -0,0 +1,165 @@
+"""Background minibatch prefetching for the learner."""
+
+import queue
+import threading
+
+import numpy as np
+import torch
+
+from deeprl_hw2.core import PrioritizedReplayMemory
+
+BATCH_FIELDS = (
+    "states",
+    "actions",
+    "rewards",
+    "next_states",
+    "dones",
+    "weights",
+    "indices",
+)
+
+
+class BatchPrefetcher:
+    """Samples the next minibatches while the learner is busy.
+
+    A worker thread samples up to num_prefetch minibatches ahead from
+    the replay memory and copies each into one of num_prefetch + 1
+    reusable staging slots. The slots are pinned when training on a GPU
+    so the host-to-device copy is asynchronous. The learner gets the
+    batch as tensors on its device, with uint8 frames converted to
+    float32 in [0, 1] by torch rather than NumPy, so it never touches
+    NumPy arrays itself.
+
+    A slot is handed back to the worker when the learner asks for the
+    next batch, so a batch stays valid until then.
+
+    The worker draws its indices from its own np.random.Generator, so
+    it never races the main thread for the global NumPy RNG. With a
+    PrioritizedReplayMemory, a batch is sampled up to num_prefetch
+    updates before it is used, so its importance-sampling weights and
+    the priorities it was drawn with miss the updates made meanwhile.
+    Keep num_prefetch small with prioritized replay.
+
+    Parameters
+    ----------
+    memory: deeprl_hw2.core.ReplayMemory
+      Memory to sample from. Sampled frames must be uint8.
+    batch_size: int
+      How many samples in each minibatch.
+    device: torch.device
+      Device the learner trains on.
+    num_prefetch: int, optional
+      How many minibatches to sample ahead.
+    seed: int, optional
+      Seed of the worker's random generator.
+    """
+
+    def __init__(self, memory, batch_size, device, num_prefetch=2, seed=None):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.device = device
+        self.rng = np.random.default_rng(seed)
+        self.prioritized = isinstance(memory, PrioritizedReplayMemory)
+        self.pin_memory = device.type == "cuda"
+
+        # Held while sampling; writers to the memory should hold it too
+        self.lock = threading.Lock()
+
+        self.slots = [self._allocate_slot() for _ in range(num_prefetch + 1)]
+        self.free_slots = queue.Queue()
+        self.ready_slots = queue.Queue()
+        for slot_id in range(len(self.slots)):
+            self.free_slots.put(slot_id)
+        self.current_slot = None
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _allocate_slot(self):
+        """Allocate reusable host tensors for one minibatch."""
+        frames_shape = (
+            self.batch_size,
+            self.memory.window_length,
+            *self.memory.state_shape,
+        )
+
+        def empty(shape, dtype):
+            return torch.empty(shape, dtype=dtype, pin_memory=self.pin_memory)
+
+        slot = {
+            "states": empty(frames_shape, torch.uint8),
+            "actions": empty((self.batch_size,), torch.long),
+            "rewards": empty((self.batch_size,), torch.float32),
+            "next_states": empty(frames_shape, torch.uint8),
+            "dones": empty((self.batch_size,), torch.float32),
+            "weights": empty((self.batch_size,), torch.float32),
+            "indices": None,
+            # Marks when the device copies out of this slot are done
+            "event": torch.cuda.Event() if self.pin_memory else None,
+        }
+        return slot
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                slot_id = self.free_slots.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            with self.lock:
+                batch = self.memory.sample(self.batch_size, rng=self.rng)
+
+            slot = self.slots[slot_id]
+            if slot["event"] is not None:
+                slot["event"].synchronize()
+
+            for name, array in zip(BATCH_FIELDS, batch):
+                if name == "indices":
+                    slot["indices"] = array
+                else:
+                    # copy_ also casts, e.g. bool dones to float32
+                    slot[name].copy_(torch.from_numpy(np.asarray(array)))
+            if not self.prioritized:
+                slot["weights"].fill_(1.0)
+
+            self.ready_slots.put(slot_id)
+
+    def get(self):
+        """Return the next minibatch as tensors on the learner's device.
+
+        Returns
+        -------
+        states, actions, rewards, next_states, dones, weights, indices
+          weights are all ones and indices None unless the memory is
+          prioritized.
+        """
+        if self.current_slot is not None:
+            self.free_slots.put(self.current_slot)
+        self.current_slot = self.ready_slots.get()
+        slot = self.slots[self.current_slot]
+
+        batch = {
+            name: slot[name].to(self.device, non_blocking=True)
+            for name in BATCH_FIELDS
+            if name != "indices"
+        }
+        if slot["event"] is not None:
+            slot["event"].record()
+
+        states = batch["states"].float().div_(255.0)
+        next_states = batch["next_states"].float().div_(255.0)
+        return (
+            states,
+            batch["actions"],
+            batch["rewards"],
+            next_states,
+            batch["dones"],
+            batch["weights"],
+            slot["indices"],
+        )
+
+    def close(self):
+        """Stop the worker thread."""
+        self.stop_event.set()
+        self.thread.join()
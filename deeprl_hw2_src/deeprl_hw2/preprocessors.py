@@ -1,13 +1,31 @@
 """Suggested Preprocessors."""
 
 import numpy as np
-from PIL import Image
 import copy
 
 from deeprl_hw2 import utils
 from deeprl_hw2.core import Preprocessor
 
 FRAME_SHAPE = (84, 84)
+ATARI_SHAPE = (210, 160)
+
+# ITU-R 601-2 luma weights, the same ones PIL uses for convert("L")
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def area_resize_weights(in_size, out_size):
+    """Return the (out_size, in_size) matrix of area-resampling weights.
+
+    Row i averages the input pixels overlapping output pixel i, each
+    weighted by the length of the overlap, so that
+    weights @ image @ weights.T resizes a 2D image.
+    """
+    scale = in_size / out_size
+    lo = np.arange(out_size)[:, np.newaxis] * scale
+    hi = lo + scale
+    pixels = np.arange(in_size)[np.newaxis, :]
+    overlap = np.minimum(hi, pixels + 1) - np.maximum(lo, pixels)
+    return (np.clip(overlap, 0, None) / scale).astype(np.float32)
 
 
 # Not used
@@ -96,14 +114,38 @@ class AtariPreprocessor(Preprocessor):
     new_size: 2 element tuple
       The size that each image in the state should be scaled to. e.g
       (84, 84) will make each image in the output have shape (84, 84).
+    window: int
+      Number of past frames stacked into a state.
     """
 
     def __init__(self, new_size, window=4):
         self.new_size = new_size
         self.window = window
 
-        # Store past frames to stack
-        self.past_frames = [np.zeros(new_size, dtype=np.uint8) for _ in range(window)]
+        # Precomputed area-resampling weights for rows and columns
+        self.row_weights = area_resize_weights(ATARI_SHAPE[0], new_size[0])
+        self.col_weights_t = area_resize_weights(ATARI_SHAPE[1], new_size[1]).T
+
+        # Store past frames to stack in a circular buffer. Every frame
+        # is written twice, window apart, so the last window frames are
+        # always one contiguous slice
+        self.past_frames = np.zeros((2 * window, *new_size), dtype=np.uint8)
+        self.frame_index = 0
+
+    def resize_frames(self, frames):
+        """Convert frames to greyscale, then downscale them.
+
+        Works on a single (210, 160, 3) frame or a batch of shape
+        (N, 210, 160, 3) and returns uint8 frames of shape new_size
+        (or (N, *new_size)). Frames that are already greyscale, i.e.
+        (210, 160) or (N, 210, 160), are only downscaled.
+        """
+        if frames.shape[-2:] == ATARI_SHAPE:
+            grey = frames.astype(np.float32)
+        else:
+            grey = frames.astype(np.float32) @ LUMA_WEIGHTS  # (..., 210, 160)
+        resized = self.row_weights @ grey @ self.col_weights_t  # (..., H, W)
+        return np.rint(resized).astype(np.uint8)
 
     def process_state_for_memory(self, state):
         """Scale, convert to greyscale and store as uint8.
@@ -112,32 +154,27 @@ class AtariPreprocessor(Preprocessor):
         memory. We get the same resolution as uint8, but use a quarter
         to an eigth of the bytes (depending on float32 or float64)
 
-        We recommend using the Python Image Library (PIL) to do the
-        image conversions.
+        Converts to greyscale before resizing (so only one channel is
+        resampled) and resizes with precomputed area weights instead of
+        a PIL round trip.
         """
-        # assuming state is an image (210, 160, 3)
+        # assuming state is an image (210, 160, 3) or (210, 160)
 
         # Shape check
-        assert state.shape == (210, 160, 3)
-
-        # Let us process with Image module
-        img = Image.fromarray(state)
+        if utils.DEBUG:
+            assert state.shape in ((*ATARI_SHAPE, 3), ATARI_SHAPE)
 
-        # rescale the image
-        img = img.resize(self.new_size)
-
-        # convert to greyscale
-        img = img.convert("L")
-
-        # convert to numpy array
-        processed_state = np.array(img, dtype=np.uint8)
+        processed_state = self.resize_frames(state)
 
         # update the past frames
-        self.past_frames.append(processed_state)
-        self.past_frames.pop(0)
-
-        stacked_frames = np.stack(self.past_frames, axis=0)
-        assert stacked_frames.shape == (self.window, *self.new_size)
+        index = self.frame_index
+        self.past_frames[index] = processed_state
+        self.past_frames[index + self.window] = processed_state
+        self.frame_index = (index + 1) % self.window
+
+        stacked_frames = self.past_frames[index + 1 : index + 1 + self.window].copy()
+        if utils.DEBUG:
+            assert stacked_frames.shape == (self.window, *self.new_size)
         return stacked_frames
 
     def process_state_for_network(self, state):
@@ -147,15 +184,16 @@ class AtariPreprocessor(Preprocessor):
         outputs float32 images.
         """
 
-        # Assume stacked frames
-        # Shape check
-        assert state.shape == (self.window, *self.new_size)
+        if utils.DEBUG:
+            # Assume stacked frames
+            # Shape check
+            assert state.shape == (self.window, *self.new_size)
 
-        # Data type check
-        assert state.dtype == np.uint8
+            # Data type check
+            assert state.dtype == np.uint8
 
-        # Check not normalized
-        assert np.max(state) > 1  # Dont normalize twice
+            # Check not normalized
+            assert np.max(state) > 1  # Dont normalize twice
 
         # convert to numpy array
         processed_state = np.array(state, dtype=np.float32) / 255.0
@@ -172,14 +210,15 @@ class AtariPreprocessor(Preprocessor):
 
         # Accept stacked samples
 
-        # Shape check
-        assert samples.shape[1:] == (self.window, *self.new_size)
+        if utils.DEBUG:
+            # Shape check
+            assert samples.shape[1:] == (self.window, *self.new_size)
 
-        # Data type check
-        assert samples.dtype == np.uint8
+            # Data type check
+            assert samples.dtype == np.uint8
 
-        # Check not normalized
-        assert np.max(samples) > 1
+            # Check not normalized
+            assert np.max(samples) > 1
 
         # convert to numpy array
         processed_samples = np.array(samples, dtype=np.float32) / 255.0
@@ -191,9 +230,68 @@ class AtariPreprocessor(Preprocessor):
 
     def reset(self):
         # Clear past frames
-        self.past_frames = [
-            np.zeros(self.new_size, dtype=np.uint8) for _ in range(self.window)
-        ]
+        self.past_frames[:] = 0
+        self.frame_index = 0
+
+
+class VectorAtariPreprocessor(AtariPreprocessor):
+    """AtariPreprocessor keeping one frame history per environment.
+
+    Processes the observations of all environments of a vectorized env
+    in one batched greyscale-and-resize call.
+
+    Parameters
+    ----------
+    new_size: 2 element tuple
+      The size that each image in the state should be scaled to.
+    window: int
+      Number of past frames stacked into a state.
+    num_envs: int
+      Number of environments.
+    """
+
+    def __init__(self, new_size, window=4, num_envs=1):
+        super().__init__(new_size, window)
+        self.num_envs = num_envs
+        self.past_frames = np.zeros(
+            (num_envs, 2 * window, *new_size), dtype=np.uint8
+        )
+        self.frame_index = np.zeros(num_envs, dtype=np.int64)
+        self.env_index = np.arange(num_envs)
+
+    def process_state_for_memory(self, state):
+        """Process a (num_envs, 210, 160[, 3]) batch into stacked uint8 states."""
+        if utils.DEBUG:
+            assert state.shape in (
+                (self.num_envs, *ATARI_SHAPE, 3),
+                (self.num_envs, *ATARI_SHAPE),
+            )
+
+        processed_state = self.resize_frames(state)
+
+        # update the past frames of every env
+        index = self.frame_index
+        self.past_frames[self.env_index, index] = processed_state
+        self.past_frames[self.env_index, index + self.window] = processed_state
+        self.frame_index = (index + 1) % self.window
+
+        # (num_envs, window) gather of the newest window frames
+        offsets = index[:, np.newaxis] + 1 + np.arange(self.window)
+        stacked_frames = self.past_frames[self.env_index[:, np.newaxis], offsets]
+        if utils.DEBUG:
+            assert stacked_frames.shape == (
+                self.num_envs,
+                self.window,
+                *self.new_size,
+            )
+        return stacked_frames
+
+    def reset(self, env_indices=None):
+        """Clear the history of the given envs (all envs by default)."""
+        if env_indices is None:
+            env_indices = self.env_index
+        self.past_frames[env_indices] = 0
+        self.frame_index[env_indices] = 0
 
 
 # Not used
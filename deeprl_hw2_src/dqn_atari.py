@@ -58,7 +58,8 @@ def create_model(window, num_actions, model_type="cnn", model_name="q_network"):
             self.fc = nn.Linear(window * 84 * 84, num_actions)
 
         def forward(self, x):
-            assert torch.max(x) <= 1.0 and torch.max(x) >= 1 / 255.0
+            if tfrl.utils.DEBUG:
+                assert torch.max(x) <= 1.0 and torch.max(x) >= 1 / 255.0
             if x.ndim > 3:
                 x = x.flatten(start_dim=1, end_dim=-1)
             return self.fc(x)
@@ -76,7 +77,8 @@ def create_model(window, num_actions, model_type="cnn", model_name="q_network"):
             self.fc2 = nn.Linear(512, num_actions)
 
         def forward(self, x):
-            assert torch.max(x) <= 1.0 and torch.max(x) >= 1 / 255.0
+            if tfrl.utils.DEBUG:
+                assert torch.max(x) <= 1.0 and torch.max(x) >= 1 / 255.0
             x = F.leaky_relu(self.conv1(x))
             x = F.leaky_relu(self.conv2(x))
             x = F.leaky_relu(self.conv3(x))
@@ -106,7 +108,8 @@ def create_model(window, num_actions, model_type="cnn", model_name="q_network"):
             self.advantage_head = nn.Linear(512, num_actions)
 
         def forward(self, x):
-            assert torch.max(x) <= 1.0 and torch.max(x) >= 1 / 255.0
+            if tfrl.utils.DEBUG:
+                assert torch.max(x) <= 1.0 and torch.max(x) >= 1 / 255.0
             x = F.leaky_relu(self.conv1(x))
             x = F.leaky_relu(self.conv2(x))
             x = F.leaky_relu(self.conv3(x))
@@ -184,8 +187,116 @@ def main():
     parser.add_argument("--wandb", action="store_true", help="Report to WanDB")
     parser.add_argument("--ddqn", action="store_true", help="Use DDQN?")
     parser.add_argument("--type", default="cnn", help="Linear or CNN")
+    parser.add_argument(
+        "--debug", action="store_true", help="Check shapes and ranges every step"
+    )
+    parser.add_argument(
+        "--n_step", default=1, type=int, help="Steps per bootstrapped return"
+    )
+    parser.add_argument(
+        "--num_envs", default=1, type=int, help="Environments stepped in lockstep"
+    )
+    parser.add_argument(
+        "--async_envs", action="store_true", help="Step each env in a subprocess"
+    )
+    parser.add_argument(
+        "--apex_actors",
+        default=0,
+        type=int,
+        help="Train with this many asynchronous actor processes",
+    )
+    parser.add_argument(
+        "--num_prefetch",
+        default=0,
+        type=int,
+        help="Minibatches sampled ahead in a background thread",
+    )
+    parser.add_argument(
+        "--eval_num_envs",
+        default=1,
+        type=int,
+        help="Vectorized environments used by the periodic evaluation",
+    )
+    parser.add_argument(
+        "--eval_async",
+        action="store_true",
+        help="Evaluate in a separate process while training continues",
+    )
+    parser.add_argument(
+        "--episode_memory",
+        action="store_true",
+        help="Use the episode-indexed replay memory",
+    )
+    parser.add_argument(
+        "--per", action="store_true", help="Use prioritized experience replay"
+    )
+    parser.add_argument(
+        "--memmap_dir", default=None, help="Store the replay memory on disk here"
+    )
+    parser.add_argument(
+        "--resume_memory",
+        action="store_true",
+        help="Reuse memory in --memmap_dir",
+    )
+    parser.add_argument(
+        "--tau",
+        default=None,
+        type=float,
+        help="Soft-update the target network with this tau every update",
+    )
+    parser.add_argument(
+        "--inference",
+        default="eager",
+        choices=tfrl.inference.BACKENDS,
+        help="How the networks are run when acting",
+    )
+    parser.add_argument(
+        "--log_format",
+        default=None,
+        choices=["csv", "parquet"],
+        help="Also log to a local file in the output folder",
+    )
+    parser.add_argument(
+        "--print_freq", default=1, type=int, help="Episodes between log lines"
+    )
+    parser.add_argument(
+        "--obs_type",
+        default="rgb",
+        choices=["rgb", "grayscale"],
+        help="Frames emitted by ALE",
+    )
+    parser.add_argument(
+        "--env_backend",
+        default="gym",
+        choices=["gym", "ale"],
+        help="Vectorize --num_envs with gymnasium or natively in ALE",
+    )
+    parser.add_argument(
+        "--checkpoint_dir", default=None, help="Save resumable checkpoints here"
+    )
+    parser.add_argument(
+        "--checkpoint_freq",
+        default=int(1e5),
+        type=int,
+        help="Iterations between checkpoints",
+    )
+    parser.add_argument(
+        "--resume", default=None, help="Resume training from this checkpoint"
+    )
 
     args = parser.parse_args()
+    # Each of these selects its own replay memory, and they do not combine
+    memory_flags = {
+        "--apex_actors": args.apex_actors > 0,
+        "--num_envs": args.num_envs > 1,
+        "--memmap_dir": args.memmap_dir is not None,
+        "--per": args.per,
+        "--episode_memory": args.episode_memory,
+    }
+    selected = [flag for flag, is_set in memory_flags.items() if is_set]
+    if len(selected) > 1:
+        parser.error(f"{' and '.join(selected)} select different replay memories")
+    tfrl.utils.set_debug(args.debug or tfrl.utils.DEBUG)
     args.output = get_output_folder(
         args.output, f"{args.env}-{args.type}-{'ddqn' if args.ddqn else 'dqn'}"
     )
@@ -208,13 +319,59 @@ def main():
     n_steps = int(1e6)
     max_size = int(1e6)
     batchsize = 32
-    target_update_frequency = int(1e4)
+    target_update_frequency = int(1e4) if args.tau is None else args.tau
     lr = 1e-4
     warm_up = int(5e4)
 
     # Create environment
     gym.register_envs(ale_py)
-    env = tfrl.utils.AtariWrapper(gym.make(args.env))
+    env = tfrl.utils.make_atari_env(args.env, obs_type=args.obs_type)
+
+    if args.apex_actors > 0:
+        memory = tfrl.apex.make_apex_memory(
+            args.apex_actors,
+            max_size,
+            window,
+            state_shape=input_shape,
+            n_step=args.n_step,
+            gamma=gamma,
+        )
+    elif args.num_envs > 1:
+        memory = tfrl.core.VectorReplayMemory(
+            args.num_envs,
+            max_size,
+            window,
+            state_shape=input_shape,
+            n_step=args.n_step,
+            gamma=gamma,
+        )
+    elif args.memmap_dir is not None:
+        memory = tfrl.core.MemmapReplayMemory(
+            max_size,
+            window,
+            state_shape=input_shape,
+            path=args.memmap_dir,
+            resume=args.resume_memory,
+            n_step=args.n_step,
+            gamma=gamma,
+        )
+    elif args.per:
+        memory = tfrl.core.PrioritizedReplayMemory(
+            max_size,
+            window,
+            state_shape=input_shape,
+            beta_steps=n_steps // 4,
+            n_step=args.n_step,
+            gamma=gamma,
+        )
+    elif args.episode_memory:
+        memory = tfrl.core.EpisodeReplayMemory(
+            max_size, window, state_shape=input_shape, n_step=args.n_step, gamma=gamma
+        )
+    else:
+        memory = tfrl.core.ReplayMemory(
+            max_size, window, state_shape=input_shape, n_step=args.n_step, gamma=gamma
+        )
 
     method_name = "DDQN" if args.ddqn else "DQN"
     model_name = args.type.upper()
@@ -225,18 +382,48 @@ def main():
             tfrl.policy.GreedyEpsilonPolicy, "epsilon", 1.0, 0.1, max_size
         ),
         preprocessor=AtariPreprocessor(input_shape, window=window),
-        memory=tfrl.core.ReplayMemory(max_size, window, state_shape=input_shape),
+        memory=memory,
         gamma=gamma,
         target_update_freq=target_update_frequency,
         train_freq=4,
         num_burn_in=warm_up,
         batch_size=batchsize,
         ddqn=args.ddqn,
+        num_prefetch=args.num_prefetch,
+        eval_num_envs=args.eval_num_envs,
+        eval_async=args.eval_async,
         use_wandb=args.wandb,
         wandb_name=session_name,
+        checkpoint_dir=args.checkpoint_dir,
+        checkpoint_freq=args.checkpoint_freq,
+        inference_backend=args.inference,
+        log_dir=args.output if args.log_format else None,
+        log_format=args.log_format or "csv",
+        print_freq=args.print_freq,
     )
     agent.compile(optimizer=torch.optim.Adam, loss_func=mean_huber_loss, lr=lr)
-    training_log = agent.fit(env, num_iterations=n_steps)
+    if args.resume is not None:
+        agent.load_checkpoint(args.resume)
+    if args.apex_actors > 0:
+        training_log = tfrl.apex.fit_apex(
+            agent,
+            args.env,
+            args.apex_actors,
+            num_updates=n_steps // 4,
+            obs_type=args.obs_type,
+        )
+    elif args.num_envs > 1:
+        envs = tfrl.utils.make_vector_atari_env(
+            args.env,
+            args.num_envs,
+            asynchronous=args.async_envs,
+            obs_type=args.obs_type,
+            backend=args.env_backend,
+        )
+        training_log = agent.fit_vectorized(envs, num_iterations=n_steps, eval_env=env)
+        envs.close()
+    else:
+        training_log = agent.fit(env, num_iterations=n_steps)
     # Saving results
     np.save(os.path.join(args.output, "eval_rewards.npy"), training_log["eval_rewards"])
     np.save(
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def fill_memory():
+    """Return a function appending random frames with periodic episode ends."""
+
+    def fill(memory, num_samples, episode_length=7, seed=0):
+        rng = np.random.default_rng(seed)
+        for i in range(num_samples):
+            frame = rng.integers(2, 256, size=memory.state_shape, dtype=np.uint8)
+            done = (i + 1) % episode_length == 0
+            memory.append(frame, rng.integers(4), rng.standard_normal(), done)
+        return memory
+
+    return fill
+
+
+@pytest.fixture
+def make_agent():
+    """Return a function building a compiled DQNAgent with a tiny network."""
+    import torch
+    from torch import nn
+
+    from deeprl_hw2.dqn import DQNAgent
+    from deeprl_hw2.objectives import mean_huber_loss
+    from deeprl_hw2.policy import GreedyEpsilonPolicy
+    from deeprl_hw2.preprocessors import AtariPreprocessor
+
+    def make(memory, **kwargs):
+        num_inputs = memory.window_length * int(np.prod(memory.state_shape))
+        agent = DQNAgent(
+            q_network=lambda: nn.Sequential(nn.Flatten(), nn.Linear(num_inputs, 4)),
+            policy=GreedyEpsilonPolicy(0.1),
+            preprocessor=AtariPreprocessor(
+                memory.state_shape, window=memory.window_length
+            ),
+            memory=memory,
+            gamma=0.99,
+            target_update_freq=100,
+            train_freq=1,
+            num_burn_in=0,
+            batch_size=8,
+            **kwargs,
+        )
+        agent.compile(optimizer=torch.optim.Adam, loss_func=mean_huber_loss, lr=1e-4)
+        return agent
+
+    return make
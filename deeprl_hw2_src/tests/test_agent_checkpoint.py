@@ -0,0 +1,33 @@
+"""DQNAgent checkpoints refuse a replay memory from another save."""
+
+import os
+
+import pytest
+import torch
+
+from deeprl_hw2.core import ReplayMemory
+
+STATE_SHAPE = (4, 5)
+
+
+def test_agent_checkpoint_round_trip(fill_memory, make_agent, tmp_path):
+    agent = make_agent(fill_memory(ReplayMemory(100, 4, STATE_SHAPE), 60))
+    agent.save_checkpoint(str(tmp_path))
+
+    restored = make_agent(ReplayMemory(100, 4, STATE_SHAPE))
+    restored.load_checkpoint(str(tmp_path))
+    assert restored.memory.total_steps == 60
+    for p, q in zip(agent.Q.parameters(), restored.Q.parameters()):
+        assert torch.equal(p, q)
+
+
+def test_interrupted_agent_save_is_detected(fill_memory, make_agent, tmp_path):
+    agent = make_agent(fill_memory(ReplayMemory(100, 4, STATE_SHAPE), 60))
+    agent.save_checkpoint(str(tmp_path))
+    # A crash after the memory was saved but before agent.pt was replaced
+    fill_memory(agent.memory, 20, seed=1)
+    agent.memory.save_checkpoint(os.path.join(str(tmp_path), "memory"))
+
+    restored = make_agent(ReplayMemory(100, 4, STATE_SHAPE))
+    with pytest.raises(RuntimeError):
+        restored.load_checkpoint(str(tmp_path))
@@ -0,0 +1,81 @@
+"""Replay memory checkpoints restore the exact memory they saved."""
+
+import numpy as np
+import pytest
+
+from deeprl_hw2.core import MemmapReplayMemory, ReplayMemory
+
+STATE_SHAPE = (4, 5)
+
+
+def assert_same_memory(memory, restored):
+    for name in memory.CHUNKED_ARRAYS:
+        np.testing.assert_array_equal(getattr(restored, name), getattr(memory, name))
+    assert (restored.position, restored.size, restored.total_steps) == (
+        memory.position,
+        memory.size,
+        memory.total_steps,
+    )
+    np.random.seed(0)
+    expected = memory.sample(16)
+    np.random.seed(0)
+    for array, expected_array in zip(restored.sample(16), expected):
+        np.testing.assert_array_equal(array, expected_array)
+
+
+def test_checkpoint_round_trip(fill_memory, tmp_path):
+    memory = fill_memory(ReplayMemory(100, 4, STATE_SHAPE, n_step=3), 150)
+    memory.save_checkpoint(str(tmp_path), chunk_size=16)
+    # An incremental save after more appends only rewrites the dirty chunks
+    fill_memory(memory, 20, seed=1)
+    memory.save_checkpoint(str(tmp_path), chunk_size=16)
+
+    restored = ReplayMemory(100, 4, STATE_SHAPE, n_step=3)
+    restored.load_checkpoint(str(tmp_path))
+    assert_same_memory(memory, restored)
+
+
+def test_memmap_checkpoint_round_trip(fill_memory, tmp_path):
+    memory = fill_memory(
+        MemmapReplayMemory(100, 4, STATE_SHAPE, path=str(tmp_path / "a"), n_step=3),
+        150,
+    )
+    memory.save_checkpoint(str(tmp_path / "checkpoint"), chunk_size=16)
+
+    restored = MemmapReplayMemory(
+        100, 4, STATE_SHAPE, path=str(tmp_path / "b"), n_step=3
+    )
+    restored.load_checkpoint(str(tmp_path / "checkpoint"))
+    assert_same_memory(memory, restored)
+
+
+def test_memmap_checkpoint_ignores_later_appends(fill_memory, tmp_path):
+    memory = fill_memory(
+        MemmapReplayMemory(100, 4, STATE_SHAPE, path=str(tmp_path / "a")), 150
+    )
+    memory.save_checkpoint(str(tmp_path / "checkpoint"), chunk_size=16)
+    snapshot = ReplayMemory(100, 4, STATE_SHAPE)
+    snapshot.load_checkpoint(str(tmp_path / "checkpoint"))
+
+    # The memmap files move on, as they would until a crash
+    fill_memory(memory, 30, seed=1).flush()
+    restored = MemmapReplayMemory(100, 4, STATE_SHAPE, path=str(tmp_path / "b"))
+    restored.load_checkpoint(str(tmp_path / "checkpoint"))
+    assert_same_memory(snapshot, restored)
+
+
+def test_interrupted_save_keeps_the_previous_files(fill_memory, tmp_path, monkeypatch):
+    memory = fill_memory(ReplayMemory(100, 4, STATE_SHAPE), 150)
+    memory.save_checkpoint(str(tmp_path), chunk_size=16)
+    saved = {f.name: f.read_bytes() for f in tmp_path.iterdir()}
+    fill_memory(memory, 20, seed=1)
+
+    def save(f, array):
+        f.write(b"partial")
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(np, "save", save)
+    with pytest.raises(OSError):
+        memory.save_checkpoint(str(tmp_path), chunk_size=16)
+    files = {f.name: f.read_bytes() for f in tmp_path.iterdir()}
+    assert {name: files[name] for name in saved} == saved
@@ -0,0 +1,65 @@
+"""EpisodeReplayMemory batches against a per-step replay of the episodes."""
+
+import numpy as np
+import pytest
+
+from deeprl_hw2.core import EpisodeReplayMemory
+
+STATE_SHAPE = (4, 5)
+
+
+def record_episodes(memory, num_samples, episode_length=7):
+    """Append random transitions to memory and return them all."""
+    rng = np.random.default_rng(0)
+    frames = rng.integers(1, 256, size=(num_samples, *STATE_SHAPE), dtype=np.uint8)
+    rewards = rng.standard_normal(num_samples).astype(np.float32)
+    dones = (np.arange(num_samples) + 1) % episode_length == 0
+    for step in range(num_samples):
+        memory.append(frames[step], step % 4, rewards[step], dones[step])
+    return frames, rewards, dones
+
+
+def stacked_state_loop(memory, frames, dones, step):
+    """The state ending at an absolute step, one frame at a time."""
+    episode_start = 0
+    for earlier in range(step):
+        if dones[earlier]:
+            episode_start = earlier + 1
+    oldest = max(episode_start, memory.total_steps - memory.max_size)
+
+    state = np.zeros((memory.window_length, *STATE_SHAPE), dtype=np.uint8)
+    for k in range(memory.window_length):
+        frame_step = step - memory.window_length + 1 + k
+        if frame_step >= oldest:
+            state[k] = frames[frame_step]
+    return state
+
+
+# 60 appends stay within the buffer, 250 wrap it twice
+@pytest.mark.parametrize("num_samples", [60, 250])
+def test_n_step_batches_match_the_episodes(num_samples):
+    memory = EpisodeReplayMemory(100, 4, STATE_SHAPE, n_step=3, gamma=0.9)
+    frames, rewards, dones = record_episodes(memory, num_samples)
+
+    np.random.seed(0)
+    indices = memory._sample_indices(500)
+    states, actions, returns, next_states, batch_dones = memory._get_batch(indices)
+    for i, idx in enumerate(indices):
+        step = memory.steps[idx]
+        expected_return, done = 0.0, False
+        for k in range(memory.n_step):
+            expected_return += memory.gamma**k * rewards[step + k]
+            if dones[step + k]:
+                done = True
+                break
+        # The next state of an episode end is the state itself
+        next_step = step if done else step + memory.n_step
+
+        assert actions[i] == step % 4 and batch_dones[i] == done
+        np.testing.assert_allclose(returns[i], expected_return, atol=1e-5)
+        np.testing.assert_array_equal(
+            states[i], stacked_state_loop(memory, frames, dones, step)
+        )
+        np.testing.assert_array_equal(
+            next_states[i], stacked_state_loop(memory, frames, dones, next_step)
+        )
@@ -0,0 +1,29 @@
+"""The batched frame stacking of ReplayMemory against the per-index loop."""
+
+import numpy as np
+import pytest
+
+from deeprl_hw2.core import ReplayMemory
+
+STATE_SHAPE = (4, 5)
+
+
+@pytest.mark.parametrize("num_samples", [60, 250])
+def test_stacked_frames_batch_matches_loop(fill_memory, num_samples):
+    memory = fill_memory(ReplayMemory(100, 4, STATE_SHAPE), num_samples)
+    indices = np.arange(memory.size)
+
+    expected = np.stack([memory._get_stacked_frames(i) for i in indices])
+    np.testing.assert_array_equal(memory._get_stacked_frames_batch(indices), expected)
+
+
+def test_full_memory_stacks_frames_across_the_wrap(fill_memory):
+    memory = fill_memory(ReplayMemory(100, 4, STATE_SHAPE), 250, episode_length=1000)
+    assert memory.size == memory.max_size
+
+    # The stack of slot 1 continues from the last slots of the buffer
+    expected = memory.frames[[98, 99, 0, 1]]
+    np.testing.assert_array_equal(memory._get_stacked_frames(1), expected)
+    np.testing.assert_array_equal(
+        memory._get_stacked_frames_batch(np.array([1]))[0], expected
+    )
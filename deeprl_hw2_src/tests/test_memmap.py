@@ -0,0 +1,28 @@
+"""MemmapReplayMemory against the in-memory ReplayMemory."""
+
+import os
+
+import numpy as np
+
+from deeprl_hw2.core import MemmapReplayMemory, ReplayMemory
+
+STATE_SHAPE = (4, 5)
+
+
+def test_memmap_memory_matches_in_memory(fill_memory, tmp_path):
+    memory = fill_memory(ReplayMemory(100, 4, STATE_SHAPE, n_step=3), 250)
+    memmap = fill_memory(
+        MemmapReplayMemory(100, 4, STATE_SHAPE, path=str(tmp_path), n_step=3), 250
+    )
+
+    assert (memmap.position, memmap.size) == (memory.position, memory.size)
+    np.random.seed(0)
+    expected = memory.sample(32)
+    np.random.seed(0)
+    for array, expected_array in zip(memmap.sample(32), expected):
+        np.testing.assert_array_equal(array, expected_array)
+
+    # The frames live in the file, not in resident memory
+    assert isinstance(memmap.frames, np.memmap)
+    size = os.path.getsize(tmp_path / "frames.dat")
+    assert size == 100 * np.prod(STATE_SHAPE)
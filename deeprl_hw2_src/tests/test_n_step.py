@@ -0,0 +1,57 @@
+"""N-step returns of the replay memories against a per-step loop."""
+
+import numpy as np
+import pytest
+
+from deeprl_hw2.core import PrioritizedReplayMemory, ReplayMemory
+
+STATE_SHAPE = (4, 5)
+
+
+def n_step_return_loop(memory, idx):
+    """The n-step return and done of one transition, one step at a time."""
+    ret, done = 0.0, False
+    for k in range(memory.n_step):
+        step = (idx + k) % memory.max_size
+        ret += memory.gamma**k * memory.rewards[step]
+        if memory.dones[step]:
+            done = True
+            break
+    return ret, done
+
+
+@pytest.mark.parametrize("n_step", [1, 3, 5])
+def test_n_step_returns_match_loop(fill_memory, n_step):
+    memory = fill_memory(
+        ReplayMemory(100, 4, STATE_SHAPE, n_step=n_step, gamma=0.9), 250
+    )
+    indices = np.arange(memory.size)
+
+    returns, dones = memory._get_n_step_returns(indices)
+    expected = [n_step_return_loop(memory, i) for i in indices]
+    np.testing.assert_allclose(returns, [r for r, _ in expected], rtol=1e-5)
+    np.testing.assert_array_equal(dones, [d for _, d in expected])
+
+
+def test_sample_skips_transitions_behind_position(fill_memory):
+    n_step = 3
+    memory = fill_memory(ReplayMemory(100, 4, STATE_SHAPE, n_step=n_step), 250)
+    np.random.seed(0)
+    indices = memory._sample_indices(10000)
+
+    behind = (memory.position - np.arange(1, n_step + 1)) % memory.max_size
+    assert not np.isin(indices, behind).any()
+    assert len(np.unique(indices)) == memory.size - n_step
+
+
+def test_prioritized_memory_skips_newest_transitions(fill_memory):
+    n_step = 3
+    memory = fill_memory(
+        PrioritizedReplayMemory(64, 4, STATE_SHAPE, n_step=n_step), 150
+    )
+    behind = (memory.position - np.arange(1, n_step + 1)) % memory.max_size
+
+    assert (memory.sum_tree[behind] == 0).all()
+    np.random.seed(0)
+    *_, indices = memory.sample(32)
+    assert not np.isin(indices, behind).any()
@@ -0,0 +1,48 @@
+"""BatchPrefetcher samples with its own generator and stops with fit."""
+
+import numpy as np
+import pytest
+import torch
+
+from deeprl_hw2.core import ReplayMemory
+from deeprl_hw2.prefetcher import BatchPrefetcher
+
+STATE_SHAPE = (4, 5)
+
+
+def test_prefetcher_samples_from_its_own_generator(fill_memory):
+    memory = fill_memory(ReplayMemory(100, 4, STATE_SHAPE, n_step=3), 150)
+    rng = np.random.default_rng(0)
+    expected = [memory.sample(8, rng=rng) for _ in range(3)]
+
+    np.random.seed(0)
+    global_state = np.random.get_state()[1].copy()
+    prefetcher = BatchPrefetcher(memory, 8, torch.device("cpu"), seed=0)
+    try:
+        for expected_batch in expected:
+            states, actions, rewards, next_states, dones, weights, indices = (
+                prefetcher.get()
+            )
+            expected_states, expected_actions, expected_rewards = expected_batch[:3]
+            np.testing.assert_allclose(states.numpy(), expected_states / 255.0)
+            np.testing.assert_array_equal(actions.numpy(), expected_actions)
+            np.testing.assert_allclose(rewards.numpy(), expected_rewards)
+            assert torch.all(weights == 1.0) and indices is None
+    finally:
+        prefetcher.close()
+    np.testing.assert_array_equal(np.random.get_state()[1], global_state)
+
+
+def test_fit_closes_the_prefetcher_on_errors(fill_memory, make_agent):
+    memory = fill_memory(ReplayMemory(100, 4, STATE_SHAPE), 150)
+    agent = make_agent(memory, num_prefetch=2)
+    agent.train_step()
+    thread = agent.prefetcher.thread
+
+    class BrokenEnv:
+        def reset(self):
+            raise RuntimeError("Environment crashed")
+
+    with pytest.raises(RuntimeError):
+        agent.fit(BrokenEnv(), num_iterations=10)
+    assert agent.prefetcher is None and not thread.is_alive()
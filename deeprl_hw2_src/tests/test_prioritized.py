@@ -0,0 +1,45 @@
+"""The segment trees of PrioritizedReplayMemory against NumPy reductions."""
+
+import numpy as np
+import pytest
+
+from deeprl_hw2.core import MinTree, PrioritizedReplayMemory, SumTree
+
+STATE_SHAPE = (4, 5)
+
+
+def test_segment_trees_match_numpy():
+    rng = np.random.default_rng(0)
+    priorities = rng.random(100)
+    sum_tree, min_tree = SumTree(100), MinTree(100)
+    sum_tree.update(np.arange(100), priorities)
+    min_tree.update(np.arange(100), priorities)
+
+    # Overwrite a batch of leaves, including repeated ancestors
+    changed = rng.choice(100, size=30, replace=False)
+    priorities[changed] = rng.random(30)
+    sum_tree.update(changed, priorities[changed])
+    min_tree.update(changed, priorities[changed])
+
+    assert sum_tree.reduce() == pytest.approx(priorities.sum())
+    assert min_tree.reduce() == priorities.min()
+    np.testing.assert_array_equal(sum_tree[np.arange(100)], priorities)
+
+    prefixsums = rng.uniform(0, priorities.sum(), size=1000)
+    expected = np.searchsorted(np.cumsum(priorities), prefixsums, side="right")
+    np.testing.assert_array_equal(sum_tree.find_prefixsum_idx(prefixsums), expected)
+
+
+def test_prioritized_sampling_follows_priorities(fill_memory):
+    memory = fill_memory(PrioritizedReplayMemory(64, 4, STATE_SHAPE), 64)
+    indices = np.arange(memory.size - 1)
+    td_errors = np.zeros(len(indices))
+    td_errors[::8] = 1e3
+    memory.update_priorities(indices, td_errors)
+
+    np.random.seed(0)
+    *_, weights, sampled = memory.sample(32)
+    assert np.isin(sampled, indices[::8]).all()
+    # Normalized by the largest weight, that of the smallest priority
+    assert (weights <= 1.0).all()
+    np.testing.assert_allclose(weights, weights[0])
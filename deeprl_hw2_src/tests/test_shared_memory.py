@@ -0,0 +1,29 @@
+"""SharedReplayMemory sees and checkpoints the appends of a forked process."""
+
+import multiprocessing as mp
+
+from deeprl_hw2.core import ReplayMemory, SharedReplayMemory
+
+STATE_SHAPE = (4, 5)
+
+
+def test_checkpoint_after_appends_from_a_forked_process(fill_memory, tmp_path):
+    memory = SharedReplayMemory(100, 4, STATE_SHAPE, n_step=3)
+    actor = mp.get_context("fork").Process(target=fill_memory, args=(memory, 150))
+    actor.start()
+    actor.join()
+    assert actor.exitcode == 0
+
+    expected = fill_memory(ReplayMemory(100, 4, STATE_SHAPE, n_step=3), 150)
+    assert (memory.position, memory.size, memory.total_steps) == (
+        expected.position,
+        expected.size,
+        expected.total_steps,
+    )
+    memory.save_checkpoint(str(tmp_path), chunk_size=16)
+
+    restored = ReplayMemory(100, 4, STATE_SHAPE, n_step=3)
+    restored.load_checkpoint(str(tmp_path))
+    assert restored.total_steps == 150
+    for name in ReplayMemory.CHUNKED_ARRAYS:
+        assert (getattr(restored, name) == getattr(expected, name)).all()
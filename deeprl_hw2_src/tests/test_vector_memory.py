@@ -0,0 +1,38 @@
+"""VectorReplayMemory keeps the transitions of every environment apart."""
+
+import numpy as np
+import pytest
+
+from deeprl_hw2.core import VectorReplayMemory
+
+STATE_SHAPE = (4, 5)
+
+
+def test_vector_memory_samples_within_one_environment():
+    num_envs = 3
+    memory = VectorReplayMemory(num_envs, 300, 4, STATE_SHAPE, n_step=3, gamma=1.0)
+    env_ids = np.arange(num_envs)
+    # Every frame, action and reward identifies the environment it came from
+    frames = np.zeros((num_envs, *STATE_SHAPE), dtype=np.uint8)
+    frames += (env_ids + 2).astype(np.uint8)[:, None, None]
+    for _ in range(150):
+        memory.append(frames, env_ids, env_ids, np.zeros(num_envs, dtype=bool))
+
+    np.random.seed(0)
+    states, actions, rewards, next_states, dones = memory.sample(64)
+    assert set(actions) == set(env_ids)
+    np.testing.assert_array_equal(states, next_states)
+    expected_states = np.broadcast_to(actions[:, None, None, None] + 2, states.shape)
+    np.testing.assert_array_equal(states, expected_states)
+    np.testing.assert_allclose(rewards, 3 * actions)
+    assert not dones.any()
+
+
+def test_vector_memory_needs_a_sampleable_shard():
+    memory = VectorReplayMemory(2, 100, 4, STATE_SHAPE, n_step=3)
+    frames = np.full((2, *STATE_SHAPE), 2, dtype=np.uint8)
+    for _ in range(3):
+        memory.append(frames, np.zeros(2), np.zeros(2), np.zeros(2, dtype=bool))
+
+    with pytest.raises(AssertionError):
+        memory.sample(4)